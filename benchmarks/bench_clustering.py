@@ -0,0 +1,100 @@
+""" scaling benchmark of the speaker clustering backends, on synthetic embeddings
+
+python3 benchmarks/bench_clustering.py
+python3 benchmarks/bench_clustering.py --sizes 100,1000,10000 --output clustering.json
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import fire
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from speaker_clustering import CLUSTERING_BACKENDS, get_clustering_backend
+
+
+def synthetic_embeddings(num_segments, num_speakers, dimension=192, noise=0.6, seed=0):
+    """ segment embeddings scattered around one random direction per speaker
+
+    Returns
+    -----------
+    embeddings : numpy array
+        (num_segments, dimension)
+    speakers : numpy array
+        true speaker of every segment
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_speakers, dimension))
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    speakers = rng.integers(0, num_speakers, num_segments)
+    embeddings = centers[speakers] + noise * rng.normal(size=(num_segments, dimension)) / np.sqrt(dimension)
+    return embeddings, speakers
+
+
+def run(sizes='100,500,1000,5000,10000,50000', num_speakers=4, backends=','.join(CLUSTERING_BACKENDS),
+        max_exact=10000, output=None):
+    """ times every backend on growing inputs, with peak memory of numpy allocations
+    and the adjusted rand index against the true speakers and the exact labels
+
+    Parameters
+    -----------
+    sizes : string, int or tuple
+        numbers of segments
+    num_speakers : int
+        number of speakers
+    backends : string or tuple
+        names of the backends to run
+    max_exact : int
+        largest input the quadratic 'agglomerative' backend is run on
+    output : string, optional
+        path of a json file the results are written to
+    """
+    #fire passes a single value as a number
+    sizes = [sizes] if isinstance(sizes, (int, float)) else sizes
+    sizes = [int(size) for size in (sizes.split(',') if isinstance(sizes, str) else sizes)]
+    backends = backends.split(',') if isinstance(backends, str) else list(backends)
+
+    results = []
+    for size in sizes:
+        embeddings, speakers = synthetic_embeddings(size, num_speakers)
+        exact_labels = None
+
+        for name in backends:
+            if name == 'agglomerative' and size > max_exact:
+                continue
+
+            backend = get_clustering_backend(name)
+            tracemalloc.start()
+            start = time.perf_counter()
+            labels = backend(embeddings, num_speakers)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            if name == 'agglomerative':
+                exact_labels = labels
+
+            result = {
+                'backend': name,
+                'segments': size,
+                'seconds': round(seconds, 4),
+                'peak_mb': round(peak / 2 ** 20, 1),
+                'ari_true': round(adjusted_rand_score(speakers, labels), 4),
+                'ari_exact': None if exact_labels is None else round(adjusted_rand_score(exact_labels, labels), 4),
+            }
+            results.append(result)
+            print('{backend:>14} {segments:>7} segments {seconds:>9.3f}s {peak_mb:>9.1f} MB  '
+                'ARI true {ari_true}  ARI exact {ari_exact}'.format(**result))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -0,0 +1,252 @@
+""" end to end benchmark of the pipeline stages on synthetic audio, with stub models
+
+Every duration runs in a fresh process on a synthetic multi-speaker wav (see synthetic.py),
+through the SpeechPipeline stage methods with the whisper and speaker embedding models
+replaced by the stubs, so the numbers measure the pipeline code and not the models.
+Reports wall time, real time factor, peak RSS and segments/second of every stage.
+
+python3 benchmarks/bench_pipeline.py run --output before.json
+python3 benchmarks/bench_pipeline.py run --durations 60,600 --baseline before.json
+python3 benchmarks/bench_pipeline.py compare before.json after.json
+"""
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fire
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+
+#stages in the order they run, every duration runs all of the selected ones
+STAGES = ('decode', 'transcribe', 'diarize', 'transcript', 'captions')
+
+
+def _peak_rss_mb():
+    """ peak resident memory of this process so far """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_one(path, stages=','.join(STAGES), num_speakers=2, use_mmap=True, clustering='agglomerative'):
+    """ runs the stages once on one file and prints the measurements as json.
+    Called by run in a fresh process per file, so peak RSS is per input.
+
+    Parameters
+    -----------
+    path : string
+        16 kHz wav file
+    stages : string or tuple
+        names of the stages to run, from STAGES
+    num_speakers : int
+        number of speakers in the file
+    use_mmap : boolean
+        memory map the wav (no ffmpeg needed) instead of decoding it
+    clustering : string
+        speaker clustering backend
+    """
+    from main import SpeechPipeline
+    from preprocess_audio import AudioFile
+    from synthetic import StubASRModel, StubEmbeddingModel
+
+    stages = stages.split(',') if isinstance(stages, str) else list(stages)
+    outdir = tempfile.mkdtemp(prefix='bench_pipeline_')
+
+    pipeline = SpeechPipeline(path, num_speakers, 'en', outpath=outdir + '/', use_diarize=True,
+        use_mmap=use_mmap, clustering=clustering, verbose=False)
+    pipeline.whisper_model = StubASRModel()
+    pipeline.diarizaton_model = StubEmbeddingModel()
+    #the non reentrant lock of model_server.py, a stage taking it twice hangs here instead of on the server
+    pipeline.model_lock = threading.Lock()
+
+    audio_file = AudioFile(path, 'en', num_speakers, use_mmap=use_mmap)
+    segments = []
+
+    def decode():
+        audio_file.open_wav() if use_mmap else audio_file.load_audio()
+
+    def transcribe():
+        segments[:] = pipeline.transcribe_audio_file(audio_file)
+
+    def diarize():
+        segments[:] = pipeline.diarize_audio_file(audio_file, segments)
+
+    def transcript():
+        pipeline.create_transcript('bench', segments)
+
+    def captions():
+        pipeline.create_vtt_file('bench_captions.vtt', segments)
+
+    functions = dict(decode=decode, transcribe=transcribe, diarize=diarize, transcript=transcript, captions=captions)
+
+    results = []
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        start = time.perf_counter()
+        functions[stage]()
+        seconds = time.perf_counter() - start
+        results.append({'stage': stage, 'seconds': seconds, 'segments': len(segments), 'peak_rss_mb': _peak_rss_mb()})
+
+    audio_file.close()
+    for name in os.listdir(outdir):
+        os.remove(os.path.join(outdir, name))
+    os.rmdir(outdir)
+
+    print(json.dumps({'results': results}))
+    return
+
+
+def _metadata():
+    """ where and when the results were measured """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def run(durations='60,600,3600,14400', stages=','.join(STAGES), num_speakers=2, use_mmap=True,
+        clustering='agglomerative', audio_dir=None, output=None, baseline=None, max_slowdown=0.25):
+    """ benchmarks every stage on synthetic audio of every duration
+
+    Parameters
+    -----------
+    durations : string, number or tuple
+        lengths of the synthetic recordings in seconds, 1 minute to 4 hours by default
+    stages : string or tuple
+        names of the stages to run, from STAGES
+    num_speakers : int
+        number of speakers in the synthetic recordings
+    use_mmap : boolean
+        memory map the wav instead of decoding it with ffmpeg
+    clustering : string
+        speaker clustering backend, 'knn' or 'two_stage' for the long durations
+    audio_dir : string, optional
+        directory the synthetic wavs are written to and reused from, defaults to the temp directory
+    output : string, optional
+        path of a json file the results are written to
+    baseline : string, optional
+        json file of an earlier run, exits with status 1 if a stage regressed
+    max_slowdown : float
+        relative slowdown (and peak RSS growth) of a stage allowed against the baseline
+    """
+    #fire passes a single value as a number
+    durations = [durations] if isinstance(durations, (int, float)) else durations
+    durations = [float(duration) for duration in (durations.split(',') if isinstance(durations, str) else durations)]
+    stages = ','.join(stages) if not isinstance(stages, str) else stages
+    audio_dir = audio_dir or os.path.join(tempfile.gettempdir(), 'speech_pipeline_bench')
+
+    from synthetic import synthetic_wav
+
+    report = {'metadata': _metadata(), 'results': []}
+    for duration in durations:
+        path = synthetic_wav(audio_dir, duration, num_speakers)
+        cmd = [sys.executable, os.path.abspath(__file__), 'run_one', path, '--stages', stages,
+            '--num_speakers', str(num_speakers), '--use_mmap', str(use_mmap), '--clustering', clustering]
+        measured = json.loads(subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, check=True).stdout.splitlines()[-1])
+
+        for result in measured['results']:
+            result = {
+                'duration': duration,
+                'stage': result['stage'],
+                'seconds': round(result['seconds'], 4),
+                'real_time_factor': round(result['seconds'] / duration, 6),
+                'segments': result['segments'],
+                'segments_per_second': round(result['segments'] / result['seconds'], 1) if result['seconds'] > 0 and result['segments'] else None,
+                'peak_rss_mb': round(result['peak_rss_mb'], 1),
+            }
+            report['results'].append(result)
+            print('{duration:>8.0f}s {stage:>10} {seconds:>9.3f}s  RTF {real_time_factor:<9} '
+                '{segments_per_second!s:>10} seg/s {peak_rss_mb:>8.1f} MB peak'.format(**result))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = _regressions(json.load(f), report, max_slowdown)
+        _exit_on_regressions(regressions)
+    return
+
+
+def _regressions(baseline, current, max_slowdown=0.25, min_seconds=0.05):
+    """ stages of current that are slower or use more memory than in baseline
+
+    Parameters
+    -----------
+    baseline, current : dictionaries
+        reports written by run
+    max_slowdown : float
+        allowed relative growth of the wall time and peak RSS
+    min_seconds : float
+        stages faster than this in both runs are timing noise and not compared
+
+    Returns
+    -----------
+    regressions : list of strings
+    """
+    before = {(result['duration'], result['stage']): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = before.get((result['duration'], result['stage']))
+        if old is None:
+            continue
+        name = '{:g}s {}'.format(result['duration'], result['stage'])
+        if max(old['seconds'], result['seconds']) >= min_seconds and result['seconds'] > old['seconds'] * (1 + max_slowdown):
+            regressions.append('{}: {}s -> {}s'.format(name, old['seconds'], result['seconds']))
+        if result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + max_slowdown):
+            regressions.append('{}: peak RSS {} MB -> {} MB'.format(name, old['peak_rss_mb'], result['peak_rss_mb']))
+    return regressions
+
+
+def _exit_on_regressions(regressions):
+    """ prints the regressions and exits with status 1 if there are any """
+    if regressions:
+        print('regressions:\n  ' + '\n  '.join(regressions), file=sys.stderr)
+        sys.exit(1)
+    print('no regressions')
+
+
+def compare(baseline, current, max_slowdown=0.25, min_seconds=0.05):
+    """ compares two reports written by run, exits with status 1 if a stage regressed
+
+    Parameters
+    -----------
+    baseline : string
+        json file of the reference run
+    current : string
+        json file of the run to check
+    max_slowdown : float
+        allowed relative growth of the wall time and peak RSS of a stage
+    min_seconds : float
+        stages faster than this in both runs are not compared
+    """
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    _exit_on_regressions(_regressions(baseline, current, max_slowdown, min_seconds))
+    return
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run, 'run_one': run_one, 'compare': compare})
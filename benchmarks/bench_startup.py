@@ -0,0 +1,76 @@
+""" startup benchmark of the command line interface
+
+Times `import main` and `python3 main.py --help` in fresh interpreters and checks
+that none of the heavy libraries are imported before a stage needs them.
+Exits with status 1 on a regression, so it can run in CI.
+
+python3 benchmarks/bench_startup.py
+python3 benchmarks/bench_startup.py --max_seconds 1.5 --output startup.json
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import fire
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#libraries that must only be imported by the stages that use them
+HEAVY_MODULES = ('torch', 'whisper', 'whisperx', 'pyannote', 'pandas', 'sklearn', 'scipy', 'speechbrain')
+
+
+def _time_command(cmd, repeat):
+    """ median wall time of running cmd in a fresh process """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, PAGER='cat'))
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run(repeat=5, max_seconds=2.0, output=None):
+    """ measures startup time and the modules imported by `import main`
+
+    Parameters
+    -----------
+    repeat : int
+        runs per measurement, the median is reported
+    max_seconds : float
+        fail if `python3 main.py --help` takes longer than this
+    output : string, optional
+        path of a json file the results are written to
+    """
+    check = 'import sys, json, main; print(json.dumps([m for m in {!r} if m in sys.modules]))'.format(HEAVY_MODULES)
+    imported = json.loads(subprocess.run([sys.executable, '-c', check], cwd=ROOT, capture_output=True,
+        text=True, check=True).stdout)
+
+    results = {
+        'python_startup_seconds': round(_time_command([sys.executable, '-c', 'pass'], repeat), 4),
+        'import_main_seconds': round(_time_command([sys.executable, '-c', 'import main'], repeat), 4),
+        'help_seconds': round(_time_command([sys.executable, 'main.py', '--help'], repeat), 4),
+        'heavy_modules_imported': imported,
+    }
+    print(json.dumps(results, indent=2))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if imported:
+        failures.append('heavy modules imported at startup: ' + ', '.join(imported))
+    if results['help_seconds'] > max_seconds:
+        failures.append('--help took {}s, more than {}s'.format(results['help_seconds'], max_seconds))
+    if failures:
+        print('\n'.join(failures), file=sys.stderr)
+        sys.exit(1)
+    return
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -0,0 +1,147 @@
+""" accuracy against speed of the whisper model sizes in fp32 and int8 on the cpu
+
+Every model size and precision transcribes the same audio, by default a synthetic wav
+(see synthetic.py). Reports load time, transcription time, real time factor, model size
+in memory, the cosine similarity of the encoder output to fp32, and the word error rate
+against a reference transcript, or against the fp32 transcript of the same model size
+when no reference is given (synthetic audio has no words, so only the agreement is
+meaningful there).
+
+python3 benchmarks/bench_whisper_precision.py
+python3 benchmarks/bench_whisper_precision.py --model_sizes tiny,base,small --num_threads 4
+python3 benchmarks/bench_whisper_precision.py --audio speech.wav --reference speech.txt --output precision.json
+"""
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import fire
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+from bench_pipeline import _metadata
+
+
+def word_error_rate(reference, hypothesis):
+    """ word level edit distance over the number of reference words """
+    reference, hypothesis = reference.lower().split(), hypothesis.lower().split()
+    if not reference:
+        return float(len(hypothesis) > 0)
+    #one row of the edit distance table at a time
+    distances = np.arange(len(hypothesis) + 1)
+    for i, word in enumerate(reference, 1):
+        previous, distances = distances, np.empty_like(distances)
+        distances[0] = i
+        substitutions = previous[:-1] + (np.array(hypothesis) != word)
+        for j in range(1, len(hypothesis) + 1):
+            distances[j] = min(previous[j] + 1, distances[j - 1] + 1, substitutions[j - 1])
+    return distances[-1] / len(reference)
+
+
+def model_megabytes(model):
+    """ size of the serialized weights, int8 layers count with their packed weights """
+    import torch
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def run(model_sizes='tiny,base', precisions='fp32,int8', audio=None, reference=None, language='en',
+        duration=60, num_threads=None, output=None):
+    """ transcribes the audio with every model size and precision
+
+    Parameters
+    -----------
+    model_sizes : string or tuple
+        whisper model sizes, from WHISPER_MODEL_SIZES in main.py
+    precisions : string or tuple
+        'fp32' and/or 'int8', fp32 is always run first as the reference
+    audio : string, optional
+        audio file to transcribe, defaults to a synthetic wav of duration seconds
+    reference : string, optional
+        text file with the reference transcript of audio
+    language : string
+        language of the audio
+    duration : float
+        length of the synthetic wav in seconds
+    num_threads : int, optional
+        torch threads, defaults to all cores
+    output : string, optional
+        path of a json file the results are written to
+    """
+    model_sizes = model_sizes.split(',') if isinstance(model_sizes, str) else list(model_sizes)
+    precisions = precisions.split(',') if isinstance(precisions, str) else list(precisions)
+    #the other precisions are compared to fp32
+    precisions = ['fp32'] + [precision for precision in precisions if precision != 'fp32']
+
+    import torch
+    import whisper
+
+    from main import SpeechPipeline
+    from parallel_pipeline import set_num_threads
+    from preprocess_audio import AudioFile
+    from synthetic import synthetic_wav
+
+    if num_threads is not None:
+        set_num_threads(num_threads)
+
+    if audio is None:
+        audio = synthetic_wav(os.path.join(tempfile.gettempdir(), 'speech_pipeline_bench'), duration)
+    samples = np.asarray(AudioFile(audio, language, 1, use_mmap=True).audio, dtype=np.float32)
+    seconds = len(samples) / 16000
+    if reference is not None:
+        with open(reference) as f:
+            reference = f.read()
+
+    report = {'metadata': dict(_metadata(), audio=audio, audio_seconds=seconds, num_threads=torch.get_num_threads()),
+        'results': []}
+    mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(samples))[None]
+    for model_size in model_sizes:
+        fp32_text, fp32_features = None, None
+        for precision in precisions:
+            start = time.perf_counter()
+            #unmemoized, so only one model is held at a time
+            model = SpeechPipeline.load_whisper_model.__wrapped__(model_size=model_size, use_gpu=False, precision=precision)
+            load_seconds = time.perf_counter() - start
+
+            with torch.inference_mode():
+                features = model.embed_audio(mel).flatten().float()
+                start = time.perf_counter()
+                result = model.transcribe(samples, language=language, fp16=False)
+                transcribe_seconds = time.perf_counter() - start
+            text = ' '.join(segment['text'].strip() for segment in result['segments'])
+
+            if precision == 'fp32':
+                fp32_text, fp32_features = text, features
+            result = {
+                'model_size': model_size,
+                'precision': precision,
+                'load_seconds': round(load_seconds, 3),
+                'transcribe_seconds': round(transcribe_seconds, 3),
+                'real_time_factor': round(transcribe_seconds / seconds, 4),
+                'model_mb': round(model_megabytes(model), 1),
+                'encoder_cosine': round(float(torch.nn.functional.cosine_similarity(features, fp32_features, dim=0)), 5),
+                'wer': round(word_error_rate(reference if reference is not None else fp32_text, text), 4),
+                'wer_reference': 'reference' if reference is not None else 'fp32',
+                'segments': len(result['segments']),
+            }
+            report['results'].append(result)
+            print('{model_size:>9} {precision:>5} load {load_seconds:>7.2f}s  transcribe {transcribe_seconds:>8.2f}s  '
+                'RTF {real_time_factor:<8} {model_mb:>7.1f} MB  cosine {encoder_cosine:<8} WER {wer}'.format(**result))
+            del model
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run})
@@ -0,0 +1,237 @@
+""" offline fixtures for the benchmarks: synthetic multi-speaker audio and lightweight
+stand-ins for the whisper and speaker embedding models
+
+The audio is made of speaker turns separated by short pauses, over low background noise.
+Every speaker talks in speech-like bursts (syllables at a few per second) of a harmonic
+tone with its own pitch, and some turns are replaced by plain tones or noise.
+
+python3 benchmarks/synthetic.py --duration 600 --path ten_minutes.wav
+"""
+import json
+import os
+import wave
+
+import fire
+import numpy as np
+
+SAMPLE_RATE = 16000
+#pitch of every speaker, in Hz
+SPEAKER_PITCHES = (110.0, 175.0, 240.0, 310.0, 95.0, 205.0, 275.0, 140.0)
+#seconds generated at a time, bounds memory when writing hours of audio
+CHUNK_SECONDS = 60.0
+
+
+def synthetic_turns(duration, num_speakers=2, seed=0):
+    """ random speaker turns covering duration seconds
+
+    Returns
+    -----------
+    turns : dictionary of numpy arrays
+        'start', 'end' in seconds, 'speaker' index and 'kind' (0 speech bursts, 1 tone, 2 noise)
+    """
+    rng = np.random.default_rng(seed)
+    #enough turns for the shortest turns and pauses, trimmed below
+    count = int(duration / 1.7) + 2
+    lengths = rng.uniform(1.5, 8.0, count)
+    pauses = rng.uniform(0.2, 1.0, count)
+    starts = np.concatenate([[0.0], np.cumsum(lengths + pauses)[:-1]]) + pauses[0]
+    ends = starts + lengths
+    keep = starts < duration
+
+    return {
+        'start': starts[keep],
+        'end': np.minimum(ends[keep], duration),
+        'speaker': rng.integers(0, num_speakers, count)[keep],
+        'kind': rng.choice(3, count, p=[0.9, 0.05, 0.05])[keep],
+    }
+
+
+def render(turns, first, last, seed=0):
+    """ float32 samples first to last of the audio described by turns """
+    rng = np.random.default_rng([seed, first])
+    t = np.arange(first, last) / SAMPLE_RATE
+    samples = 0.003 * rng.standard_normal(len(t))
+
+    #turn under every sample, -1 in pauses
+    turn = np.searchsorted(turns['start'], t, side='right') - 1
+    inside = (turn >= 0) & (t < turns['end'][np.maximum(turn, 0)])
+    if not inside.any():
+        return samples.astype(np.float32)
+
+    t_in = t[inside]
+    turn = turn[inside]
+    local = t_in - turns['start'][turn]
+    pitch = np.asarray(SPEAKER_PITCHES)[turns['speaker'][turn] % len(SPEAKER_PITCHES)]
+    kind = turns['kind'][turn]
+
+    #three harmonics with a slow pitch wobble
+    phase = 2 * np.pi * pitch * local * (1 + 0.02 * np.sin(2 * np.pi * 0.5 * local))
+    voice = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+    #syllables, about four per second
+    envelope = np.sin(np.pi * ((local * (3.5 + 0.2 * (turn % 5))) % 1.0)) ** 2
+
+    signal = np.where(kind == 0, 0.2 * envelope * voice, 0.0)
+    signal = np.where(kind == 1, 0.1 * np.sin(2 * np.pi * 2 * pitch * local), signal)
+    signal = np.where(kind == 2, 0.05 * rng.standard_normal(len(t_in)), signal)
+    samples[inside] += signal
+    return samples.astype(np.float32)
+
+
+def synthetic_audio(duration, num_speakers=2, seed=0):
+    """ the whole synthetic recording in memory, for short durations
+
+    Returns
+    -----------
+    samples : numpy array
+        float32 samples at 16 kHz
+    turns : dictionary of numpy arrays
+        from synthetic_turns
+    """
+    turns = synthetic_turns(duration, num_speakers, seed)
+    return render(turns, 0, int(duration * SAMPLE_RATE), seed), turns
+
+
+def write_wav(path, duration, num_speakers=2, seed=0):
+    """ writes the synthetic recording to a 16 kHz mono 16 bit wav, a chunk at a time.
+    The turns are saved next to it as path + '.json'.
+
+    Returns
+    -----------
+    turns : dictionary of numpy arrays
+        from synthetic_turns
+    """
+    turns = synthetic_turns(duration, num_speakers, seed)
+    total = int(duration * SAMPLE_RATE)
+    chunk = int(CHUNK_SECONDS * SAMPLE_RATE)
+
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        for first in range(0, total, chunk):
+            samples = render(turns, first, min(total, first + chunk), seed)
+            f.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+    with open(path + '.json', 'w') as f:
+        json.dump({key: value.tolist() for key, value in turns.items()}, f)
+    return turns
+
+
+def synthetic_wav(audio_dir, duration, num_speakers=2, seed=0):
+    """ path to a synthetic wav in audio_dir, written on first use and reused afterwards """
+    path = os.path.join(audio_dir, 'synthetic_{:g}s_{}spk_{}.wav'.format(duration, num_speakers, seed))
+    if not os.path.exists(path + '.json'):
+        os.makedirs(audio_dir, exist_ok=True)
+        write_wav(path, duration, num_speakers, seed)
+    return path
+
+
+class StubASRModel(object):
+    """
+    """
+    def __init__(self, words_per_second=2.5, frame_seconds=0.02, threshold=0.02, min_pause=0.3):
+        """ stand-in for the whisper model with the same transcribe interface.
+        Segments are the loud regions of the audio, found from the frame energy, and
+        the text is a placeholder with a realistic number of words. Its cost grows
+        linearly with the audio, so the benchmarks measure the code around the model.
+
+        Parameters
+        -----------
+        words_per_second : float
+            length of the placeholder text
+        frame_seconds : float
+            frame length of the energy detector
+        threshold : float
+            rms above which a frame is speech
+        min_pause : float
+            pauses shorter than this (in seconds) do not end a segment
+        """
+        self.words_per_second = words_per_second
+        self.frame_seconds = frame_seconds
+        self.threshold = threshold
+        self.min_pause = min_pause
+        self.is_multilingual = True
+
+    def transcribe(self, audio, task='transcribe', initial_prompt=None, **options):
+        """ same output layout as whisper.transcribe """
+        audio = np.asarray(audio, dtype=np.float32)
+        frame = int(self.frame_seconds * SAMPLE_RATE)
+        num_frames = len(audio) // frame
+
+        frames = audio[:num_frames * frame].reshape(num_frames, frame)
+        speech = np.sqrt(np.einsum('ij,ij->i', frames, frames) / frame) > self.threshold
+
+        #start and end frame of every run of speech frames
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], speech.astype(np.int8), [0]])))
+        starts, ends = edges[::2], edges[1::2]
+        if len(starts) > 1:
+            #merge runs split by short pauses
+            keep = np.concatenate([[True], (starts[1:] - ends[:-1]) * self.frame_seconds >= self.min_pause])
+            starts, ends = starts[keep], np.concatenate([ends[:-1][keep[1:]], ends[-1:]])
+
+        word = 'word' if task == 'transcribe' else 'english'
+        segments = []
+        for start, end in zip(starts * self.frame_seconds, ends * self.frame_seconds):
+            num_words = max(1, int(round((end - start) * self.words_per_second)))
+            segments.append({
+                'id': len(segments),
+                'seek': int(start * 100) // 3000 * 3000,
+                'start': float(start),
+                'end': float(end),
+                'text': ' ' + ' '.join([word] * num_words),
+                'tokens': list(range(num_words)),
+                'temperature': 0.0,
+                'avg_logprob': -0.2,
+                'compression_ratio': 1.5,
+                'no_speech_prob': 0.01,
+            })
+        return {'text': ''.join(segment['text'] for segment in segments), 'segments': segments, 'language': 'en'}
+
+
+class StubEmbeddingModel(object):
+    """
+    """
+    def __init__(self, dimension=192, num_bands=32, min_seconds=0.1, seed=0):
+        """ stand-in for the pyannote speaker embedding model with the same batched
+        interface. Embeddings are a fixed random projection of the log spectrum between
+        60 Hz and 1 kHz, pooled into bands, which tells the synthetic speakers apart.
+
+        Parameters
+        -----------
+        dimension : int
+            size of the embeddings
+        num_bands : int
+            number of log spaced frequency bands
+        min_seconds : float
+            shorter waveforms get NaN embeddings, like the real model
+        seed : int
+            seed of the projection
+        """
+        self.dimension = dimension
+        self.sample_rate = SAMPLE_RATE
+        self.band_edges = np.geomspace(60.0, 1000.0, num_bands + 1)
+        self.min_samples = int(min_seconds * SAMPLE_RATE)
+        self.projection = np.random.default_rng(seed).normal(size=(num_bands, dimension)) / np.sqrt(num_bands)
+
+    def __call__(self, waveforms, masks=None):
+        """ waveforms (batch, 1, samples) and masks (batch, samples) -> (batch, dimension) """
+        waveforms = np.asarray(waveforms, dtype=np.float32)[:, 0]
+        if masks is not None:
+            waveforms = waveforms * np.asarray(masks, dtype=np.float32)
+            lengths = np.asarray(masks).sum(axis=1)
+        else:
+            lengths = np.full(len(waveforms), waveforms.shape[1])
+
+        spectrum = np.abs(np.fft.rfft(waveforms, axis=1))
+        bounds = np.searchsorted(np.fft.rfftfreq(waveforms.shape[1], 1.0 / SAMPLE_RATE), self.band_edges)
+        #band sums from the running sum, empty bands stay zero
+        total = np.concatenate([np.zeros((len(spectrum), 1)), np.cumsum(spectrum, axis=1)], axis=1)
+        bands = np.log(total[:, bounds[1:]] - total[:, bounds[:-1]] + 1e-6)
+
+        embeddings = np.tanh((bands - bands.mean(axis=1, keepdims=True)) @ self.projection)
+        embeddings[lengths < self.min_samples] = np.nan
+        return embeddings
+
+
+if __name__ == '__main__':
+    fire.Fire(write_wav)
@@ -0,0 +1,199 @@
+import fcntl
+import json
+import os
+import threading
+import time
+
+import fire
+import numpy as np
+
+#typed columns of every chunk, in the order they are written
+COLUMN_DTYPES = {
+    'file_id': '<i4',
+    'variant_id': '<i2',
+    'start': '<f8',
+    'end': '<f8',
+    'speaker_id': '<i2',
+    'text_offsets': '<i8',
+}
+
+
+class CorpusStore(object):
+    """
+    """
+    def __init__(self, corpus_dir):
+        """ append-only columnar store for the segments of a whole run, instead of one csv
+        per file and variant. Every append writes one chunk of typed columns (file id,
+        variant, start, end, speaker, text) to corpus.data and then one line with its byte
+        offsets to corpus.index, so the segments of one file are read without scanning
+        the rest. Appends from several threads and processes are serialised with a lock file.
+
+        A file and variant appended again supersedes the earlier chunk, so reruns do not
+        duplicate segments.
+
+        Parameters
+        -----------
+        corpus_dir : string
+            directory of the store, created if needed
+        """
+        self.corpus_dir = corpus_dir
+        os.makedirs(corpus_dir, exist_ok=True)
+        self.data_path = os.path.join(corpus_dir, 'corpus.data')
+        self.index_path = os.path.join(corpus_dir, 'corpus.index')
+        self.lock_path = os.path.join(corpus_dir, 'corpus.lock')
+
+        #index entries read so far, and how far the index file has been read
+        self.chunks = []
+        self.file_ids = {}
+        self.variant_ids = {}
+        self._index_offset = 0
+        self._thread_lock = threading.Lock()
+
+    def _read_index(self, repair=False):
+        """ reads index lines appended since the last call. A line cut off by a crash is
+        ignored, and with repair (only while holding the lock) removed from the file.
+        """
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb+' if repair else 'rb') as f:
+            f.seek(self._index_offset)
+            data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            if repair and len(complete) < len(data):
+                f.truncate(self._index_offset + len(complete))
+
+        for line in complete.splitlines():
+            entry = json.loads(line)
+            self.file_ids.setdefault(entry['file'], len(self.file_ids))
+            self.variant_ids.setdefault(entry['variant'], len(self.variant_ids))
+            self.chunks.append(entry)
+        self._index_offset += len(complete)
+
+    def append(self, file, variant, segments):
+        """ appends the segments of one file and variant as a new chunk
+
+        Parameters
+        -----------
+        file : string
+            the audio file the segments come from
+        variant : string
+            e.g. 'transcript', 'diarized', 'word_aligned' or 'translated_to_english'
+        segments : list of dictionaries
+            with 'start', 'end', 'text' (or 'word') and optionally 'speaker'
+
+        Returns
+        -----------
+        entry : dictionary
+            index entry of the chunk
+        """
+        texts = [str(segment.get('text', segment.get('word', ''))).encode() for segment in segments]
+        speakers = sorted({str(segment['speaker']) for segment in segments if segment.get('speaker') is not None})
+        speaker_ids = {speaker: i for i, speaker in enumerate(speakers)}
+
+        with self._thread_lock, open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._read_index(repair=True)
+                file_id = self.file_ids.get(file, len(self.file_ids))
+                variant_id = self.variant_ids.get(variant, len(self.variant_ids))
+
+                columns = {
+                    'file_id': np.full(len(segments), file_id),
+                    'variant_id': np.full(len(segments), variant_id),
+                    'start': [segment.get('start', np.nan) for segment in segments],
+                    'end': [segment.get('end', np.nan) for segment in segments],
+                    'speaker_id': [speaker_ids.get(str(segment.get('speaker')), -1) for segment in segments],
+                    'text_offsets': np.concatenate([[0], np.cumsum([len(text) for text in texts], dtype=np.int64)]),
+                }
+                blocks = [np.asarray(columns[name], dtype=dtype).tobytes() for name, dtype in COLUMN_DTYPES.items()]
+                blocks.append(b''.join(texts))
+
+                with open(self.data_path, 'ab') as data:
+                    offset = data.tell()
+                    data.write(b''.join(blocks))
+
+                #byte range of every column inside the chunk
+                layout, position = {}, 0
+                for name, block in zip(list(COLUMN_DTYPES) + ['text'], blocks):
+                    layout[name] = [position, len(block)]
+                    position += len(block)
+
+                entry = {'file': file, 'variant': variant, 'rows': len(segments), 'offset': offset,
+                    'columns': layout, 'speakers': speakers, 'time': time.time()}
+                #the chunk only exists once its index line is written
+                with open(self.index_path, 'ab') as index:
+                    index.write((json.dumps(entry) + '\n').encode())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return entry
+
+    def latest_chunks(self):
+        """ index entries of the last chunk of every file and variant, in append order """
+        with self._thread_lock:
+            self._read_index()
+            latest = {(entry['file'], entry['variant']): entry for entry in self.chunks}
+        return sorted(latest.values(), key=lambda entry: entry['offset'])
+
+    def files(self):
+        """ files with segments in the store """
+        return list(dict.fromkeys(entry['file'] for entry in self.latest_chunks()))
+
+    def _read_chunk(self, data, entry):
+        """ columns of one chunk as a dictionary of arrays and lists """
+        columns = {}
+        for name, dtype in COLUMN_DTYPES.items():
+            start, size = entry['columns'][name]
+            columns[name] = np.frombuffer(data, dtype=dtype, count=size // np.dtype(dtype).itemsize,
+                offset=entry['offset'] + start)
+
+        start, size = entry['columns']['text']
+        blob = bytes(data[entry['offset'] + start:entry['offset'] + start + size])
+        offsets = columns.pop('text_offsets')
+        columns['text'] = [blob[offsets[i]:offsets[i + 1]].decode() for i in range(entry['rows'])]
+
+        speakers = np.array(entry['speakers'] + [''], dtype=object)
+        columns['speaker'] = speakers[columns.pop('speaker_id')]
+        columns['file'] = [entry['file']] * entry['rows']
+        columns['variant'] = [entry['variant']] * entry['rows']
+        return columns
+
+    def read(self, file=None, variant=None):
+        """ segments of the store as a data frame. Only the chunks of the selected file
+        and variant are read from disk.
+
+        Parameters
+        -----------
+        file : string, optional
+            only segments of this file
+        variant : string, optional
+            only segments of this variant
+
+        Returns
+        -----------
+        segments : pandas DataFrame
+            columns file_id, file, variant, start, end, speaker, text
+        """
+        import pandas as pd
+
+        names = ['file_id', 'file', 'variant', 'start', 'end', 'speaker', 'text']
+        entries = [entry for entry in self.latest_chunks()
+            if (file is None or entry['file'] == file) and (variant is None or entry['variant'] == variant)]
+        if not entries or os.path.getsize(self.data_path) == 0:
+            return pd.DataFrame(columns=names)
+
+        data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        frames = [pd.DataFrame(self._read_chunk(data, entry)) for entry in entries]
+        return pd.concat(frames, ignore_index=True)[names]
+
+    def export(self, path, file=None, variant=None):
+        """ writes (part of) the store to a csv file """
+        self.read(file, variant).to_csv(path, index=False)
+
+
+if __name__ == '__main__':
+    """
+    inspects a store, e.g.
+    python3 corpus_store.py --corpus_dir corpus files
+    python3 corpus_store.py --corpus_dir corpus export all.csv --variant diarized
+    """
+    fire.Fire(CorpusStore)
@@ -1,49 +1,191 @@
+import itertools
+import os
+
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+
+from run_manifest import atomic_write
+
+#caption formats: (header, decimal marker of the timestamps)
+CAPTION_FORMATS = {
+	'vtt': ('WEBVTT\n\n', '.'),
+	'srt': ('', ','),
+}
+
+#segments formatted together when writing a generator of segments
+CHUNK_SIZE = 4096
+
+
+def format_timestamps(seconds, decimal_marker='.'):
+	""" formats times as HH:MM:SS.mmm with integer arithmetic on the whole array.
+	Milliseconds are truncated like the strftime formatting this replaces, hours
+	go past 24 instead of wrapping.
+
+	Parameters
+	-----------
+	seconds : array like of floats
+		times in seconds, negative times are clipped to 0
+	decimal_marker : string, default '.'
+		'.' for WebVTT, ',' for SRT
+
+	Returns
+	-----------
+	timestamps : numpy array of strings
+	"""
+	seconds = np.asarray(seconds, dtype=np.float64).ravel()
+	#round to microseconds first, as timedelta does, so 1.001 is not formatted as 1.000
+	milliseconds = np.maximum(np.round(seconds * 1e6).astype(np.int64), 0) // 1000
+
+	hours, milliseconds = np.divmod(milliseconds, 3600000)
+	minutes, milliseconds = np.divmod(milliseconds, 60000)
+	secs, milliseconds = np.divmod(milliseconds, 1000)
+
+	hour_digits = max(2, len(str(int(hours.max())))) if len(hours) else 2
+	fields = [(hours, hour_digits), (b':', 1), (minutes, 2), (b':', 1), (secs, 2),
+		(decimal_marker.encode(), 1), (milliseconds, 3)]
+	width = hour_digits + 10
+
+	#one row of ascii characters per timestamp
+	chars = np.empty((len(seconds), width), dtype=np.uint8)
+	position = 0
+	for value, digits in fields:
+		if isinstance(value, bytes):
+			chars[:, position] = value[0]
+		else:
+			for i in range(digits):
+				chars[:, position + i] = 48 + (value // 10 ** (digits - 1 - i)) % 10
+		position += digits
+
+	return chars.view('S' + str(width)).ravel().astype(str)
+
+
+def format_cues(starts, ends, texts, speakers=None, caption_format='vtt', first_index=1):
+	""" caption cues for a batch of segments, as one string
+
+	Parameters
+	-----------
+	starts, ends : array like of floats
+		times of the segments in seconds
+	texts : list of strings
+		text of the segments
+	speakers : list of strings, optional
+		speaker labels, added as WebVTT voice tags or as an SRT 'SPEAKER: ' prefix
+	caption_format : string, default 'vtt'
+		'vtt' or 'srt'
+	first_index : int, default 1
+		number of the first cue
+
+	Returns
+	-----------
+	cues : string
+		cues without the file header
+	"""
+	decimal_marker = CAPTION_FORMATS[caption_format][1]
+	start_times = format_timestamps(starts, decimal_marker)
+	end_times = format_timestamps(ends, decimal_marker)
+
+	texts = [str(text) for text in texts]
+	if speakers is not None:
+		if caption_format == 'vtt':
+			texts = ['<v ' + str(speaker) + '>' + text.strip() for speaker, text in zip(speakers, texts)]
+		else:
+			texts = [str(speaker) + ': ' + text.strip() for speaker, text in zip(speakers, texts)]
+
+	return ''.join([str(index) + '\n' + start + ' --> ' + end + '\n' + text + '\n\n'
+		for index, start, end, text in zip(itertools.count(first_index), start_times, end_times, texts)])
+
 
 class CreateClosedCaptions(object):
 	"""
 	"""
-	def __init__(self, filename, segments, outpath):
-		""" Transcribe audio with whisper model
+	def __init__(self, filename, segments, outpath, caption_format=None, speaker_labels=False):
+		""" Write caption files for the transcript of an audio file
 
 		Parameters
 		-----------
 		filename : string
 			name of the file being transcribed
-		segments  : list of dictionaries or pandas df
+		segments  : list of dictionaries, pandas df or iterable of dictionaries
 			created in the transcribe_audio_file method of or diarize_audio_file
-			method in SpeechPipeline class. Text segments of Audio.
+			method in SpeechPipeline class. Text segments of Audio. Segments are
+			not modified.
 		outpath : string
 			path to save vtt file to
+		caption_format : string, optional
+			'vtt' (WebVTT) or 'srt', defaults to the extension of filename, or 'vtt'
+		speaker_labels : boolean, default False
+			if True, label cues with the 'speaker' of diarized segments
 		"""
 
-		if isinstance(segments, pd.DataFrame):
-			self.segments = segments
-		else:
-			self.segments = pd.DataFrame(segments)
+		if caption_format is None:
+			caption_format = 'srt' if filename.lower().endswith('.srt') else 'vtt'
+		if caption_format not in CAPTION_FORMATS:
+			raise ValueError('caption_format must be one of ' + ', '.join(CAPTION_FORMATS) + ', got ' + repr(caption_format))
 
+		self.segments = segments
 		self.outpath = outpath
 		self.filename = filename
+		self.caption_format = caption_format
+		self.speaker_labels = speaker_labels
 
 	# define function to convert seconds to desired format
 	def convert_seconds(self, seconds):
 		"""
 		Parameters
 		-----------
-		seconds : xxx
-			xxx
+		seconds : float
+			time in seconds
 
 		Returns
 		-----------
-		formatte_times : xxx
-			xxx
+		formatted_time : string
+			HH:MM:SS.mmm, with the decimal marker of the caption format
 		"""
+		return str(format_timestamps([seconds], CAPTION_FORMATS[self.caption_format][1])[0])
+
+
+	def _chunks(self, segments):
+		""" yields (starts, ends, texts, speakers) for consecutive batches of segments """
+		if isinstance(segments, pd.DataFrame):
+			speakers = segments['speaker'].tolist() if self.speaker_labels and 'speaker' in segments else None
+			yield segments['start'].to_numpy(), segments['end'].to_numpy(), segments['text'].tolist(), speakers
+			return
 
-		# create timedelta object with total seconds
-		td = timedelta(seconds=seconds)
-		# use strftime method to format timedelta object as desired
-		return (datetime.min + td).strftime('%H:%M:%S.%f')[:-3]
+		iterator = iter(segments)
+		while True:
+			chunk = list(itertools.islice(iterator, CHUNK_SIZE))
+			if not chunk:
+				return
+			speakers = None
+			if self.speaker_labels and all('speaker' in segment for segment in chunk):
+				speakers = [segment['speaker'] for segment in chunk]
+			yield ([segment['start'] for segment in chunk], [segment['end'] for segment in chunk],
+				[segment['text'] for segment in chunk], speakers)
+
+
+	def create_caption_file(self, verbose=False):
+		""" writes all segments to outpath + filename, in one buffered write for
+		lists and data frames and one write per CHUNK_SIZE segments for generators
+
+		Returns
+		----------
+		caption_path: string
+			path of the saved file
+		"""
+
+		caption_path = self.outpath+self.filename
+
+		#written to a temporary file first, a crash never leaves half a caption file
+		with atomic_write(caption_path) as f:
+			f.write(CAPTION_FORMATS[self.caption_format][0])
+			index = 1
+			for starts, ends, texts, speakers in self._chunks(self.segments):
+				f.write(format_cues(starts, ends, texts, speakers, self.caption_format, first_index=index))
+				index += len(texts)
+
+		if verbose:
+			print('#### File saved to ', caption_path, ' ####')
+		return caption_path
 
 
 	def create_vtt_file(self, verbose):
@@ -53,30 +195,54 @@ class CreateClosedCaptions(object):
 		vtt_file: file
 			saved to location of outpath
 		"""
+		self.caption_format = 'vtt'
+		self.create_caption_file(verbose)
+		return
+
+
+	def create_srt_file(self, verbose):
+		"""
+		Returns
+		----------
+		srt_file: file
+			saved to location of outpath
+		"""
+		self.caption_format = 'srt'
+		self.create_caption_file(verbose)
+		return
+
+
+	def stream_caption_file(self, segments, verbose):
+		""" writes a cue for every segment to filename.partial as soon as it arrives, for
+		transcripts that are still being decoded, and renames it to filename at the end.
+		Segments are passed through unchanged.
+
+		Parameters
+		-----------
+		segments : iterable of dictionaries
+			segments from the whisper model, e.g. TranscribeAudio.transcribe_stream
+
+		Yields
+		----------
+		segment : dictionary
+			each segment, after its cue is written to the caption file
+		"""
+
+		caption_path = self.outpath+self.filename
+
+		#cues are appended to a .partial file, renamed when all segments are written
+		with open(caption_path + '.partial', 'w') as f:
+			f.write(CAPTION_FORMATS[self.caption_format][0])
 
-		vtt_path = self.outpath+self.filename
-		# Load the CSV file into a pandas dataframe
-		
-		# Convert the timecode columns to timedelta format
-		self.segments['start_vtt'] = self.segments['start'].apply(self.convert_seconds)
-		self.segments['end_vtt'] = self.segments['end'].apply(self.convert_seconds)
-		
-		# Write the WebVTT file
-		with open(vtt_path, 'w') as f:
-			# Write the WebVTT header
-			f.write('WEBVTT\n\n')
-			
-			# Loop through each row of the dataframe and write the subtitle data
-			for index, row in self.segments.iterrows():
-				# Write the subtitle index
-				f.write(str(index + 1) + '\n')
-				
-				# Write the subtitle timecode
-				f.write(str(row['start_vtt']) + ' --> ' + str(row['end_vtt']) + '\n')
-				
-				# Write the subtitle text
-				f.write(str(row['text']) + '\n\n')
+			for index, segment in enumerate(segments):
+				speakers = [segment['speaker']] if self.speaker_labels and 'speaker' in segment else None
+				f.write(format_cues([segment['start']], [segment['end']], [segment['text']], speakers,
+					self.caption_format, first_index=index + 1))
+				#make the cue visible to readers of the file right away
+				f.flush()
+				yield segment
+		os.replace(caption_path + '.partial', caption_path)
 
 		if verbose:
-			print('#### File saved to ', vtt_path, ' ####')
-		return
\ No newline at end of file
+			print('#### File saved to ', caption_path, ' ####')
+		return
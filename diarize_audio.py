@@ -1,77 +1,60 @@
-import pyannote.audio
-from pyannote.audio import Audio
-from pyannote.core import Segment
-
-import contextlib
-import wave
-
-from sklearn.cluster import AgglomerativeClustering
 import numpy as np
 
+from speaker_embedding import BatchedSpeakerEmbedding
+from speaker_clustering import get_clustering_backend
+
 
 class DiarizeAudio(object):
     """
     """
-    def __init__(self, AudioFile, segments, model=None):
+    def __init__(self, AudioFile, segments, model=None, batch_size=32, clustering='agglomerative'):
         """
 
         AudioFile : AudioFile Object
-          object containing path to audio file, language and number of speakers
+          object holding the decoded audio, language and number of speakers
         segments : list of dictionaries
           created with whisper model 
         model : load speechbrain 'spkrec-ecapa-voxceleb' model with pyannote
           instantiated in SpeechPipeline Class
+        batch_size : int, default 32
+          number of segments embedded together in one forward pass of the model
+        clustering : string, default 'agglomerative'
+          clustering backend, 'agglomerative' (exact), or the memory bounded 'knn' and
+          'two_stage' for files with thousands of segments, see speaker_clustering.py
 
         """
-        self.path = AudioFile.path
         self.audiofile = AudioFile
         self.segments = segments
         self.embedding_model = model
-
-        #check to see if audio file is in wav format, if not convert to wav format
-        if self.audiofile.path[-3:] != 'wav':
-            #update self.path to new wav file
-            self.path = self.audiofile.convert_to_wav()
+        self.batch_size = batch_size
+        self.clustering_backend = get_clustering_backend(clustering)
 
 
-    def _segment_embedding(self, segment):
-      """ get segment embedding from speechbrain speaker diarization model
-
-      Parameters
-      -----------
-      segment : dictionary
-        segment of audio determined by whisper ASR model.
+    def extract_embeddings(self):
+      """ gets the speaker embedding of every segment from the diarization model
 
       Returns
       -----------
-      segment_embedding : xxx
-        
+      embeddings : numpy array
+        (number of segments, 192), NaN rows for segments too short to embed
       """
 
-      #audio processing 
-      with contextlib.closing(wave.open(self.path,'r')) as f:
-        frames = f.getnframes()
-        rate = f.getframerate()
-        duration = frames / float(rate)
+      embeddings = np.zeros(shape=(len(self.segments), 192))
 
-      #create pyannote Audio object
-      audio = Audio()
+      #get segment embeddings from diarization model, in batches of similar duration
+      engine = BatchedSpeakerEmbedding(self.embedding_model, batch_size=self.batch_size)
+      engine(self.audiofile, self.segments, out=embeddings)
+      return embeddings
 
-      #get start time of segment
-      start = segment["start"]
-      # Whisper overshoots the end timestamp in the last segment
-      end = min(duration, segment["end"])
-      #create pyannote segment object
-      clip = Segment(start, end)
-      #crop audio
-      waveform, sample_rate = audio.crop(self.path, clip)
-      #get embedding from model
-      return self.embedding_model(waveform[None])
 
+    def cluster(self, embeddings):
+      """ uses the clustering backend to cluster segment embeddings based on the
+      number of speakers. Assigns speaker label to each segments (utterance).
 
-    def clustering(self):
-      """ gets embedding for each segment. Uses agglomerative clustering to cluster segments 
-      based on the number of speakers. Assigns speaker label to each segments (utterance).
+      Parameters
+      -----------
+      embeddings : numpy array
+        segment embeddings, from extract_embeddings
 
       Returns
       -----------
@@ -79,18 +62,11 @@ class DiarizeAudio(object):
         updates self.segments in class with the speaker label from diarization model
       """
 
-      embeddings = np.zeros(shape=(len(self.segments), 192))
-
-      #get segment embedding from diarization model
-      for i, segment in enumerate(self.segments):
-        embeddings[i] = self._segment_embedding(segment)
-
       #handle nans
       embeddings = np.nan_to_num(embeddings)
 
       #using clustering to determine speaker labels
-      clustering = AgglomerativeClustering(self.audiofile.num_speakers).fit(embeddings)
-      labels = clustering.labels_
+      labels = self.clustering_backend(embeddings, self.audiofile.num_speakers)
 
       #update self.segments with speaker labels
       for i in range(len(self.segments)):
@@ -98,3 +74,15 @@ class DiarizeAudio(object):
 
       return self.segments
 
+
+    def clustering(self):
+      """ gets embedding for each segment. Uses the clustering backend to cluster segments 
+      based on the number of speakers. Assigns speaker label to each segments (utterance).
+
+      Returns
+      -----------
+      self.segments : list of dictionaries
+        updates self.segments in class with the speaker label from diarization model
+      """
+
+      return self.cluster(self.extract_embeddings())
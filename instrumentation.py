@@ -0,0 +1,217 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+#prefix of every metric in the prometheus textfile
+METRIC_PREFIX = 'speech_pipeline'
+
+
+def peak_rss_bytes():
+    """ peak resident memory of this process so far """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    """ resident memory of this process now, None where /proc is not available """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Instrumentation(object):
+    """
+    """
+    def __init__(self, hooks=()):
+        """ measures pipeline stages and passes one record per stage run to every hook.
+
+        A hook is any callable taking the record, a dictionary with the keys
+        'time', 'stage', 'file', 'wall_seconds', 'cpu_seconds', 'audio_seconds',
+        'real_time_factor', 'segments', 'peak_rss_bytes', 'rss_bytes', 'error'
+        and any fields added with annotate. CPU time and memory are those of the
+        whole process, peak_rss_bytes is its high-water mark at the end of the stage.
+
+        Parameters
+        -----------
+        hooks : list of callables
+            collectors called with every record, e.g. JSONLinesHook or PrometheusTextfileHook
+        """
+        self.hooks = list(hooks)
+        #records of the stages running on each thread, innermost last
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        """ attaches another collector, called with every following record """
+        self.hooks.append(hook)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def annotate(self, **fields):
+        """ adds fields (e.g. segments=120 or cached=True) to the record of the innermost
+        stage running on this thread. Does nothing outside a stage.
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].update(fields)
+
+    @contextlib.contextmanager
+    def measure(self, stage, audio_file=None, **fields):
+        """ times the body of the with statement as one run of stage
+
+        Parameters
+        -----------
+        stage : string
+            name of the stage
+        audio_file : AudioFile object, optional
+            audio the stage runs on, gives the file name and (if it is loaded) the duration
+        fields : keyword arguments
+            added to the record
+
+        Yields
+        -----------
+        record : dictionary
+            filled in when the stage ends, fields set on it are kept
+        """
+        record = {'stage': stage, 'file': getattr(audio_file, 'path', None), 'segments': None, 'error': None}
+        record.update(fields)
+
+        stack = self._stack()
+        stack.append(record)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__ + ': ' + str(e)
+            raise
+        finally:
+            record['wall_seconds'] = time.perf_counter() - wall
+            record['cpu_seconds'] = time.process_time() - cpu
+            stack.pop()
+
+            #only use the duration if it is known, asking for it would decode the file
+            duration = audio_file.loaded_duration() if audio_file is not None else None
+            record['audio_seconds'] = duration
+            record['real_time_factor'] = record['wall_seconds'] / duration if duration else None
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            record['rss_bytes'] = current_rss_bytes()
+            record['time'] = time.time()
+            self.emit(record)
+
+    def emit(self, record):
+        """ passes record to every hook. A failing hook warns instead of failing the stage. """
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                warnings.warn('metrics hook ' + repr(hook) + ' failed: ' + repr(e))
+
+
+class JSONLinesHook(object):
+    """
+    """
+    def __init__(self, path):
+        """ appends every record to a file as one line of json. Lines are written with a
+        single append, so several processes can share the file.
+
+        Parameters
+        -----------
+        path : string
+            path of the metrics file
+        """
+        self.path = path
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with open(self.path, 'a') as f:
+            f.write(line)
+
+
+class PrometheusTextfileHook(object):
+    """
+    """
+    def __init__(self, path, prefix=METRIC_PREFIX):
+        """ keeps per stage totals and rewrites them to a file in the Prometheus text
+        format after every record, for the node_exporter textfile collector.
+        The file is replaced atomically, the collector never reads half a file.
+
+        Parameters
+        -----------
+        path : string
+            path of the .prom file
+        prefix : string, default 'speech_pipeline'
+            prefix of the metric names
+        """
+        self.path = path
+        self.prefix = prefix
+        self.totals = {}
+        self.last_real_time_factor = {}
+        self.peak_rss = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.totals.setdefault(record['stage'], {'runs': 0, 'errors': 0, 'wall_seconds': 0.0,
+                'cpu_seconds': 0.0, 'audio_seconds': 0.0, 'segments': 0})
+            totals['runs'] += 1
+            totals['errors'] += record['error'] is not None
+            totals['wall_seconds'] += record['wall_seconds']
+            totals['cpu_seconds'] += record['cpu_seconds']
+            totals['audio_seconds'] += record['audio_seconds'] or 0.0
+            totals['segments'] += record['segments'] or 0
+            if record['real_time_factor'] is not None:
+                self.last_real_time_factor[record['stage']] = record['real_time_factor']
+            self.peak_rss = max(self.peak_rss, record['peak_rss_bytes'])
+            self.write()
+
+    def format(self):
+        """ the metrics in the Prometheus text format """
+        counters = [
+            ('stage_runs_total', 'runs', 'Number of runs of the stage.'),
+            ('stage_errors_total', 'errors', 'Number of runs of the stage that raised an error.'),
+            ('stage_seconds_total', 'wall_seconds', 'Wall time spent in the stage.'),
+            ('stage_cpu_seconds_total', 'cpu_seconds', 'Process CPU time spent in the stage.'),
+            ('stage_audio_seconds_total', 'audio_seconds', 'Seconds of audio processed by the stage.'),
+            ('stage_segments_total', 'segments', 'Segments produced by the stage.'),
+        ]
+        lines = []
+        for name, key, description in counters:
+            lines.append('# HELP {}_{} {}'.format(self.prefix, name, description))
+            lines.append('# TYPE {}_{} counter'.format(self.prefix, name))
+            for stage, totals in sorted(self.totals.items()):
+                lines.append('{}_{}{{stage="{}"}} {}'.format(self.prefix, name, stage, totals[key]))
+
+        lines.append('# HELP {}_stage_real_time_factor Wall time over audio duration of the last run of the stage.'.format(self.prefix))
+        lines.append('# TYPE {}_stage_real_time_factor gauge'.format(self.prefix))
+        for stage, value in sorted(self.last_real_time_factor.items()):
+            lines.append('{}_stage_real_time_factor{{stage="{}"}} {}'.format(self.prefix, stage, value))
+
+        lines.append('# HELP {}_peak_rss_bytes Peak resident memory of the process.'.format(self.prefix))
+        lines.append('# TYPE {}_peak_rss_bytes gauge'.format(self.prefix))
+        lines.append('{}_peak_rss_bytes {}'.format(self.prefix, self.peak_rss))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """ replaces the file with the current metrics """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.format())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,331 @@
+import bisect
+import os
+import queue
+import sys
+import threading
+import time
+
+import fire
+import numpy as np
+
+from create_closed_captions import CAPTION_FORMATS, CreateClosedCaptions, format_cues
+from main import WHISPER_MODEL_SIZES, WHISPER_PRECISIONS, SpeechPipeline
+from parallel_pipeline import set_num_threads
+
+#the input is raw 16 kHz signed 16 bit little endian pcm, e.g. ffmpeg ... -f s16le -ac 1 -ar 16000 -
+SAMPLE_RATE = 16000
+
+#seconds of audio read from the input at a time
+CHUNK_SECONDS = 0.1
+
+#characters of finalised text passed as the prompt of the next decode
+PROMPT_CHARACTERS = 200
+
+
+def read_pcm(stream, chunks, channels=1, chunk_seconds=CHUNK_SECONDS):
+    """ reads s16le audio from a binary stream until it ends and puts (arrival time,
+    samples) on the chunks queue, then None. Runs on its own thread, so audio keeps
+    being read (and timestamped on arrival) while the model decodes.
+
+    Parameters
+    -----------
+    stream : binary file
+        e.g. sys.stdin.buffer or an open FIFO
+    chunks : queue.Queue
+        receives (time.perf_counter() at arrival, float32 mono samples)
+    channels : int, default 1
+        interleaved channels of the input, averaged to mono
+    chunk_seconds : float
+        seconds of audio read at a time
+    """
+    frame_bytes = 2 * channels
+    size = int(chunk_seconds * SAMPLE_RATE) * frame_bytes
+    #read1 returns what the pipe has instead of waiting for a full chunk
+    read = getattr(stream, 'read1', stream.read)
+    leftover = b''
+    try:
+        while True:
+            data = read(size)
+            if not data:
+                break
+            data = leftover + data
+            #keep a partial frame for the next read
+            usable = len(data) - len(data) % frame_bytes
+            data, leftover = data[:usable], data[usable:]
+            if not data:
+                continue
+            samples = np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1)
+            chunks.put((time.perf_counter(), samples))
+    finally:
+        chunks.put(None)
+
+
+def latency_percentiles(latencies, percentiles=(50, 90, 99)):
+    """ percentiles, mean and max of latencies in seconds, rounded to milliseconds """
+    if len(latencies) == 0:
+        return {'count': 0}
+    latencies = np.asarray(latencies, dtype=np.float64)
+    report = {'count': len(latencies)}
+    for percentile, value in zip(percentiles, np.percentile(latencies, percentiles)):
+        report['p' + str(percentile)] = round(float(value), 3)
+    report['mean'] = round(float(latencies.mean()), 3)
+    report['max'] = round(float(latencies.max()), 3)
+    return report
+
+
+class LiveTranscriber(object):
+    """
+    """
+    def __init__(self, language=None, model_size='base', use_gpu=False, precision='fp32', num_threads=None,
+        step=1.0, stable_margin=1.0, max_buffer=20.0, channels=1, caption_format='vtt', verbose=True):
+        """ transcribes a live audio stream, e.g. a hearing relayed with
+        `ffmpeg -i rtmp://... -f s16le -ac 1 -ar 16000 - | python3 live_transcription.py run`.
+
+        New audio is appended to a rolling buffer and the whole buffer is decoded again
+        every step seconds, so each decode overlaps the previous ones. Segments that are
+        followed by another segment and end at least stable_margin seconds before the
+        newest audio are final: their cues are written and their audio is dropped from
+        the buffer. The rest is partial, shown but decoded again with more context on
+        the next step. A buffer longer than max_buffer is finalised anyway, whisper
+        sees at most 30 seconds.
+
+        If decoding is slower than step, the audio that arrived meanwhile is decoded
+        together on the next step, so the transcript falls behind by at most one decode.
+
+        Parameters
+        -----------
+        language : string, optional
+            language code, detected from the first decoded speech if None
+        model_size : string, default 'base'
+            one of WHISPER_MODEL_SIZES, smaller models have lower latency
+        use_gpu : boolean, default False
+            loads the model onto the gpu if available
+        precision : string, default 'fp32'
+            'fp32' or 'int8' (cpu only)
+        num_threads : int, optional
+            torch threads, defaults to all cores
+        step : float, default 1.0
+            seconds of new audio between two decodes
+        stable_margin : float, default 1.0
+            seconds between the end of a segment and the newest audio before it is final
+        max_buffer : float, default 20.0
+            seconds of audio after which the buffer is finalised, below 30
+        channels : int, default 1
+            interleaved channels of the input pcm
+        caption_format : string, default 'vtt'
+            'vtt' or 'srt'
+        verbose : boolean, default True
+            shows partial segments and the latency report on stderr
+        """
+        if model_size not in WHISPER_MODEL_SIZES:
+            raise ValueError('model_size must be one of ' + ', '.join(WHISPER_MODEL_SIZES) + ', got ' + repr(model_size))
+        if precision not in WHISPER_PRECISIONS:
+            raise ValueError('precision must be one of ' + ', '.join(WHISPER_PRECISIONS) + ', got ' + repr(precision))
+        if caption_format not in CAPTION_FORMATS:
+            raise ValueError('caption_format must be one of ' + ', '.join(CAPTION_FORMATS) + ', got ' + repr(caption_format))
+        if not 0 < step < max_buffer <= 30:
+            raise ValueError('step and max_buffer must satisfy 0 < step < max_buffer <= 30, got ' + repr((step, max_buffer)))
+
+        self.language = language
+        self.model_size = model_size
+        self.use_gpu = use_gpu
+        self.precision = precision
+        self.num_threads = num_threads
+        self.step = step
+        self.stable_margin = stable_margin
+        self.max_buffer = max_buffer
+        self.channels = channels
+        self.caption_format = caption_format
+        self.verbose = verbose
+        self._whisper_model = None
+
+    @property
+    def whisper_model(self):
+        #loaded on first use, like the models of SpeechPipeline
+        if self._whisper_model is None:
+            if self.num_threads is not None:
+                set_num_threads(self.num_threads)
+            self._whisper_model = SpeechPipeline.load_whisper_model(self.model_size, self.use_gpu, self.precision)
+        return self._whisper_model
+
+    @whisper_model.setter
+    def whisper_model(self, model):
+        self._whisper_model = model
+
+    def decode(self, buffer, prompt):
+        """ whisper segments of the buffer, with times relative to its start """
+        model = self.whisper_model
+        device = getattr(model, 'device', None)
+        result = model.transcribe(buffer, language=self.language, initial_prompt=prompt or None,
+            condition_on_previous_text=False, fp16=device is not None and device.type != 'cpu')
+        if self.language is None and result['segments']:
+            #fixed after the first speech, so the language does not flip between decodes
+            self.language = result.get('language')
+        return result['segments']
+
+    def transcribe(self, stream):
+        """ transcribes the audio of stream until it ends
+
+        Parameters
+        -----------
+        stream : binary file
+            s16le pcm at 16 kHz
+
+        Yields
+        -----------
+        final : boolean
+            True for final segments, False for partial ones
+        segment : dictionary
+            whisper segment with times on the timeline of the stream. Final segments
+            get consecutive ids, and a 'latency' in seconds from the arrival of their
+            last sample until they are yielded
+        """
+        chunks = queue.Queue()
+        reader = threading.Thread(target=read_pcm, args=(stream, chunks, self.channels), name='pcm-reader', daemon=True)
+        reader.start()
+
+        #start of the buffer on the timeline of the stream, and the samples after it
+        buffer_offset = 0.0
+        buffer = np.zeros(0, dtype=np.float32)
+        #stream time at the end of every chunk in the buffer, and when it arrived
+        chunk_ends, chunk_arrivals = [], []
+        segment_id = 0
+        prompt = ''
+        ended = False
+
+        while not ended:
+            #wait for step seconds of new audio, then take everything that arrived meanwhile
+            new = []
+            new_samples = 0
+            while not ended and (new_samples < self.step * SAMPLE_RATE or not chunks.empty()):
+                chunk = chunks.get()
+                if chunk is None:
+                    ended = True
+                    break
+                new.append(chunk)
+                new_samples += len(chunk[1])
+            if new:
+                buffer_end = buffer_offset + len(buffer) / SAMPLE_RATE
+                for arrival, samples in new:
+                    buffer_end += len(samples) / SAMPLE_RATE
+                    chunk_ends.append(buffer_end)
+                    chunk_arrivals.append(arrival)
+                buffer = np.concatenate([buffer] + [samples for _, samples in new])
+            if not len(buffer):
+                continue
+
+            duration = len(buffer) / SAMPLE_RATE
+            segments = []
+            for segment in self.decode(buffer, prompt[-PROMPT_CHARACTERS:]):
+                segment = dict(segment)
+                segment['start'] = buffer_offset + min(segment['start'], duration)
+                segment['end'] = buffer_offset + min(segment['end'], duration)
+                segments.append(segment)
+            buffer_end = buffer_offset + duration
+
+            #every segment but the last, if it ended long enough ago
+            num_final = 0
+            while num_final < len(segments) - 1 and segments[num_final]['end'] <= buffer_end - self.stable_margin:
+                num_final += 1
+            if ended:
+                num_final = len(segments)
+            elif duration > self.max_buffer:
+                num_final = max(num_final, len(segments) - 1)
+                committed = segments[num_final - 1]['end'] if num_final else buffer_offset
+                if buffer_end - committed > self.max_buffer:
+                    num_final = len(segments)
+
+            now = time.perf_counter()
+            for segment in segments[:num_final]:
+                #arrival of the chunk holding the last sample of the segment
+                index = min(bisect.bisect_left(chunk_ends, segment['end'] - 1e-6), len(chunk_ends) - 1)
+                segment['id'] = segment_id
+                segment['latency'] = now - chunk_arrivals[index]
+                segment_id += 1
+                prompt += segment['text']
+                yield True, segment
+            for segment in segments[num_final:]:
+                segment['latency'] = now - chunk_arrivals[-1]
+                yield False, segment
+
+            #drop the audio of final segments, or of silence except its end, where speech may start
+            if num_final:
+                committed = segments[num_final - 1]['end']
+            elif not segments:
+                committed = max(buffer_offset, buffer_end - self.stable_margin)
+            else:
+                committed = buffer_offset
+            if committed > buffer_offset:
+                buffer = buffer[int(round((committed - buffer_offset) * SAMPLE_RATE)):]
+                buffer_offset = committed
+                first = bisect.bisect_right(chunk_ends, buffer_offset)
+                #keep one chunk, the arrival of the newest audio is still needed
+                first = min(first, len(chunk_ends) - 1)
+                del chunk_ends[:first], chunk_arrivals[:first]
+        reader.join()
+
+    def run(self, source='-', caption_path=None):
+        """ transcribes the pcm audio of source and writes a cue for every final segment,
+        to stdout or to caption_path. A latency report is printed to stderr at the end
+        and kept in self.report.
+
+        Parameters
+        -----------
+        source : string, default '-'
+            path of a file or FIFO with the pcm audio, '-' for stdin
+        caption_path : string, optional
+            caption file, written to caption_path + '.partial' as cues are final and
+            renamed when the stream ends. Cues go to stdout if not given.
+        """
+        stream = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        latencies = {'final': [], 'partial': []}
+        start = time.perf_counter()
+
+        def final_segments():
+            for final, segment in self.transcribe(stream):
+                latencies['final' if final else 'partial'].append(segment['latency'])
+                if final:
+                    yield segment
+                elif self.verbose:
+                    #the partial text is replaced by the next one on the same line
+                    sys.stderr.write('\r\033[K~ ' + segment['text'].strip()[-120:])
+                    sys.stderr.flush()
+
+        try:
+            if caption_path is not None:
+                captions = CreateClosedCaptions(os.path.basename(caption_path), None,
+                    os.path.join(os.path.dirname(caption_path), ''), caption_format=self.caption_format)
+                for segment in captions.stream_caption_file(final_segments(), verbose=False):
+                    if self.verbose:
+                        sys.stderr.write('\r\033[K' + segment['text'].strip() + '\n')
+            else:
+                sys.stdout.write(CAPTION_FORMATS[self.caption_format][0])
+                for segment in final_segments():
+                    sys.stdout.write(format_cues([segment['start']], [segment['end']], [segment['text']],
+                        caption_format=self.caption_format, first_index=segment['id'] + 1))
+                    sys.stdout.flush()
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+        self.report = {
+            'seconds': round(time.perf_counter() - start, 3),
+            'final_latency': latency_percentiles(latencies['final']),
+            'partial_latency': latency_percentiles(latencies['partial']),
+        }
+        if self.verbose:
+            sys.stderr.write('\r\033[K#### Latency, audio in to caption out: ' + str(self.report['final_latency']) + ' ####\n')
+            sys.stderr.write('#### Latency of partial segments: ' + str(self.report['partial_latency']) + ' ####\n')
+        #not returned, fire would print it after the cues on stdout
+        return
+
+
+if __name__ == '__main__':
+    """
+    captions a live stream, e.g.
+    ffmpeg -i rtmp://host/live/hearing -f s16le -ac 1 -ar 16000 - | python3 live_transcription.py --language en run
+    python3 live_transcription.py --model_size small run --source /tmp/hearing.pcm --caption_path out/hearing.vtt
+    """
+    fire.Fire(LiveTranscriber)
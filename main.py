@@ -1,24 +1,47 @@
+import contextlib
+import functools
 import os
 
-import whisper
-#import whisperx
+import fire 
 
-from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
+#heavy libraries (torch, whisper, whisperx, pyannote, pandas, sklearn) are imported
+#by the stages that use them, so the CLI starts fast and --help needs none of them
+from transcribe_audio import TranscribeAudio, WINDOW_SECONDS
+from preprocess_audio import AudioFile, SpeechAudioFile, detect_speech
+from parallel_pipeline import run_parallel, set_num_threads
+from result_cache import ResultCache, parse_size
+from model_pool import ModelPool
+from speaker_clustering import CLUSTERING_BACKENDS
+from instrumentation import Instrumentation, JSONLinesHook, PrometheusTextfileHook
+from run_manifest import RunManifest, atomic_write, options_digest, STARTED, DONE, FAILED
 
-import torch
-import fire 
+#whisper checkpoints that can be selected with model_size
+WHISPER_MODEL_SIZES = ('tiny', 'tiny.en', 'base', 'base.en', 'small', 'small.en', 'medium', 'medium.en',
+	'large-v1', 'large-v2', 'large-v3', 'large')
+
+#weights of the whisper model, int8 quantizes the linear layers for cpu inference
+WHISPER_PRECISIONS = ('fp32', 'int8')
 
-import pandas as pd
+#speechbrain model used for speaker embeddings
+DIARIZATION_MODEL = "speechbrain/spkrec-ecapa-voxceleb"
 
-from transcribe_audio import TranscribeAudio
-from diarize_audio import DiarizeAudio
-from preprocess_audio import AudioFile
-#from word_align_audio import WordAlignAudio
-from create_closed_captions import CreateClosedCaptions
+#how the speaker embedding model runs: the pyannote wrapper as loaded, or traced with
+#torch.jit in float32 or with int8 linear layers (cpu only), see speaker_embedding.py
+EMBEDDING_BACKENDS = ('pyannote', 'traced', 'traced_int8')
+
+#where traced speaker embedding models are saved and reloaded from
+TRACED_EMBEDDING_DIR = os.path.join('.cache', 'speaker_embedding')
+
+#arguments that change how a run is executed but not its outputs, ignored when resuming
+RUN_ARGUMENTS = ['path', 'workers', 'pipelined', 'queue_size', 'server', 'cache_dir', 'cache_size', 'wav_dir',
+	'metrics_path', 'prometheus_path', 'manifest_path', 'resume', 'num_threads', 'alignment_pool_size', 'queue_dir', 'lease_seconds', 'verbose']
 
 class SpeechPipeline(object):
 
-	def __init__(self, path, num_speakers, language, outpath='', use_diarize=False, use_translate=False, use_word_alignment=False, create_captions=False, use_gpu=False, verbose=True):
+	#word alignment models by (language, use_gpu), shared by the pipelines of this process
+	alignment_models = ModelPool()
+
+	def __init__(self, path, num_speakers, language=None, outpath='', use_diarize=False, use_translate=False, use_word_alignment=False, create_captions=False, caption_format='vtt', caption_speakers=False, use_gpu=False, model_size='base', precision='fp32', num_threads=None, clip_batch_size=None, embedding_batch_size=32, embedding_backend='pyannote', embedding_window=None, vad=False, use_mmap=False, wav_dir=None, workers=1, stream_window=None, cache_dir=None, cache_size='10GB', alignment_pool_size=None, clustering='agglomerative', server=None, pipelined=False, queue_size=2, metrics_path=None, prometheus_path=None, corpus_dir=None, manifest_path=None, resume=False, queue_dir=None, lease_seconds=600, verbose=True):
 		"""
 		Parameters
 		------------
@@ -26,8 +49,10 @@ class SpeechPipeline(object):
 			path to directory of audiofiles or single audio file
 		num_speakers : int
 			number of speakers in the audio file
-		language : string
-			language of the audio file
+		language : string, optional
+			language code of the audio, e.g. en. If not given, whisper detects the language of
+			every file once, from its first 30 seconds, and transcription, translation and word
+			alignment of the file use it.
 		outpath : string
 			path to where the transcript and diarization csv will be saved.
 		use_diarize : boolean, default False
@@ -38,8 +63,90 @@ class SpeechPipeline(object):
 			if True, will produce word aligment rather than segment alignment
 		create_captions : boolean, default False
 			if True, will produce a vtt file with captions for video.
+		caption_format : string, default 'vtt'
+			format of the captions, 'vtt' (WebVTT) or 'srt'
+		caption_speakers : boolean, default False
+			if True, captions of diarized audio are labeled with the speaker
 		use_gpu : boolean, default False
 			`if true, then will check if there is a gpu and run computation there
+		model_size : string, default 'base'
+			whisper model, one of WHISPER_MODEL_SIZES. Larger models are more accurate and slower.
+		precision : string, default 'fp32'
+			'fp32', or 'int8' to run whisper with int8 dynamic quantized linear layers on the cpu,
+			several times smaller and usually faster at a small cost in accuracy
+		num_threads : int, optional
+			number of torch threads used by every model call. Defaults to all cores, or an
+			even split of the cores between workers.
+		clip_batch_size : int, optional
+			if set, files of up to 30 seconds are transcribed together, this many at a time,
+			with one whisper encoder and decoder pass per batch instead of one per file
+		embedding_batch_size : int, default 32
+			number of segments embedded together by the diarization model
+		embedding_backend : string, default 'pyannote'
+			one of EMBEDDING_BACKENDS. 'traced' runs the speaker embedding network traced with
+			torch.jit (saved to .cache/speaker_embedding and reused), 'traced_int8' also quantizes
+			it to int8 on the cpu. Falls back to 'pyannote' with a warning if the embeddings of
+			a probe batch are not within cosine similarity 0.98 of the original model.
+		embedding_window : float, optional
+			if set, speaker embeddings are computed once per file on windows of this many seconds,
+			overlapping by half, and every segment takes the mean of the windows centred in it.
+			Diarizing the translated segments then needs no second pass of the model.
+		vad : boolean, default False
+			if True, speech regions are found from frame energy and zero crossings first, and
+			transcription, alignment and diarization run on the speech only, with timestamps
+			mapped back to the original file. Can not be combined with stream_window.
+		use_mmap : boolean, default False
+			if True, audio is memory mapped from a 16 kHz wav instead of decoded into memory,
+			so long recordings are never fully loaded by diarization and alignment
+		wav_dir : string, optional
+			directory for the temporary wav files used by use_mmap, defaults to the system temp directory
+		workers : int, default 1
+			number of worker processes used when path is a directory. Every worker loads
+			its own copy of the models and the cpu threads are split between them.
+		stream_window : float, optional
+			if set, audio is transcribed in windows of this many seconds and the transcript
+			csv (and vtt) is appended to as segments are decoded, so memory does not grow with
+			the file length. Other stages run once transcription is finished.
+		cache_dir : string, optional
+			if set, segments, embeddings and aligned words are cached in this directory, keyed
+			by the audio content and the stage options, and reused when the pipeline is rerun
+		cache_size : int or string, default '10GB'
+			size limit of the cache, least recently used results are removed beyond it
+		alignment_pool_size : int or string, optional
+			memory limit of the word alignment models kept loaded (one per language), least
+			recently used models are dropped beyond it. Defaults to the current limit, 4GB.
+		clustering : string, default 'agglomerative'
+			speaker clustering backend. 'agglomerative' is exact but quadratic in the number of
+			segments, 'knn' and 'two_stage' keep memory bounded on multi-hour files
+		server : string, optional
+			path to the unix socket of a running model_server.py. If set, the job is sent to
+			the server, which keeps the models loaded, and its results are streamed back.
+		pipelined : boolean, default False
+			if True, a directory is processed with decoding, model stages and output writing
+			running on separate threads, so they overlap between consecutive files
+		queue_size : int, default 2
+			number of files waiting between two pipelined stages
+		metrics_path : string, optional
+			if set, wall and cpu time, real time factor, memory and segment counts of every
+			stage, ffmpeg call and model load are appended to this file as json lines
+		prometheus_path : string, optional
+			if set, per stage totals are written to this file in the Prometheus text format,
+			for the node_exporter textfile collector
+		corpus_dir : string, optional
+			if set, transcripts of every file and variant are appended to one columnar
+			store in this directory (see corpus_store.py) instead of separate csv files
+		manifest_path : string, optional
+			if set, the content hash, options and state of every file and stage are appended to
+			this file as json lines. Defaults to outpath + 'run_manifest.jsonl' with resume.
+		resume : boolean, default False
+			if True, files the manifest records as done with the same content and options are
+			skipped, failed and partly processed files are run again
+		queue_dir : string, optional
+			if set, a directory is processed through a work queue in this directory (see
+			work_queue.py), shared by several pipelines on one or more machines: each file is
+			claimed by one of them, and files of a pipeline that died are taken over by another
+		lease_seconds : float, default 600
+			seconds without a heartbeat after which the claim of a file expires
 		verbose : boolean, default True
 			prints updates to console about audio progress
 
@@ -53,13 +160,44 @@ class SpeechPipeline(object):
 		self.use_translate : boolean
 		self.use_word_alignment : boolean
 		self.create_captions : boolean
+		self.caption_format : string
+		self.caption_speakers : boolean
+		self.embedding_batch_size : int
+		self.embedding_backend : string
+		self.model_size : string
+		self.precision : string
+		self.num_threads : int
+		self.clip_batch_size : int
+		self.embedding_window : float
+		self.vad : boolean
+		self.use_mmap : boolean
+		self.wav_dir : string
+		self.workers : int
+		self.stream_window : float
+		self.cache : ResultCache
+		self.clustering : string
+		self.server : string
+		self.pipelined : boolean
+		self.queue_size : int
+		self.instrumentation : Instrumentation
+		self.corpus : CorpusStore
+		self.manifest : RunManifest
+		self.resume : boolean
+		self.queue_dir : string
+		self.lease_seconds : float
 		self.verbose : boolean
 		self.device : string
 		self.whisper_model
-		self.alignment_model
-		self.metadata
 		self.diarization_model
 		"""
+		#check the arguments before any model or file work
+		SpeechPipeline.validate_arguments(path, num_speakers, language, outpath, workers=workers,
+			stream_window=stream_window, clustering=clustering, embedding_batch_size=embedding_batch_size,
+			caption_format=caption_format, model_size=model_size, precision=precision, use_gpu=use_gpu,
+			num_threads=num_threads, embedding_backend=embedding_backend, embedding_window=embedding_window, vad=vad,
+			pipelined=pipelined, queue_dir=queue_dir, lease_seconds=lease_seconds, clip_batch_size=clip_batch_size,
+			use_translate=use_translate)
+
 		self.path = path
 		self.num_speakers = num_speakers
 		self.language = language
@@ -73,105 +211,430 @@ class SpeechPipeline(object):
 		self.use_translate = use_translate
 		self.use_word_alignment = use_word_alignment
 		self.create_captions = create_captions
+		self.caption_format = caption_format
+		self.caption_speakers = caption_speakers
+		self.embedding_batch_size = embedding_batch_size
+		self.embedding_backend = embedding_backend
+		self.embedding_window = embedding_window
+		self.vad = vad
+		self.use_mmap = use_mmap
+		self.wav_dir = wav_dir
+		self.workers = workers
+		self.stream_window = stream_window
+		self.clustering = clustering
+		self.server = server
+		self.pipelined = pipelined
+		self.queue_size = queue_size
+		self.queue_dir = queue_dir
+		self.lease_seconds = lease_seconds
 		self.verbose = verbose
+		self.model_size = model_size
+		self.precision = precision
+		self.num_threads = num_threads
+		self.clip_batch_size = clip_batch_size
+		self._threads_set = False
+
+		#own collectors can be attached with self.instrumentation.add_hook
+		self.instrumentation = Instrumentation()
+		if metrics_path is not None:
+			self.instrumentation.add_hook(JSONLinesHook(metrics_path))
+		if prometheus_path is not None:
+			self.instrumentation.add_hook(PrometheusTextfileHook(prometheus_path))
+
+		if corpus_dir is not None:
+			from corpus_store import CorpusStore
+			self.corpus = CorpusStore(corpus_dir)
+		else:
+			self.corpus = None
+
+		self.resume = resume
+		if resume and manifest_path is None:
+			manifest_path = outpath + 'run_manifest.jsonl'
+		if manifest_path is not None:
+			self.manifest = RunManifest(manifest_path)
+			#every instrumented stage of an input file is recorded too
+			self.instrumentation.add_hook(self.manifest.stage_hook)
+		else:
+			self.manifest = None
 
-		if use_gpu:
-			self.device = "cuda" if torch.cuda.is_available() else "cpu"
-			#DECVICE = 'cpu'
+		if alignment_pool_size is not None:
+			SpeechPipeline.alignment_models.max_size = parse_size(alignment_pool_size)
+			SpeechPipeline.alignment_models.evict()
+
+		if cache_dir is not None:
+			self.cache = ResultCache(cache_dir, max_size=cache_size)
 		else:
-			self.device = 'cpu'
+			self.cache = None
+
+		#arguments to recreate this pipeline in a worker process
+		self._worker_kwargs = dict(path=path, num_speakers=num_speakers, language=language, outpath=outpath,
+			use_diarize=use_diarize, use_translate=use_translate, use_word_alignment=use_word_alignment,
+			create_captions=create_captions, caption_format=caption_format, caption_speakers=caption_speakers, use_gpu=use_gpu,
+			model_size=model_size, precision=precision, num_threads=num_threads, clip_batch_size=clip_batch_size,
+			embedding_batch_size=embedding_batch_size, embedding_backend=embedding_backend, embedding_window=embedding_window,
+			vad=vad, use_mmap=use_mmap, wav_dir=wav_dir, workers=1, stream_window=stream_window,
+			cache_dir=cache_dir, cache_size=cache_size, alignment_pool_size=alignment_pool_size, clustering=clustering,
+			pipelined=pipelined, queue_size=queue_size, metrics_path=metrics_path,
+			prometheus_path=prometheus_path, corpus_dir=corpus_dir, manifest_path=manifest_path, resume=resume,
+			queue_dir=queue_dir, lease_seconds=lease_seconds, verbose=verbose)
+		#digest of the options the outputs depend on, a resumed run only skips files done with the same
+		self.options_digest = options_digest({name: value for name, value in self._worker_kwargs.items()
+			if name not in RUN_ARGUMENTS})
+
+		self.use_gpu = use_gpu
+		self._device = None
+
+		#models are loaded on first use, see the properties below
+		self._whisper_model = None
+		self._diarization_model = None
+		#(audio file, window embeddings) of the file being diarized, see window_embeddings
+		self._window_embeddings = None
+		#segments of clips transcribed in a batch by content hash, see transcribe_clips
+		self._batched_transcripts = {}
+
+		#held while a model runs, model_server.py shares one lock between concurrent jobs
+		self.model_lock = contextlib.nullcontext()
+		#called with (path, segments) for every saved output, used by model_server.py
+		self.on_output = None
+
+
+	@staticmethod
+	def validate_arguments(path, num_speakers, language, outpath='', workers=1, stream_window=None,
+		clustering='agglomerative', embedding_batch_size=32, caption_format='vtt', model_size='base',
+		precision='fp32', use_gpu=False, num_threads=None, embedding_backend='pyannote', embedding_window=None, vad=False,
+		pipelined=False, queue_dir=None, lease_seconds=600, clip_batch_size=None, use_translate=False):
+		""" checks the command line arguments, raises an error for the first invalid one.
+		Parameters are the same as for SpeechPipeline.
+		"""
+		if not os.path.exists(path):
+			raise FileNotFoundError('path does not exist: ' + str(path))
+		if isinstance(num_speakers, bool) or not isinstance(num_speakers, int) or num_speakers < 1:
+			raise ValueError('num_speakers must be a positive integer, got ' + repr(num_speakers))
+		if language is not None and (not isinstance(language, str) or not language):
+			raise ValueError('language must be a language code such as en, got ' + repr(language))
+		if outpath and os.path.dirname(outpath) and not os.path.isdir(os.path.dirname(outpath)):
+			raise FileNotFoundError('output directory does not exist: ' + os.path.dirname(outpath))
+		if not isinstance(workers, int) or workers < 1:
+			raise ValueError('workers must be a positive integer, got ' + repr(workers))
+		if stream_window is not None and not stream_window > 0:
+			raise ValueError('stream_window must be a positive number of seconds, got ' + repr(stream_window))
+		if clustering not in CLUSTERING_BACKENDS:
+			raise ValueError('clustering must be one of ' + ', '.join(CLUSTERING_BACKENDS) + ', got ' + repr(clustering))
+		if not isinstance(embedding_batch_size, int) or embedding_batch_size < 1:
+			raise ValueError('embedding_batch_size must be a positive integer, got ' + repr(embedding_batch_size))
+		if caption_format not in ['vtt', 'srt']:
+			raise ValueError('caption_format must be vtt or srt, got ' + repr(caption_format))
+		if model_size not in WHISPER_MODEL_SIZES:
+			raise ValueError('model_size must be one of ' + ', '.join(WHISPER_MODEL_SIZES) + ', got ' + repr(model_size))
+		if precision not in WHISPER_PRECISIONS:
+			raise ValueError('precision must be one of ' + ', '.join(WHISPER_PRECISIONS) + ', got ' + repr(precision))
+		if precision == 'int8' and use_gpu:
+			raise ValueError('precision int8 runs on the cpu only, use it without use_gpu')
+		if embedding_backend not in EMBEDDING_BACKENDS:
+			raise ValueError('embedding_backend must be one of ' + ', '.join(EMBEDDING_BACKENDS) + ', got ' + repr(embedding_backend))
+		if embedding_backend == 'traced_int8' and use_gpu:
+			raise ValueError('embedding_backend traced_int8 runs on the cpu only, use it without use_gpu')
+		if embedding_window is not None and not embedding_window > 0:
+			raise ValueError('embedding_window must be a positive number of seconds, got ' + repr(embedding_window))
+		if vad and stream_window is not None:
+			raise ValueError('vad needs the whole file before transcription, it can not be combined with stream_window')
+		if queue_dir is not None and (workers > 1 or pipelined):
+			raise ValueError('queue_dir can not be combined with workers or pipelined, run several pipelines on the same queue_dir instead')
+		if not isinstance(lease_seconds, (int, float)) or lease_seconds <= 0:
+			raise ValueError('lease_seconds must be a positive number of seconds, got ' + repr(lease_seconds))
+		if num_threads is not None and (not isinstance(num_threads, int) or num_threads < 1):
+			raise ValueError('num_threads must be a positive integer, got ' + repr(num_threads))
+		if clip_batch_size is not None:
+			if isinstance(clip_batch_size, bool) or not isinstance(clip_batch_size, int) or clip_batch_size < 1:
+				raise ValueError('clip_batch_size must be a positive integer, got ' + repr(clip_batch_size))
+			if stream_window is not None or use_translate:
+				raise ValueError('clip_batch_size batches transcription only, it can not be combined with stream_window or use_translate')
+			if workers > 1 or pipelined or queue_dir is not None:
+				raise ValueError('clip_batch_size batches the files of one process, it can not be combined with workers, pipelined or queue_dir')
+
+
+	@staticmethod
+	def get_device(use_gpu=False):
+		""" 'cuda' if use_gpu is set and a gpu is available, otherwise 'cpu' """
+		if use_gpu:
+			import torch
+			return "cuda" if torch.cuda.is_available() else "cpu"
+		return 'cpu'
+
 
-		#load Whisper ASR model
-		self.whisper_model = SpeechPipeline.load_whisper_model(use_gpu=use_gpu)
+	@property
+	def device(self):
+		if self._device is None:
+			self._device = SpeechPipeline.get_device(self.use_gpu)
+		return self._device
 
-		#load alignment model
-		if self.use_word_alignment:
-			self.alignment_model, self.metadata = SpeechPipeline.load_alignment_model(language, use_gpu=use_gpu)
 
-		#load speaker_diarization model
-		if use_diarize:
-			self.diarizaton_model = SpeechPipeline.load_diarization_model(use_gpu=use_gpu)
+	def set_threads(self):
+		""" applies num_threads once, before the first model is loaded """
+		if self.num_threads is not None and not self._threads_set:
+			set_num_threads(self.num_threads)
+			self._threads_set = True
 
 
+	@property
+	def whisper_model_name(self):
+		""" model size and precision, part of the cache keys of whisper results """
+		#fp32 keeps the plain size so results cached before precision existed stay valid
+		return self.model_size if self.precision == 'fp32' else self.model_size + '-' + self.precision
+
+
+	@property
+	def embedding_model_name(self):
+		""" speaker embedding model and backend, part of the cache keys of embeddings """
+		if self.embedding_backend == 'pyannote':
+			return DIARIZATION_MODEL
+		return DIARIZATION_MODEL + '-' + self.embedding_backend
+
+
+	@property
+	def whisper_model(self):
+		""" whisper ASR model, loaded on first use """
+		if self._whisper_model is None:
+			self.set_threads()
+			with self.instrumentation.measure('load_whisper_model', model=self.whisper_model_name):
+				self._whisper_model = SpeechPipeline.load_whisper_model(model_size=self.model_size, use_gpu=self.use_gpu,
+					precision=self.precision)
+		return self._whisper_model
+
+
+	@whisper_model.setter
+	def whisper_model(self, model):
+		self._whisper_model = model
+
+
+	def alignment_model(self, language):
+		""" whisperx alignment model and its metadata for language, loaded on first use
+
+		Returns
+		-----------
+		model, metadata
+		"""
+		if (language, self.use_gpu) in SpeechPipeline.alignment_models:
+			return SpeechPipeline.load_alignment_model(language, use_gpu=self.use_gpu)
+		self.set_threads()
+		with self.instrumentation.measure('load_alignment_model', language=language):
+			return SpeechPipeline.load_alignment_model(language, use_gpu=self.use_gpu)
+
+
+	@property
+	def diarizaton_model(self):
+		""" speaker embedding model, loaded on first use """
+		if self._diarization_model is None:
+			self.set_threads()
+			with self.instrumentation.measure('load_diarization_model', model=self.embedding_model_name):
+				self._diarization_model = SpeechPipeline.load_diarization_model(use_gpu=self.use_gpu,
+					backend=self.embedding_backend)
+		return self._diarization_model
+
+
+	@diarizaton_model.setter
+	def diarizaton_model(self, model):
+		self._diarization_model = model
+
+
+	#loaders are memoized, pipelines in the same process share the loaded models
 	@staticmethod
-	def load_whisper_model(model_size='base', use_gpu=False):
+	@functools.lru_cache(maxsize=None)
+	def load_whisper_model(model_size='base', use_gpu=False, precision='fp32'):
 		""" loads and returns whisper model for multilingual ASR
 
 		Parameters
 		------------
 		model_size : string
-			options from whisper model ['base']
+			one of WHISPER_MODEL_SIZES
 		use_gpu : boolean, default False
-			loads model onto gpu if available
+			loads model onto gpu if available, ignored for int8
+		precision : string, default 'fp32'
+			'fp32', or 'int8' for a cpu model with int8 dynamic quantized linear layers
 
 		Returns
 		----------
 		model : whisper model from openAI
 		"""
 
+		import whisper
+
 		print('### LOADING WHISPER MODEL ###')
 
-		if use_gpu:
-			DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-			#DECVICE = 'cpu'
-		else:
-			DEVICE = 'cpu'
+		#quantized kernels only exist for the cpu
+		DEVICE = 'cpu' if precision == 'int8' else SpeechPipeline.get_device(use_gpu)
 
 		try:
-			return whisper.load_model('.cache/whisper/'+model_size+'.pt', device=DEVICE)
+			model = whisper.load_model('.cache/whisper/'+model_size+'.pt', device=DEVICE)
 		except:
-			return whisper.load_model(model_size, device=DEVICE)
+			model = whisper.load_model(model_size, device=DEVICE)
+
+		if precision == 'int8':
+			from quantization import quantize_dynamic_int8
+			model = quantize_dynamic_int8(model)
+		return model
 
 
+	#alignment models are pooled instead, least recently used languages are dropped
 	@staticmethod
 	def load_alignment_model(model_language, use_gpu=False):
-		""" loads and returns whisper model for multilingual ASR
+		""" loads and returns the whisperx word alignment model of a language
 
 		Parameters
 		------------
-		model_size : string
-			options from whisper model ['base']
+		model_language : string
+			language code, e.g. en
 		use_gpu : boolean, default False
 			loads model onto gpu if available
 
 		Returns
 		----------
-		model : whisper model from openAI
+		model : wav2vec2 alignment model
+		metadata : dictionary
+			language and vocabulary of the model
 		"""
 
-		print('### LOADING WHISPERX MODEL ###')
+		def load():
+			import whisperx
 
-		if use_gpu:
-			DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-			#DECVICE = 'cpu'
-		else:
-			DEVICE = 'cpu'
+			print('### LOADING WHISPERX MODEL ###')
+
+			DEVICE = SpeechPipeline.get_device(use_gpu)
+
+			return whisperx.load_align_model(language_code=model_language, device=DEVICE)
 
-		return whisperx.load_align_model(language_code=model_language, device=DEVICE)
+		return SpeechPipeline.alignment_models.get((model_language, use_gpu), load)
 
 
 	@staticmethod
-	def load_diarization_model(use_gpu=False):
+	@functools.lru_cache(maxsize=None)
+	def load_diarization_model(use_gpu=False, backend='pyannote'):
 		""" loads and returns speechbrain model for speaker diarization
 
 		Parameters
 		------------
 		use_gpu : boolean, default False
-			loads model onto gpu if available
+			loads model onto gpu if available, ignored for traced_int8
+		backend : string, default 'pyannote'
+			one of EMBEDDING_BACKENDS
 
 		Returns
 		----------
 		model : diarization model from pyannote
 		"""
 
+		from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
+
 		print('### LOADING DIARIZATION MODEL ###')
 
-		if use_gpu:
-			DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-		else:
-			DEVICE = 'cpu'
+		#quantized kernels only exist for the cpu
+		DEVICE = 'cpu' if backend == 'traced_int8' else SpeechPipeline.get_device(use_gpu)
+
+		model = PretrainedSpeakerEmbedding(DIARIZATION_MODEL, device=DEVICE)
+		if backend == 'pyannote':
+			return model
+
+		from speaker_embedding import OptimizedSpeakerEmbedding
+		return OptimizedSpeakerEmbedding(model, DIARIZATION_MODEL, precision='int8' if backend == 'traced_int8' else 'fp32',
+			cache_dir=TRACED_EMBEDDING_DIR)
+
+
+	def cached_stage(self, audio_file, stage, compute, **options):
+		""" returns the result of a stage from the cache, or computes and caches it.
+		Without a cache_dir the stage is always computed.
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			audio the stage runs on, its content hash is part of the cache key
+		stage : string
+			name of the stage
+		compute : function
+			called without arguments to compute the result on a cache miss
+		options : keyword arguments
+			everything else the result depends on
+
+		Returns
+		-----------
+		result of the stage
+		"""
+		if self.cache is None:
+			with self.model_lock:
+				return compute()
+
+		key = self.cache.key(audio_file.content_hash(), stage, **options)
+		result = self.cache.get(key)
+		self.instrumentation.annotate(cached=result is not None)
+		if result is None:
+			with self.model_lock:
+				result = compute()
+			self.cache.put(key, result)
+		elif self.verbose:
+			print('#### Using cached', stage, 'for', audio_file.path, '####')
+		return result
+
+
+	def speech_audio_file(self, audio_file):
+		""" finds the speech regions of the audio with detect_speech
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+
+		Returns
+		-----------
+		speech_file : SpeechAudioFile object
+			the speech of audio_file, the model stages run on it like on an AudioFile
+		"""
+		with self.instrumentation.measure('vad', audio_file) as record:
+			regions = self.cached_stage(audio_file, 'vad', lambda: detect_speech(audio_file), method='energy_zcr')
+			record['segments'] = len(regions)
+		speech_file = SpeechAudioFile(audio_file, regions)
+
+		if self.verbose:
+			print('#### Found', len(regions), 'speech regions,', round(speech_file.duration, 1), 'seconds of speech in', audio_file.path, '####')
+		return speech_file
+
+
+	def detect_language(self, audio_file):
+		""" detects the language of the audio with whisper, from its first 30 seconds
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+
+		Returns
+		-----------
+		language : string
+			language code, e.g. en
+		"""
+		def detect():
+			from whisper.audio import log_mel_spectrogram, pad_or_trim
+
+			model = self.whisper_model
+			if not model.is_multilingual:
+				return 'en'
+
+			import numpy as np
+
+			#only the first window is read, also when the audio is streamed from ffmpeg
+			windows = audio_file.stream(30.0)
+			_, samples = next(windows, (0.0, np.zeros(0, dtype=np.float32)))
+			windows.close()
 
-		return PretrainedSpeakerEmbedding("speechbrain/spkrec-ecapa-voxceleb", device=DEVICE)
+			n_mels = getattr(model.dims, 'n_mels', 80)
+			chunk = pad_or_trim(samples)
+			mel = log_mel_spectrogram(chunk, n_mels) if n_mels != 80 else log_mel_spectrogram(chunk)
+			_, probs = model.detect_language(mel.to(model.device))
+			return max(probs, key=probs.get)
+
+		with self.instrumentation.measure('detect_language', audio_file) as record:
+			language = self.cached_stage(audio_file, 'language', detect, model=self.whisper_model_name)
+			record['language'] = language
+
+		if self.verbose:
+			print('#### Detected language', language, 'in', audio_file.path, '####')
+		return language
 
 
 	def transcribe_audio_file(self, audio_file):
@@ -193,16 +656,176 @@ class SpeechPipeline(object):
 		if self.verbose:
 			print('#### Transcribing Audio at', audio_file.path, '####')
 
-		#create TranscribeAudio class, pass in AudioFile object and ASR model
-		TA = TranscribeAudio(audio_file, model=self.whisper_model)
+		def transcribe():
+			if not self.is_batched_clip(audio_file):
+				#create TranscribeAudio class, pass in AudioFile object and ASR model, loaded on a cache miss only
+				TA = TranscribeAudio(audio_file, model=self.whisper_model)
+				return TA.transcribe_audio(verbose=self.verbose)
+			return self._batched_transcripts.pop(audio_file.content_hash())
+
+		#a clip not transcribed with its batch is a batch of one, transcribed here since
+		#transcribe_clips takes the model lock, which cached_stage holds while transcribe runs
+		if self.is_batched_clip(audio_file) and audio_file.content_hash() not in self._batched_transcripts:
+			self.transcribe_clips([audio_file])
 
 		#call method to transcribe audio
-		segments = TA.transcribe_audio(verbose=self.verbose)
+		with self.instrumentation.measure('transcribe', audio_file) as record:
+			segments = self.cached_stage(audio_file, 'transcribe', transcribe, model=self.whisper_model_name,
+				language=audio_file.language, **self.clip_options(audio_file))
+			record['segments'] = len(segments)
 
 		#return transcribed segments
 		return segments
 
 
+	def is_batched_clip(self, audio_file):
+		""" True if audio_file is transcribed in batches of clips, with clip_batch_size
+		set and at most one whisper window long. The length is read from the file header, a
+		file with a cached transcript is never decoded.
+		"""
+		return self.clip_batch_size is not None and audio_file.header_duration() <= WINDOW_SECONDS
+
+
+	def clip_options(self, audio_file):
+		""" cache options of the transcription of audio_file, batched clips are decoded
+		differently from whisper.transcribe and cached apart
+		"""
+		return {'method': 'batched_clip'} if self.is_batched_clip(audio_file) else {}
+
+
+	def transcribe_clips(self, audio_files):
+		""" transcribes short audio files together with batched whisper encoder and decoder
+		passes (see transcribe_audio.transcribe_clips). Segments are kept until
+		transcribe_audio_file asks for them. Files with a cached transcript are skipped, files
+		without a language get the language detected from their batch.
+
+		Parameters
+		-----------
+		audio_files : list of AudioFile objects
+			at most WINDOW_SECONDS long each
+		"""
+		from transcribe_audio import transcribe_clips
+
+		def cached(audio_file, stage, **options):
+			if self.cache is None:
+				return None
+			return self.cache.get(self.cache.key(audio_file.content_hash(), stage, **options))
+
+		pending = []
+		for audio_file in audio_files:
+			if audio_file.language is None:
+				audio_file.language = cached(audio_file, 'language', model=self.whisper_model_name)
+			if audio_file.language is None or cached(audio_file, 'transcribe', model=self.whisper_model_name,
+					language=audio_file.language, **self.clip_options(audio_file)) is None:
+				pending.append(audio_file)
+		if not pending:
+			return
+
+		if self.verbose:
+			print('#### Transcribing', len(pending), 'clips in batches of', self.clip_batch_size, '####')
+
+		with self.instrumentation.measure('transcribe_clips', clips=len(pending)) as record:
+			with self.model_lock:
+				segments, languages = transcribe_clips(self.whisper_model, [audio_file.audio for audio_file in pending],
+					[audio_file.language for audio_file in pending], batch_size=self.clip_batch_size, verbose=self.verbose)
+			record['segments'] = sum(len(clip_segments) for clip_segments in segments)
+
+		for audio_file, clip_segments, language in zip(pending, segments, languages):
+			if audio_file.language is None:
+				audio_file.language = language
+				if self.cache is not None:
+					self.cache.put(self.cache.key(audio_file.content_hash(), 'language', model=self.whisper_model_name), language)
+			self._batched_transcripts[audio_file.content_hash()] = clip_segments
+		return
+
+
+	def stream_transcribe_audio_file(self, audio_file, filename):
+		""" transcribes audio window by window with the whisper model. Every segment is
+		appended to the transcript csv (and vtt file with create_captions) as soon as
+		it is decoded.
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			audio file object that needs to be transcribed
+		filename : string
+			name of the file being transcribed
+
+		Returns
+		-----------
+		segments : list of dictionaries
+			created with whisper model
+
+		"""
+
+		if self.verbose:
+			print('#### Streaming transcription of Audio at', audio_file.path, '####')
+
+		options = dict(model=self.whisper_model_name, language=audio_file.language, window=self.stream_window)
+		cached = None
+		if self.cache is not None:
+			key = self.cache.key(audio_file.content_hash(), 'transcribe_stream', **options)
+			cached = self.cache.get(key)
+
+		if cached is not None:
+			#cached segments are written through the same writers
+			stream = iter(cached)
+		else:
+			TA = TranscribeAudio(audio_file, model=self.whisper_model)
+			stream = TA.transcribe_stream(window=self.stream_window, verbose=self.verbose)
+		stream = self.stream_transcript(filename, stream)
+
+		if self.create_captions:
+			from create_closed_captions import CreateClosedCaptions
+			CCC = CreateClosedCaptions(filename+'_captions.'+self.caption_format, [], self.outpath)
+			stream = CCC.stream_caption_file(stream, self.verbose)
+
+		#segments are kept for the stages that need the whole transcript
+		with self.instrumentation.measure('transcribe_stream', audio_file, cached=cached is not None) as record:
+			if cached is not None:
+				segments = list(stream)
+			else:
+				with self.model_lock:
+					segments = list(stream)
+				if self.cache is not None:
+					self.cache.put(key, segments)
+			record['segments'] = len(segments)
+
+		if self.create_captions:
+			self._report_output(self.outpath+filename+'_captions.'+self.caption_format, segments)
+		return segments
+
+
+	def transcribe_translate_audio_file(self, audio_file):
+		""" uses the whisper model to transcribe audio and translate it to English,
+		sharing the spectrogram and encoder pass of every window between both tasks.
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			audio file object that needs to be transcribed
+
+		Returns
+		-----------
+		segments : list of dictionaries
+			created with whisper model
+		english_segments : list of dictionaries
+			translated to English with whisper model
+
+		"""
+
+		if self.verbose:
+			print('#### Transcribing and Translating Audio at', audio_file.path, '####')
+
+		with self.instrumentation.measure('transcribe_translate', audio_file) as record:
+			#the model is only loaded on a cache miss
+			segments, english_segments = self.cached_stage(audio_file, 'transcribe_translate',
+				lambda: TranscribeAudio(audio_file, model=self.whisper_model).transcribe_and_translate(verbose=self.verbose),
+				model=self.whisper_model_name, language=audio_file.language)
+			record['segments'] = len(segments) + len(english_segments)
+		return segments, english_segments
+
+
 	def translate_audio_file(self, audio_file):
 		""" uses the whiper model to transcribe audio. 
 		Creates TranscribeAudio object.
@@ -222,11 +845,16 @@ class SpeechPipeline(object):
 		if self.verbose:
 			print('#### Translating and Transcribing Audio at', audio_file.path, '####')
 
-		#create TranscribeAudio class, pass in AudioFile object and ASR model
-		TA = TranscribeAudio(audio_file, model=self.whisper_model)
+		#create TranscribeAudio class, pass in AudioFile object and ASR model, loaded on a cache miss only
+		def translate():
+			TA = TranscribeAudio(audio_file, model=self.whisper_model)
+			return TA.translate_to_english(verbose=self.verbose)
 
 		#call method to transcribe audio
-		segments = TA.translate_to_english(verbose=self.verbose)
+		with self.instrumentation.measure('translate', audio_file) as record:
+			segments = self.cached_stage(audio_file, 'translate', translate,
+				model=self.whisper_model_name, language=audio_file.language)
+			record['segments'] = len(segments)
 
 		#return transcribed segements
 		return segments
@@ -248,13 +876,22 @@ class SpeechPipeline(object):
 			with word aligned annotations
 		"""
 
+		from word_align_audio import WordAlignAudio
+
 		if self.verbose:
 			print('#### Aligning Audio at', audio_file.path, '####')
 		
-		#create word align audio object
-		WAA = WordAlignAudio(audio_file, self.alignment_model, self.metadata, self.device)
+		def align():
+			#create word align audio object, the alignment model is loaded on a cache miss only
+			alignment_model, metadata = self.alignment_model(audio_file.language)
+			WAA = WordAlignAudio(audio_file, alignment_model, metadata, self.device)
+			return WAA.align_words(segments, verbose=self.verbose)
+
 		#call method to add word level time stamps
-		aligned_segments = WAA.align_words(segments, verbose=self.verbose)
+		with self.instrumentation.measure('align', audio_file) as record:
+			aligned_segments = self.cached_stage(audio_file, 'align', align,
+				language=audio_file.language, segments=[(segment['start'], segment['end'], segment['text']) for segment in segments])
+			record['segments'] = len(aligned_segments['word_segments'])
 		return aligned_segments
 
 	def diarize_audio_file(self, audio_file, segments):
@@ -271,17 +908,93 @@ class SpeechPipeline(object):
 		diarized_segments : list of dictionaries
 			segments from whisper model ASR with a speaker label
 		"""
+		from diarize_audio import DiarizeAudio
+
 		if self.verbose:
 			print('#### Diarizing Audio at', audio_file.path, '####')
 
-		#create DiarizeAudio class
-		DA = DiarizeAudio(audio_file, segments, self.diarizaton_model)
-		#call method to assign speaker label to segements
-		diarized_segments = DA.clustering()
+		#create DiarizeAudio class, clustering needs no model
+		DA = DiarizeAudio(audio_file, segments, batch_size=self.embedding_batch_size, clustering=self.clustering)
+
+		def extract_embeddings():
+			#the diarization model is loaded on a cache miss only
+			DA.embedding_model = self.diarizaton_model
+			return DA.extract_embeddings()
+
+		with self.instrumentation.measure('diarize', audio_file, clustering=self.clustering) as record:
+			if self.embedding_window is not None:
+				#pooled from the windows, shared by every segmentation of the file
+				windowed, window_embeddings = self.window_embeddings(audio_file)
+				embeddings = windowed.pool(window_embeddings, segments)
+			else:
+				#speaker embeddings only depend on the audio and the segment boundaries
+				embeddings = self.cached_stage(audio_file, 'embeddings', extract_embeddings,
+					model=self.embedding_model_name, segments=[(segment['start'], segment['end']) for segment in segments])
+			#call method to assign speaker label to segements
+			diarized_segments = DA.cluster(embeddings)
+			record['segments'] = len(diarized_segments)
 		#return labeled segments
 		return diarized_segments
 
 
+	def assign_speakers_audio_file(self, audio_file, diarized_segments, segments):
+		""" labels another segmentation of a diarized file (e.g. its translation) with the
+		speaker of the diarized segments each segment overlaps most, see speaker_assignment.py
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			the diarized audio
+		diarized_segments : list of dictionaries
+			from diarize_audio_file
+		segments : list of dictionaries
+			segments of the same audio to label
+
+		Returns
+		-----------
+		diarized_segments : list of dictionaries
+			copies of segments with a speaker label
+		"""
+		from speaker_assignment import assign_speakers
+
+		with self.instrumentation.measure('assign_speakers', audio_file) as record:
+			labeled_segments = assign_speakers(diarized_segments, segments)
+			record['segments'] = len(labeled_segments)
+		return labeled_segments
+
+
+	def window_embeddings(self, audio_file):
+		""" speaker embeddings of audio_file on the sliding window grid of embedding_window.
+		Computed (or read from the cache) once, later calls for the same file reuse them.
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+
+		Returns
+		-----------
+		windowed : WindowedSpeakerEmbedding
+			pools the window embeddings into segment embeddings
+		embeddings : numpy array
+			(number of windows, dimension)
+		"""
+		from speaker_embedding import WindowedSpeakerEmbedding
+
+		#pooling needs no model, it is set on a cache miss only
+		windowed = WindowedSpeakerEmbedding(None, window=self.embedding_window,
+			step=self.embedding_window / 2, batch_size=self.embedding_batch_size)
+
+		def embed():
+			windowed.engine.embedding_model = self.diarizaton_model
+			return windowed(audio_file)
+
+		if self._window_embeddings is None or self._window_embeddings[0] is not audio_file:
+			embeddings = self.cached_stage(audio_file, 'window_embeddings', embed,
+				model=self.embedding_model_name, window=windowed.window, step=windowed.step)
+			self._window_embeddings = (audio_file, embeddings)
+		return windowed, self._window_embeddings[1]
+
+
 	def create_transcript(self, filename, segments):
 		"""
 		Parameters
@@ -297,14 +1010,87 @@ class SpeechPipeline(object):
 		transcript : csv file 
 			csv file of transcript saved at filename_transcript.csv
 		"""
+		import pandas as pd
+
 		#file_name = os.path.basename(self.path)[:-4]
 		#self.file_name = os.path.basename(self.path)[:-4]
 
-		df = pd.DataFrame(segments)
-		df.to_csv(self.outpath + filename +'_transcript.csv')
+		with self.instrumentation.measure('create_transcript', output=self.outpath + filename + '_transcript.csv') as record:
+			df = pd.DataFrame(segments)
+			#written to a temporary file first, a crash never leaves half a csv
+			with atomic_write(self.outpath + filename +'_transcript.csv', newline='') as f:
+				df.to_csv(f)
+			record['segments'] = len(segments)
 
 		if self.verbose:
 				print('#### File saved to ', self.outpath+filename, '_transcript.csv ####')
+		self._report_output(self.outpath + filename +'_transcript.csv', segments)
+		return
+
+
+	def append_to_corpus(self, filename, variant, segments):
+		"""
+		Parameters
+		-----------
+		filename : string
+			name of the file being transcribed
+		variant : string
+			kind of transcript, e.g. 'transcript', 'diarized' or 'word_aligned'
+		segments : list of dictionaries
+			Text segments of Audio, appended to the corpus store as one chunk
+		"""
+		with self.instrumentation.measure('append_to_corpus', output=self.corpus.corpus_dir, variant=variant) as record:
+			self.corpus.append(filename, variant, segments)
+			record['segments'] = len(segments)
+
+		if self.verbose:
+				print('#### Appended', variant, 'of', filename, 'to', self.corpus.corpus_dir, '####')
+		self._report_output(self.corpus.corpus_dir, segments)
+		return
+
+
+	def _report_output(self, path, segments):
+		""" passes a saved output to the on_output callback, if there is one """
+		if self.on_output is not None:
+			self.on_output(path, segments)
+
+
+	def stream_transcript(self, filename, segments):
+		""" appends segments to filename_transcript.csv.partial as they arrive, and renames it
+		to filename_transcript.csv when all segments are saved. The csv has the same layout as
+		the one written by create_transcript.
+
+		Parameters
+		-----------
+		filename : string
+			name of the file being transcribed
+		segments : iterable of dictionaries
+			e.g. from TranscribeAudio.transcribe_stream
+
+		Yields
+		-----------
+		segment : dictionary
+			each segment, after it is saved
+		"""
+		import pandas as pd
+
+		columns = None
+		saved = []
+		#appended to a .partial file, renamed when the transcript is complete
+		partial_path = self.outpath + filename + '_transcript.csv.partial'
+		with open(partial_path, 'w', newline='') as f:
+			for i, segment in enumerate(segments):
+				if columns is None:
+					columns = list(segment.keys())
+				pd.DataFrame([segment], index=[i], columns=columns).to_csv(f, header=(i == 0))
+				f.flush()
+				saved.append(segment)
+				yield segment
+		os.replace(partial_path, self.outpath + filename + '_transcript.csv')
+
+		if self.verbose:
+				print('#### File saved to ', self.outpath+filename, '_transcript.csv ####')
+		self._report_output(self.outpath + filename + '_transcript.csv', saved)
 		return
 
 
@@ -321,88 +1107,420 @@ class SpeechPipeline(object):
 		Returns
 		----------
 		vtt_file: file
-			saved to location of outpath
+			vtt (or srt with caption_format) file saved to location of outpath
 		"""
-		CCC = CreateClosedCaptions(filename, segments, self.outpath)
-		CCC.create_vtt_file(self.verbose)
+		from create_closed_captions import CreateClosedCaptions
+
+		with self.instrumentation.measure('create_vtt_file', output=self.outpath + filename) as record:
+			CCC = CreateClosedCaptions(filename, segments, self.outpath, caption_format=self.caption_format,
+				speaker_labels=self.caption_speakers)
+			CCC.create_caption_file(self.verbose)
+			record['segments'] = len(segments)
+		self._report_output(self.outpath + filename, segments)
 		return
 
-	def pipeline(self):
-		""" takes a directory or file. If directory, iterates through all files in the directory. 
-		First audio is transcribed with the whisper model. 
-		The segments generated by the whisper model are then assigne a speaker label with the speechbrain s
-		speaker diarization model. 
-		For each audio file, a csv of the transcript is saved to the specificed outpath. 
+	def prepare_file(self, file_path):
+		""" creates the AudioFile of a file and decodes it (or memory maps it), so the model
+		stages find the audio ready. With a cache only the content hash is computed, cached
+		files never need their audio. Streamed files are decoded window by window later.
+
+		Parameters
+		-----------
+		file_path : string
+			path to the audio file
+
+		Returns
+		-----------
+		audio_file : AudioFile object
 		"""
+		#Make AudioFile object to hold data pertaining to single Audio File
+		audio_file = AudioFile(file_path, self.language, self.num_speakers, use_mmap=self.use_mmap, wav_dir=self.wav_dir,
+			instrumentation=self.instrumentation)
+		try:
+			if self.manifest is not None:
+				self.manifest.record(file_path, 'file', STARTED, content_hash=audio_file.content_hash(),
+					options=self.options_digest)
+			if self.cache is not None:
+				audio_file.content_hash()
+			elif not self.stream_window:
+				audio_file.open_wav(verbose=self.verbose) if self.use_mmap else audio_file.load_audio(verbose=self.verbose)
+		except Exception:
+			audio_file.close()
+			raise
+		return audio_file
+
+
+	def run_models(self, audio_file, speech_file=None):
+		""" runs every enabled model stage on a prepared audio file. Outputs are returned
+		instead of saved, except in streaming mode where the transcript is saved as it is decoded.
 
-		#check to see if path is a directory'
-		if os.path.isdir(self.path):
-			#get all files in directory
-			for file in os.listdir(self.path):
-				#files to skip
-				if file not in ['.DS_Store']:
-					#Make AudioFile object to hold data pertaining to single Audio File
-					audio_file = AudioFile(self.path+'/'+file, self.language, self.num_speakers)
-					#transcribe audio and return segments for diarization
-					segments = self.transcribe_audio_file(audio_file)
-					filename = os.path.basename(self.path+'/'+file)[:-4]
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			from prepare_file, closed when the stages are done
+		speech_file : SpeechAudioFile object, optional
+			the speech of audio_file if it was already found with speech_audio_file, with vad
 
-					if self.use_word_alignment:
-						aligned_segments = self.align_to_words_audio_file(audio_file, segments)
-						#outputs csv file with word aligned transcript
-						self.create_transcript(filename+'_word_aligned', aligned_segments['word_segments'])
+		Returns
+		-----------
+		outputs : list of tuples
+			('transcript' or 'vtt', file name, variant, segments), saved by write_outputs
+		"""
+		outputs = []
+		try:
+			filename = os.path.basename(audio_file.path)[:-4]
+
+			#the model stages only see the speech, silence and music are cut out
+			if not self.vad:
+				speech_file = None
+			elif speech_file is None:
+				speech_file = self.speech_audio_file(audio_file)
+			if speech_file is not None:
+				audio_file = speech_file
+
+			if audio_file.language is None:
+				#detected once, transcription, translation and alignment of the file all use it
+				audio_file.language = self.detect_language(audio_file)
+
+			#transcribe audio and return segments for diarization
+			english_segments = None
+			if self.stream_window:
+				#transcript and captions are written while the audio is transcribed
+				segments = self.stream_transcribe_audio_file(audio_file, filename)
+			elif self.use_translate:
+				#translation reuses the encoder pass of the transcription
+				segments, english_segments = self.transcribe_translate_audio_file(audio_file)
+			else:
+				segments = self.transcribe_audio_file(audio_file)
 
-					if self.use_diarize:
-						diarized_segments = self.diarize_audio_file(audio_file, segments)
-						#outputs transcript of diarized segments
-						self.create_transcript(filename+'_diarized', diarized_segments)
-					else:
-						#outputs transcript of original segments
-						self.create_transcript(filename, segments)
+			if self.use_word_alignment:
+				aligned_segments = self.align_to_words_audio_file(audio_file, segments)
+				#outputs csv file with word aligned transcript
+				outputs.append(('transcript', filename, 'word_aligned', aligned_segments['word_segments']))
 
-					if self.use_translate:
-						english_segments = self.translate_audio_file(audio_file)
+			if self.use_diarize:
+				diarized_segments = self.diarize_audio_file(audio_file, segments)
+				#outputs transcript of diarized segments
+				outputs.append(('transcript', filename, 'diarized', diarized_segments))
+			elif not self.stream_window or self.corpus is not None:
+				#outputs transcript of original segments, streamed csvs are already saved
+				outputs.append(('transcript', filename, 'transcript', segments))
 
-						if self.use_diarize:
-							english_diarized_segments = self.diarize_audio_file(audio_file, english_segments)
-							self.create_transcript(filename+'_translated_to_english_diarized', english_diarized_segments)
+			if self.use_translate:
+				if english_segments is None:
+					english_segments = self.translate_audio_file(audio_file)
 
-						else:
-							self.create_transcript(filename + '_translated_to_english', english_segments)
+				if self.use_diarize:
+					#speaker turns of the transcript are reused, no second diarization pass
+					english_diarized_segments = self.assign_speakers_audio_file(audio_file, diarized_segments, english_segments)
+					outputs.append(('transcript', filename, 'translated_to_english_diarized', english_diarized_segments))
 
-					if self.create_captions:
-						self.create_vtt_file(filename+'_captions.vtt', segments)
+				else:
+					outputs.append(('transcript', filename, 'translated_to_english', english_segments))
 
+			if self.create_captions and not self.stream_window:
+				#diarized segments carry the speaker labels
+				outputs.append(('vtt', filename, 'captions', diarized_segments if self.use_diarize else segments))
 
+			if speech_file is not None:
+				#timestamps of the outputs are in the time of the original file
+				outputs = [(kind, filename, variant, speech_file.segments_to_original(segments))
+					for kind, filename, variant, segments in outputs]
+		finally:
+			#drop the decoded audio and any converted wav before the next file
+			audio_file.close()
+			self._window_embeddings = None
+		return outputs
 
-		#if path is a file, this is checked when self.PATH is set in the init for the class
-		else:
-			audio_file = AudioFile(self.path, self.language, self.num_speakers)
-			segments = self.transcribe_audio_file(audio_file)
-			filename = os.path.basename(self.path)[:-4]
 
-			if self.use_word_alignment:
-				aligned_segments = self.align_to_words_audio_file(audio_file, segments)
-				self.create_transcript(filename+'_word_aligned', aligned_segments['word_segments'])
+	def write_outputs(self, outputs):
+		""" saves the outputs returned by run_models to outpath, or appends the
+		transcripts to the corpus store if there is one
 
-			if self.use_diarize:
-				diarized_segments = self.diarize_audio_file(audio_file, segments)
-				self.create_transcript(filename+'_diarized', diarized_segments)
+		Parameters
+		-----------
+		outputs : list of tuples
+			('transcript' or 'vtt', file name, variant, segments)
+
+		Returns
+		-----------
+		paths : list of strings
+			saved files, or the corpus directory for transcripts appended to the corpus
+		"""
+		paths = []
+		for kind, filename, variant, segments in outputs:
+			if kind == 'vtt':
+				name = filename+'_'+variant+'.'+self.caption_format
+				self.create_vtt_file(name, segments)
+				paths.append(self.outpath + name)
+			elif self.corpus is not None:
+				self.append_to_corpus(filename, variant, segments)
+				paths.append(self.corpus.corpus_dir)
 			else:
-				self.create_transcript(filename, segments)
+				name = filename if variant == 'transcript' else filename+'_'+variant
+				self.create_transcript(name, segments)
+				paths.append(self.outpath + name + '_transcript.csv')
+		return paths
 
-			if self.use_translate:
-				english_segments = self.translate_audio_file(audio_file)
 
-				if self.use_diarize:
-					english_diarized_segments = self.diarize_audio_file(audio_file, english_segments)
-					self.create_transcript(filename+'_translated_to_english_diarized', english_diarized_segments)
+	def finish_file(self, file_path, outputs):
+		""" saves the outputs of a file and records it as done in the manifest
 
-				else:
-					self.create_transcript(filename + '_translated_to_english', english_segments)
+		Parameters
+		-----------
+		file_path : string
+			path to the audio file
+		outputs : list of tuples
+			from run_models
 
+		Returns
+		-----------
+		paths : list of strings
+			saved files of file_path
+		"""
+		paths = self.write_outputs(outputs)
+		if self.stream_window:
+			#the streamed transcript and captions were saved by run_models
+			filename = os.path.basename(file_path)[:-4]
+			paths.append(self.outpath + filename + '_transcript.csv')
 			if self.create_captions:
-				self.create_vtt_file(filename+'_captions.vtt', segments)
+				paths.append(self.outpath + filename + '_captions.' + self.caption_format)
+		if self.manifest is not None:
+			self.manifest.record(file_path, 'file', DONE, outputs=paths)
+		return paths
+
+
+	def process_file(self, file_path):
+		""" runs every enabled stage on a single audio file and saves the outputs to outpath.
+
+		Parameters
+		-----------
+		file_path : string
+			path to the audio file
+
+		Returns
+		-----------
+		paths : list of strings
+			saved files of file_path, kept in the done marker of the work queue
+		"""
+		try:
+			return self.finish_file(file_path, self.run_models(self.prepare_file(file_path)))
+		except Exception as e:
+			if self.manifest is not None:
+				self.manifest.record(file_path, 'file', FAILED, error=type(e).__name__ + ': ' + str(e))
+			raise
+
+
+	def is_done(self, file_path):
+		""" True if the manifest records file_path as done with its current content and
+		the current options, so a resumed run can skip it
+		"""
+		if self.manifest is None or file_path not in self.manifest.files:
+			return False
+		content_hash = AudioFile(file_path, self.language, self.num_speakers).content_hash()
+		return self.manifest.is_complete(file_path, content_hash, self.options_digest)
+
+
+	def process_files_pipelined(self, files):
+		""" processes files with decoding, model stages and output writing on separate
+		threads connected by bounded queues. The next file is decoded and the previous
+		file's outputs are written while the current file is in the models.
+
+		Parameters
+		-----------
+		files : list of strings
+			paths to the audio files
+
+		Returns
+		-----------
+		failed : dictionary
+			file path -> traceback for every file that raised an error
+		"""
+		from stage_executor import StageExecutor
+
+		executor = StageExecutor([
+			('decode', self.prepare_file),
+			('models', lambda audio_file: (audio_file.path, self.run_models(audio_file))),
+			('write', lambda result: self.finish_file(*result)),
+		], queue_size=self.queue_size)
+		results = executor.run(files)
+
+		if self.verbose:
+			print(executor.format_stats())
+		failed = {file_path: error for file_path, (_, error) in results.items() if error is not None}
+		if self.manifest is not None:
+			for file_path, error in failed.items():
+				self.manifest.record(file_path, 'file', FAILED, error=error.strip().splitlines()[-1])
+		return failed
+
+
+	def process_files_batched(self, files):
+		""" processes files clip_batch_size at a time. The files of a group are decoded, the
+		ones of at most 30 seconds are transcribed together with transcribe_clips, and then
+		every file runs through the other stages and is saved as in process_file.
+
+		Parameters
+		-----------
+		files : list of strings
+			paths to the audio files
+
+		Returns
+		-----------
+		failed : dictionary
+			file path -> traceback for every file that raised an error
+		"""
+		import traceback
+
+		failed = {}
+
+		def fail(file_path, audio_file=None):
+			failed[file_path] = traceback.format_exc()
+			if audio_file is not None:
+				audio_file.close()
+			if self.manifest is not None:
+				self.manifest.record(file_path, 'file', FAILED, error=failed[file_path].strip().splitlines()[-1])
+			if self.verbose:
+				print(failed[file_path])
+
+		for start in range(0, len(files), self.clip_batch_size):
+			audio_files = {}
+			for file_path in files[start:start + self.clip_batch_size]:
+				try:
+					audio_files[file_path] = self.prepare_file(file_path)
+				except Exception:
+					fail(file_path)
+
+			#the models see the speech of the clips, found once and passed on to run_models
+			speech_files, clips = {}, {}
+			for file_path, audio_file in audio_files.items():
+				try:
+					if self.vad:
+						speech_files[file_path] = self.speech_audio_file(audio_file)
+					clip = speech_files.get(file_path, audio_file)
+					if self.is_batched_clip(clip):
+						clips[file_path] = clip
+				except Exception:
+					fail(file_path, audio_files[file_path])
+			try:
+				self.transcribe_clips(list(clips.values()))
+			except Exception:
+				#every clip is transcribed again on its own, and fails with its own error
+				if self.verbose:
+					print(traceback.format_exc())
+
+			for file_path, audio_file in audio_files.items():
+				if file_path in failed:
+					continue
+				try:
+					#the clips carry the language detected in their batch
+					self.finish_file(file_path, self.run_models(audio_file, speech_file=speech_files.get(file_path)))
+				except Exception:
+					fail(file_path, audio_file)
+			self._batched_transcripts.clear()
+		return failed
+
+
+	def process_files_queued(self, files):
+		""" processes the files this pipeline claims in the work queue at self.queue_dir.
+		Other pipelines running on the same directory and queue_dir, on this or other
+		machines, claim the other files. Returns once every file is done or failed too often.
+
+		Parameters
+		-----------
+		files : list of strings
+			paths to the audio files
+
+		Returns
+		-----------
+		failed : dictionary
+			file path -> traceback for every file that raised an error in this pipeline
+		"""
+		from work_queue import WorkQueue
+
+		queue = WorkQueue(self.queue_dir, lease_seconds=self.lease_seconds)
+		failed = queue.process(files, self.process_file, verbose=self.verbose)
+		if self.verbose:
+			print('#### Queue:', queue.status(), '####')
+		return failed
+
+
+	def submit_to_server(self):
+		""" sends this job to the model server at self.server and prints the results it
+		streams back. Paths are made absolute, since the server has its own working directory.
+		"""
+		from model_server import submit_job
+
+		def absolute(path):
+			#outpath is a prefix, keep a trailing separator
+			return os.path.abspath(path) + (os.sep if path == '' or path.endswith(('/', os.sep)) else '')
+
+		params = dict(self._worker_kwargs)
+		params['path'] = os.path.abspath(self.path)
+		params['outpath'] = absolute(self.outpath)
+		for name in ['wav_dir', 'cache_dir', 'corpus_dir', 'metrics_path', 'prometheus_path', 'manifest_path', 'queue_dir']:
+			if params[name] is not None:
+				params[name] = os.path.abspath(params[name])
+
+		for event in submit_job(self.server, params):
+			if event['event'] in ['rejected', 'error']:
+				raise RuntimeError('model server ' + event['event'] + ' the job: ' + str(event.get('error', '')))
+			if self.verbose:
+				if event['event'] == 'output':
+					print('#### File saved to ', event['path'], '####')
+				else:
+					print('#### Server:', event['event'], '####')
+		return
+
+
+	def pipeline(self):
+		""" takes a directory or file. If directory, iterates through all files in the directory. 
+		First audio is transcribed with the whisper model. 
+		The segments generated by the whisper model are then assigne a speaker label with the speechbrain s
+		speaker diarization model. 
+		For each audio file, a csv of the transcript is saved to the specificed outpath. 
+		"""
+
+		#run the job on a model server instead of loading the models here
+		if self.server is not None:
+			self.submit_to_server()
+			return
+
+		if self.manifest is not None:
+			#drop an event cut off by a crash of the previous run
+			self.manifest.load(repair=True)
+
+		#check to see if path is a directory'
+		if os.path.isdir(self.path):
+			#get all files in directory, skipping system files
+			files = [self.path+'/'+file for file in os.listdir(self.path) if file not in ['.DS_Store']]
+
+			if self.resume:
+				remaining = [file_path for file_path in files if not self.is_done(file_path)]
+				if self.verbose:
+					print('#### Resuming,', len(files) - len(remaining), 'of', len(files), 'files already done ####')
+				files = remaining
+
+			if self.workers > 1 or self.pipelined or self.queue_dir is not None or self.clip_batch_size is not None:
+				if self.workers > 1:
+					failed = run_parallel(self._worker_kwargs, files, self.workers, verbose=self.verbose)
+				elif self.pipelined:
+					failed = self.process_files_pipelined(files)
+				elif self.queue_dir is not None:
+					failed = self.process_files_queued(files)
+				else:
+					failed = self.process_files_batched(files)
+				if failed:
+					raise RuntimeError(str(len(failed)) + ' files failed: ' + ', '.join(sorted(failed)))
+			else:
+				for file_path in files:
+					self.process_file(file_path)
+
+		#if path is a file, this is checked when self.PATH is set in the init for the class
+		elif self.resume and self.is_done(self.path):
+			if self.verbose:
+				print('#### Resuming,', self.path, 'is already done ####')
+		else:
+			self.process_file(self.path)
 		return
 
 
@@ -0,0 +1,80 @@
+import collections
+import threading
+
+from result_cache import parse_size
+
+
+def model_bytes(model):
+    """ memory of the parameters and buffers of a torch model, or of every torch model
+    in a tuple or list (e.g. an alignment model and its metadata). Other objects count as 0.
+    """
+    if isinstance(model, (tuple, list)):
+        return sum(model_bytes(item) for item in model)
+    if not hasattr(model, 'parameters') or not hasattr(model, 'buffers'):
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelPool(object):
+    """
+    """
+    def __init__(self, max_size='4GB', size_of=model_bytes):
+        """ models loaded on demand and kept by key (e.g. the language of an alignment model).
+        When the models together use more than max_size, the least recently used ones are
+        dropped until they fit again. The model just loaded is always kept, even if it is
+        larger than max_size on its own.
+
+        Parameters
+        -----------
+        max_size : int or string, default '4GB'
+            memory limit of the pooled models, e.g. 500MB or 4GB
+        size_of : function, default model_bytes
+            memory of a model in bytes
+        """
+        self.max_size = parse_size(max_size)
+        self.size_of = size_of
+        #key -> (model, size), least recently used first
+        self.models = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key, load):
+        """ the model of key, loaded with load() if it is not in the pool
+
+        Parameters
+        -----------
+        key : hashable
+        load : function
+            called without arguments on a miss, returns the model
+
+        Returns
+        -----------
+        model
+        """
+        #one load at a time, two jobs needing the same language load it once
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key][0]
+
+            model = load()
+            self.models[key] = (model, self.size_of(model))
+            self.evict()
+            return model
+
+    def evict(self):
+        """ drops least recently used models until the pool fits in max_size """
+        with self.lock:
+            while len(self.models) > 1 and self.size() > self.max_size:
+                self.models.popitem(last=False)
+
+    def size(self):
+        """ memory of the pooled models in bytes """
+        return sum(size for _, size in self.models.values())
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def keys(self):
+        """ keys of the pooled models, least recently used first """
+        return list(self.models)
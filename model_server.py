@@ -0,0 +1,173 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+import fire
+
+from main import SpeechPipeline
+from parallel_pipeline import set_num_threads
+from result_cache import parse_size
+
+#default location of the server socket
+SOCKET_PATH = '/tmp/speech_pipeline.sock'
+
+
+def _send(connection, event):
+    """ writes one event to the socket as a line of json """
+    connection.sendall((json.dumps(event, default=str) + '\n').encode())
+
+
+def submit_job(socket_path, params):
+    """ sends a job to a running model server and yields its events as they arrive.
+    Events are dictionaries with an 'event' key: 'queued', 'started', 'output' (one per
+    saved file, with its path and number of segments), then 'done', 'error' or 'rejected'.
+
+    Parameters
+    -----------
+    socket_path : string
+        path to the unix socket of the server
+    params : dictionary
+        arguments for SpeechPipeline, with absolute paths
+
+    Yields
+    -----------
+    event : dictionary
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        _send(connection, {'params': params})
+        with connection.makefile('r') as events:
+            for line in events:
+                event = json.loads(line)
+                yield event
+                if event['event'] in ['done', 'error', 'rejected']:
+                    return
+
+
+class ModelServer(object):
+    """
+    """
+    def __init__(self, socket_path=SOCKET_PATH, max_jobs=1, max_queue=16, model_size='base', use_gpu=False,
+        precision='fp32', num_threads=None, preload_diarization=False, embedding_backend='pyannote', preload_languages=(),
+        alignment_pool_size='4GB'):
+        """ long lived process that keeps the SpeechPipeline models loaded and runs
+        jobs sent over a unix socket by `main.py pipeline --server <socket_path>`.
+
+        Jobs run in their own threads. Up to max_jobs run at the same time, sharing
+        one lock around model inference so only decoding, clustering and writing
+        overlap. Up to max_queue further jobs wait, beyond that jobs are rejected.
+
+        Parameters
+        -----------
+        socket_path : string
+            path of the unix socket to listen on
+        max_jobs : int, default 1
+            number of jobs running at the same time
+        max_queue : int, default 16
+            number of jobs waiting for a free slot before new jobs are rejected
+        model_size : string, default 'base'
+            whisper model loaded at startup
+        use_gpu : boolean, default False
+            loads models onto gpu if available
+        precision : string, default 'fp32'
+            precision of the whisper model loaded at startup, 'fp32' or 'int8'
+        num_threads : int, optional
+            number of torch threads of the server, shared by all jobs
+        preload_diarization : boolean, default False
+            if True, also load the speaker embedding model at startup
+        embedding_backend : string, default 'pyannote'
+            backend of the preloaded speaker embedding model, see EMBEDDING_BACKENDS in main.py
+        preload_languages : tuple of strings
+            languages whose word alignment models are loaded at startup
+        alignment_pool_size : int or string, default '4GB'
+            memory limit of the word alignment models kept loaded, the least recently
+            used languages are dropped beyond it
+        """
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.max_queue = max_queue
+
+        if num_threads is not None:
+            set_num_threads(num_threads)
+
+        #models are memoized by the SpeechPipeline loaders, every job reuses them
+        SpeechPipeline.load_whisper_model(model_size=model_size, use_gpu=use_gpu, precision=precision)
+        if preload_diarization:
+            SpeechPipeline.load_diarization_model(use_gpu=use_gpu, backend=embedding_backend)
+        SpeechPipeline.alignment_models.max_size = parse_size(alignment_pool_size)
+        for language in ([preload_languages] if isinstance(preload_languages, str) else preload_languages):
+            SpeechPipeline.load_alignment_model(language, use_gpu=use_gpu)
+
+        self.slots = threading.Semaphore(max_jobs)
+        self.model_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = 0
+
+    def run_job(self, connection, params):
+        """ runs one job and streams its events to connection """
+        with self.pending_lock:
+            if self.pending >= self.max_jobs + self.max_queue:
+                _send(connection, {'event': 'rejected', 'error': 'queue is full'})
+                return
+            self.pending += 1
+            position = max(0, self.pending - self.max_jobs)
+        try:
+            _send(connection, {'event': 'queued', 'position': position})
+            with self.slots:
+                _send(connection, {'event': 'started'})
+                start = time.perf_counter()
+                try:
+                    #one pipeline per job, all sharing the models loaded by this server
+                    #the thread count and alignment pool are the server's, not the client's
+                    params = dict(params, workers=1, server=None, num_threads=None, alignment_pool_size=None)
+                    pipeline = SpeechPipeline(**params)
+                    pipeline.model_lock = self.model_lock
+                    pipeline.on_output = lambda path, segments: _send(connection,
+                        {'event': 'output', 'path': path, 'segments': len(segments)})
+                    pipeline.pipeline()
+                except Exception:
+                    _send(connection, {'event': 'error', 'error': traceback.format_exc()})
+                else:
+                    _send(connection, {'event': 'done', 'seconds': round(time.perf_counter() - start, 3)})
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+
+    def serve(self):
+        """ listens on the socket until interrupted """
+        server = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    server.run_job(self.connection, request['params'])
+                except (BrokenPipeError, ConnectionResetError):
+                    #client went away, the job (if it started) has still run
+                    pass
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, JobHandler) as unix_server:
+            unix_server.daemon_threads = True
+            print('### MODEL SERVER LISTENING ON', self.socket_path, '###')
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os.remove(self.socket_path)
+        return
+
+
+if __name__ == '__main__':
+    """
+    starts the server, e.g.
+    python3 model_server.py --socket_path /tmp/speech_pipeline.sock --max_jobs 2 serve
+    """
+    fire.Fire(ModelServer)
@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import traceback
+
+#SpeechPipeline owned by this worker process, created once by _init_worker
+_worker_pipeline = None
+
+
+def threads_per_worker(workers):
+    """ splits the cores between worker processes so torch intra-op threads
+    of different workers do not oversubscribe the machine
+
+    Parameters
+    -----------
+    workers : int
+        number of worker processes
+
+    Returns
+    -----------
+    num_threads : int
+    """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def set_num_threads(num_threads):
+    """ limits the intra-op threads of torch (and OpenMP/MKL) to num_threads and the
+    inter-op threads to one. Has the most effect before torch is first imported.
+
+    Parameters
+    -----------
+    num_threads : int
+        number of threads used by one model call
+    """
+    #set before torch is imported so OpenMP/MKL pick it up
+    for name in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[name] = str(num_threads)
+
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        #already set, only possible before the first parallel op
+        pass
+
+
+def _init_worker(pipeline_kwargs, num_threads):
+    """ runs once in every worker process: limits threads and loads the models """
+    global _worker_pipeline
+
+    set_num_threads(num_threads)
+
+    #every worker keeps its own totals, so it needs its own prometheus file
+    if pipeline_kwargs.get('prometheus_path') is not None:
+        root, ext = os.path.splitext(pipeline_kwargs['prometheus_path'])
+        pipeline_kwargs = dict(pipeline_kwargs, prometheus_path=root + '_' + str(os.getpid()) + ext)
+
+    from main import SpeechPipeline
+    _worker_pipeline = SpeechPipeline(**pipeline_kwargs)
+
+
+def _process_file(file_path):
+    """ processes one file in a worker, returns (file_path, error message or None) """
+    try:
+        _worker_pipeline.process_file(file_path)
+        return file_path, None
+    except Exception:
+        return file_path, traceback.format_exc()
+
+
+def run_parallel(pipeline_kwargs, files, workers, verbose=True):
+    """ processes files with a pool of worker processes. Each worker loads the
+    models once and takes the next file from a shared queue as soon as it is free.
+    Every worker runs SpeechPipeline.process_file, so outputs match a serial run.
+
+    Parameters
+    -----------
+    pipeline_kwargs : dictionary
+        arguments used to create the SpeechPipeline in every worker
+    files : list of strings
+        paths to the audio files
+    workers : int
+        number of worker processes
+    verbose : boolean, default True
+        prints updates to console about finished files
+
+    Returns
+    -----------
+    failed : dictionary
+        file path -> traceback for every file that raised an error
+    """
+    #an explicit num_threads wins over the even split of the cores
+    num_threads = pipeline_kwargs.get('num_threads') or threads_per_worker(workers)
+    if verbose:
+        print('#### Processing', len(files), 'files with', workers, 'workers,', num_threads, 'threads each ####')
+
+    failed = {}
+    #spawn so workers do not inherit torch/OpenMP state from the parent
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker, initargs=(pipeline_kwargs, num_threads)) as pool:
+        for file_path, error in pool.imap_unordered(_process_file, files, chunksize=1):
+            if error is not None:
+                failed[file_path] = error
+                if verbose:
+                    print('#### Failed', file_path, '####')
+                    print(error)
+            elif verbose:
+                print('#### Finished', file_path, '####')
+    return failed
@@ -1,12 +1,235 @@
-from scipy.io import wavfile
+#from scipy.io import wavfile
 #import noisereduce as nr
 import subprocess
 
+import hashlib
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from instrumentation import Instrumentation
+
+#sample rate expected by the whisper, speechbrain and wav2vec2 models
+SAMPLE_RATE = 16000
+
+#(wav format tag, bits per sample) -> (numpy dtype, scale to [-1, 1])
+WAV_SAMPLE_TYPES = {
+	(1, 16): ('<i2', 1.0 / 32768.0),
+	(1, 32): ('<i4', 1.0 / 2147483648.0),
+	(3, 32): ('<f4', 1.0),
+}
+
+
+def frame_features(samples, frame_length):
+	""" log energy and zero crossing rate of consecutive frames, a trailing partial frame is dropped
+
+	Parameters
+	-----------
+	samples : numpy array
+		float32 samples
+	frame_length : int
+		samples per frame
+
+	Returns
+	-----------
+	energy : numpy array
+		mean power of every frame in dB
+	zero_crossings : numpy array
+		fraction of sign changes between consecutive samples of every frame
+	"""
+	num_frames = len(samples) // frame_length
+	frames = np.asarray(samples[:num_frames * frame_length], dtype=np.float32).reshape(num_frames, frame_length)
+	energy = 10 * np.log10(np.mean(np.square(frames, dtype=np.float64), axis=1) + 1e-10)
+	signs = np.signbit(frames)
+	zero_crossings = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / float(frame_length)
+	return energy, zero_crossings
+
+
+def merge_runs(starts, ends, min_gap):
+	""" merges sorted runs [start, end) separated by fewer than min_gap, overlapping runs included
+
+	Returns
+	-----------
+	starts, ends : numpy arrays
+	"""
+	if len(starts) == 0:
+		return starts, ends
+	#a run is merged into the previous one if the gap between them is too short
+	merge = np.concatenate([[False], starts[1:] - ends[:-1] < min_gap])
+	first = np.flatnonzero(~merge)
+	return starts[first], np.maximum.reduceat(ends, first)
+
+
+def detect_speech(audio_file, frame_seconds=0.03, energy_margin=10.0, min_energy=-55.0, unvoiced_margin=6.0,
+	zcr_threshold=0.25, min_speech=0.25, min_silence=0.3, padding=0.2, window=60.0):
+	""" finds the speech regions of an audio file from frame energy and zero crossings.
+	A frame is speech if it is energy_margin dB above the noise floor (the 10th percentile
+	of the frame energies, and at least min_energy), or, for unvoiced consonants, if it is
+	less than unvoiced_margin dB below that and crosses zero often. Regions are merged
+	across pauses shorter than min_silence, regions shorter than min_speech dropped and
+	the others padded.
+	The audio is read window by window, memory does not grow with the file length.
+
+	Parameters
+	-----------
+	audio_file : AudioFile object
+	frame_seconds : float, default 0.03
+		length of the analysis frames
+	energy_margin : float, default 10.0
+		dB above the noise floor for voiced speech
+	min_energy : float, default -55.0
+		lowest dB threshold, so digital silence does not make noise look like speech
+	unvoiced_margin : float, default 6.0
+		dB below the threshold still accepted for frames with a high zero crossing rate
+	zcr_threshold : float, default 0.25
+		zero crossing rate of unvoiced speech
+	min_speech : float, default 0.25
+		shortest region kept, in seconds
+	min_silence : float, default 0.3
+		shortest pause between two regions, in seconds
+	padding : float, default 0.2
+		seconds added before and after every region, so word onsets and endings are kept
+	window : float, default 60.0
+		seconds of audio read at a time
+
+	Returns
+	-----------
+	regions : numpy array
+		(number of regions, 2) first and last (exclusive) sample of every region
+	"""
+	frame_length = int(frame_seconds * SAMPLE_RATE)
+	#whole frames per window, so no frame straddles two windows. Half a sample is added
+	#so stream rounds down to exactly that many samples.
+	window_samples = max(1, int(window * SAMPLE_RATE) // frame_length) * frame_length
+	window = (window_samples + 0.5) / SAMPLE_RATE
+
+	features, num_samples = [], 0
+	for _, samples in audio_file.stream(window):
+		features.append(frame_features(samples, frame_length))
+		num_samples += len(samples)
+	if num_samples < frame_length:
+		return np.zeros((0, 2), dtype=np.int64)
+	energy = np.concatenate([energy for energy, _ in features])
+	zero_crossings = np.concatenate([zero_crossings for _, zero_crossings in features])
+
+	threshold = max(np.percentile(energy, 10) + energy_margin, min_energy)
+	speech = (energy > threshold) | ((energy > threshold - unvoiced_margin) & (zero_crossings > zcr_threshold))
+
+	#first and last (exclusive) frame of every run of speech frames
+	changes = np.flatnonzero(np.diff(np.concatenate([[False], speech, [False]]).astype(np.int8)))
+	starts, ends = changes[::2], changes[1::2]
+
+	#pauses shorter than min_silence (e.g. between syllables) are bridged before short regions are dropped
+	starts, ends = merge_runs(starts, ends, int(round(min_silence / frame_seconds)))
+	keep = (ends - starts) * frame_seconds >= min_speech
+	pad = int(round(padding / frame_seconds))
+	starts, ends = merge_runs(np.maximum(starts[keep] - pad, 0), np.minimum(ends[keep] + pad, len(speech)), 1)
+
+	regions = np.stack([starts * frame_length, np.minimum(ends * frame_length, num_samples)], axis=1)
+	return regions.astype(np.int64).reshape(-1, 2)
+
+
+class WavReader(object):
+	"""
+	"""
+	def __init__(self, path):
+		""" random access reader over the PCM data chunk of a wav file.
+		The samples are memory mapped, so only the pages that are sliced are read
+		and resident memory does not grow with the length of the recording.
+
+		Parameters
+		-----------
+		path : string
+			path to a PCM (16/32 bit integer or 32 bit float) wav file
+		"""
+		self.path = path
+
+		with open(path, 'rb') as f:
+			riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+			if riff != b'RIFF' or wave_id != b'WAVE':
+				raise ValueError(path + ' is not a RIFF/WAVE file')
+
+			fmt = None
+			while True:
+				header = f.read(8)
+				if len(header) < 8:
+					raise ValueError('no data chunk in ' + path)
+				chunk_id, chunk_size = struct.unpack('<4sI', header)
+				if chunk_id == b'data':
+					data_offset = f.tell()
+					break
+				elif chunk_id == b'fmt ':
+					fmt = f.read(chunk_size)
+					f.seek(chunk_size & 1, 1)
+				else:
+					#chunks are padded to an even number of bytes
+					f.seek(chunk_size + (chunk_size & 1), 1)
+
+		if fmt is None:
+			raise ValueError('no fmt chunk in ' + path)
+
+		format_tag, channels, rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+		if format_tag == 0xFFFE:
+			#WAVE_FORMAT_EXTENSIBLE, the real format is the start of the sub format GUID
+			format_tag = struct.unpack('<H', fmt[24:26])[0]
+		if (format_tag, bits) not in WAV_SAMPLE_TYPES:
+			raise ValueError('unsupported wav sample format in ' + path)
+		dtype, self.scale = WAV_SAMPLE_TYPES[(format_tag, bits)]
+
+		#ffmpeg writes a placeholder data size when it streams, trust the file size instead
+		data_size = min(chunk_size, os.path.getsize(path) - data_offset)
+
+		#header metadata, read once
+		self.sample_rate = rate
+		self.num_channels = channels
+		self.num_frames = data_size // block_align
+		self.duration = self.num_frames / float(rate)
+
+		if self.num_frames > 0:
+			self.samples = np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=(self.num_frames, channels))
+		else:
+			self.samples = np.zeros((0, channels), dtype=dtype)
+
+
+	def read(self, first=0, last=None):
+		""" converts the frames between first and last to float32 mono samples.
+		Only this slice of the file is read from disk.
+
+		Parameters
+		-----------
+		first : int
+			first frame
+		last : int, optional
+			frame after the last one, defaults to the end of the file
+
+		Returns
+		-----------
+		samples : numpy array
+			float32 samples in the range [-1, 1]
+		"""
+		block = self.samples[first:last]
+		if self.num_channels > 1:
+			samples = block.mean(axis=1, dtype=np.float32)
+		else:
+			samples = block[:, 0].astype(np.float32)
+		if self.scale != 1.0:
+			samples *= self.scale
+		return samples
+
+
+	def crop(self, start, end):
+		""" float32 mono samples between start and end seconds """
+		first = min(self.num_frames, max(0, int(round(start * self.sample_rate))))
+		last = min(self.num_frames, max(first, int(round(end * self.sample_rate))))
+		return self.read(first, last)
+
 
 class AudioFile(object):
 	"""
 	"""
-	def __init__(self, PATH, language, num_speakers):
+	def __init__(self, PATH, language, num_speakers, use_mmap=False, wav_dir=None, instrumentation=None):
 		"""
 
 		Parameters
@@ -17,14 +240,258 @@ class AudioFile(object):
 			two digit code indicating language of audio file
 		num_speakers : int
 			number of speakers in audio file
+		use_mmap : boolean, default False
+			if True, memory map a 16 kHz wav instead of decoding the whole file into memory.
+			Other inputs are converted to a wav in wav_dir first.
+		wav_dir : string, optional
+			directory converted wav files are written to, defaults to the system temp directory
+		instrumentation : Instrumentation object, optional
+			measures the ffmpeg decoding and conversion, see instrumentation.py
 		"""
 		self.path = PATH
 		self.language = language
 		self.num_speakers = num_speakers
+		self.use_mmap = use_mmap
+		self.wav_dir = wav_dir
+		self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+
+		#decoded 16 kHz mono float32 samples, filled on first use by load_audio
+		self._audio = None
+		#memory mapped wav, opened on first use by open_wav
+		self._reader = None
+		#wav written by convert_to_wav, removed by close
+		self.wav_path = None
+		#sha256 of the file content, filled on first use by content_hash
+		self._content_hash = None
+
+
+	def content_hash(self, block_size=1 << 20):
+		""" sha256 of the content of the audio file, identifies the audio independent of its path
+
+		Return
+		--------
+		digest: string
+		"""
+		if self._content_hash is None:
+			digest = hashlib.sha256()
+			with open(self.path, 'rb') as f:
+				for block in iter(lambda: f.read(block_size), b''):
+					digest.update(block)
+			self._content_hash = digest.hexdigest()
+		return self._content_hash
+
+
+	def load_audio(self, verbose=False):
+		""" decodes the audio file once with ffmpeg into 16 kHz mono float32 samples.
+		Samples are read straight from an ffmpeg pipe, no wav file is written to disk.
+		Every later call returns the same array.
+
+		Parameters
+		--------
+		verbose: boolean, default False
+			prints updates on decoding file
+
+		Return
+		--------
+		audio: numpy array
+			float32 samples in the range [-1, 1] at SAMPLE_RATE
+		"""
+		if self._audio is None:
+			if verbose:
+				print('#### Decoding', self.path, '####')
+
+			with self.instrumentation.measure('ffmpeg_decode', self):
+				try:
+					out = subprocess.run(self._decode_command(), capture_output=True, check=True).stdout
+				except subprocess.CalledProcessError as e:
+					raise RuntimeError('Failed to decode ' + self.path + ': ' + e.stderr.decode(errors='ignore')) from e
+
+			audio = np.frombuffer(out, np.int16).astype(np.float32)
+			audio /= 32768.0
+			self._audio = audio
+		return self._audio
+
+
+	def _decode_command(self):
+		""" ffmpeg command writing 16 kHz mono 16 bit samples of the file to stdout """
+		return ['ffmpeg', '-nostdin', '-threads', '0', '-loglevel', 'error', '-i', self.path,
+			'-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(SAMPLE_RATE), '-']
+
+
+	def stream(self, window):
+		""" yields the audio in consecutive windows of a fixed length. Unless the audio
+		is already decoded or memory mapped, samples are read from an ffmpeg pipe one
+		window at a time, so memory depends on the window and not the file length.
+
+		Parameters
+		--------
+		window: float
+			length of each window in seconds
+
+		Yields
+		--------
+		offset: float
+			start of the window in seconds
+		samples: numpy array
+			float32 samples of the window, the last one may be shorter
+		"""
+		window_samples = max(1, int(window * SAMPLE_RATE))
+
+		if self._audio is not None or self.use_mmap:
+			for first in range(0, self.num_samples, window_samples):
+				yield first / SAMPLE_RATE, self.samples(first, first + window_samples)
+			return
+
+		process = subprocess.Popen(self._decode_command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		first = 0
+		finished = False
+		try:
+			while True:
+				#blocks until a full window is decoded or ffmpeg reaches the end of the file
+				data = process.stdout.read(2 * window_samples)
+				if not data:
+					break
+				samples = np.frombuffer(data, np.int16).astype(np.float32)
+				samples /= 32768.0
+				yield first / SAMPLE_RATE, samples
+				first += len(samples)
+			finished = True
+		finally:
+			process.stdout.close()
+			if not finished:
+				#the consumer stopped early (GeneratorExit or an error), ffmpeg is not needed anymore
+				process.kill()
+			#after the end of the output ffmpeg may take a moment to exit, wait for its exit code
+			error = process.stderr.read().decode(errors='ignore')
+			process.stderr.close()
+			process.wait()
+
+		if process.returncode != 0:
+			raise RuntimeError('Failed to decode ' + self.path + ': ' + error)
+
+
+	def open_wav(self, verbose=False):
+		""" memory maps the PCM data of the audio file. If the file is not already a
+		16 kHz wav it is converted with convert_to_wav first.
+
+		Parameters
+		--------
+		verbose: boolean, default False
+			prints updates on converting file
+
+		Return
+		--------
+		reader: WavReader
+		"""
+		if self._reader is None:
+			reader = None
+			if self.path.lower().endswith('.wav'):
+				try:
+					reader = WavReader(self.path)
+				except ValueError:
+					reader = None
+				if reader is not None and reader.sample_rate != SAMPLE_RATE:
+					reader = None
+
+			if reader is None:
+				reader = WavReader(self.convert_to_wav(verbose=verbose))
+			self._reader = reader
+		return self._reader
+
+
+	@property
+	def audio(self):
+		""" decoded 16 kHz mono float32 samples, shared by every stage.
+		With use_mmap the whole file is converted on every access, stages that only
+		need part of the audio should use crop instead.
+		"""
+		if self.use_mmap:
+			return self.open_wav().read()
+		return self.load_audio()
+
+
+	@property
+	def sample_rate(self):
+		return SAMPLE_RATE
+
+
+	@property
+	def num_samples(self):
+		""" number of samples in the audio """
+		if self.use_mmap:
+			return self.open_wav().num_frames
+		return len(self.load_audio())
+
+
+	@property
+	def duration(self):
+		""" length of the audio in seconds """
+		return self.num_samples / SAMPLE_RATE
+
+
+	def loaded_duration(self):
+		""" duration in seconds if the audio is already decoded or memory mapped, otherwise None.
+		Unlike duration it never decodes the file.
+		"""
+		if self._audio is not None:
+			return len(self._audio) / SAMPLE_RATE
+		if self._reader is not None:
+			return self._reader.num_frames / SAMPLE_RATE
+		return None
+
+
+	def header_duration(self):
+		""" duration in seconds read without decoding the audio: from the decoded or memory
+		mapped audio if there is one, else from the header of a wav file or with ffprobe.
+		Decodes the file only if ffprobe can not tell.
+		"""
+		duration = self.loaded_duration()
+		if duration is not None:
+			return duration
+		try:
+			return WavReader(self.path).duration
+		except (ValueError, struct.error):
+			pass
+		try:
+			out = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+				'default=noprint_wrappers=1:nokey=1', self.path], capture_output=True, check=True).stdout
+			return float(out)
+		except (OSError, ValueError, subprocess.CalledProcessError):
+			return self.duration
+
+
+	def samples(self, first, last):
+		""" float32 samples between sample index first and last.
+		A view of self.audio, or a slice read from the memory mapped wav with use_mmap.
+		"""
+		if self.use_mmap:
+			return self.open_wav().read(first, last)
+		return self.load_audio()[first:last]
+
+
+	def crop(self, start, end):
+		""" returns the samples between start and end
+
+		Parameters
+		--------
+		start : float
+			start of the window in seconds
+		end : float
+			end of the window in seconds, clipped to the end of the audio
+
+		Return
+		--------
+		samples: numpy array
+			view into self.audio, or a slice of the memory mapped wav with use_mmap
+		"""
+		num_samples = self.num_samples
+		first = min(num_samples, max(0, int(round(start * SAMPLE_RATE))))
+		last = min(num_samples, max(first, int(round(end * SAMPLE_RATE))))
+		return self.samples(first, last)
 
 
 	def convert_to_wav(self, verbose=False):
-		""" uses ffmpeg to convert audio to wav format
+		""" uses ffmpeg to convert audio to a 16 kHz mono 16 bit wav file in self.wav_dir
 
 		Parameters
 		--------
@@ -39,11 +506,189 @@ class AudioFile(object):
 		if verbose:
 			print('#### Converting', self.path, 'to WAV file ####')
 
-		wav_path  = self.path[:-4] + '.wav'
-		subprocess.call(['ffmpeg', '-i', self.path, wav_path, '-y'])
-		self.path = wav_path
+		wav_dir = self.wav_dir if self.wav_dir is not None else tempfile.gettempdir()
+		#files with the same name in different directories get different wav files
+		path_hash = hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:12]
+		wav_path = os.path.join(wav_dir, os.path.basename(self.path)[:-4] + '_' + path_hash + '.wav')
+
+		cmd = ['ffmpeg', '-nostdin', '-y', '-i', self.path,
+			'-ac', '1', '-ar', str(SAMPLE_RATE), '-acodec', 'pcm_s16le', wav_path]
+		with self.instrumentation.measure('ffmpeg_convert', self):
+			try:
+				subprocess.run(cmd, capture_output=True, check=True)
+			except subprocess.CalledProcessError as e:
+				raise RuntimeError('Failed to convert ' + self.path + ': ' + e.stderr.decode(errors='ignore')) from e
+
+		self.wav_path = wav_path
 		return wav_path
 
+
+	def close(self):
+		""" releases the decoded audio and memory map, and removes the converted wav file """
+		self._audio = None
+		self._reader = None
+		if self.wav_path is not None:
+			if os.path.exists(self.wav_path):
+				os.remove(self.wav_path)
+			self.wav_path = None
+
+
+class SpeechAudioFile(object):
+	"""
+	"""
+	def __init__(self, audio_file, regions):
+		""" the speech regions of an audio file joined into one shorter recording. Has the
+		methods of AudioFile the model stages use, so transcription, alignment and
+		diarization run on speech only, and maps their timestamps back to the time of
+		the original file. Samples are read from the original audio (or its memory map)
+		when a stage asks for them, nothing is copied up front.
+
+		Parameters
+		-----------
+		audio_file : AudioFile object
+			the original audio, closed with this object
+		regions : numpy array
+			(number of regions, 2) first and last sample of every speech region, from detect_speech
+		"""
+		self.source = audio_file
+		self.path = audio_file.path
+		self.language = audio_file.language
+		self.num_speakers = audio_file.num_speakers
+		self.regions = np.asarray(regions, dtype=np.int64).reshape(-1, 2)
+
+		#first sample of every region in the joined audio, and the total length
+		lengths = self.regions[:, 1] - self.regions[:, 0]
+		self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+	def content_hash(self):
+		""" sha256 of the original file and the regions, cached results of the joined
+		audio never mix with those of the whole file
+		"""
+		digest = hashlib.sha256(self.source.content_hash().encode())
+		digest.update(self.regions.tobytes())
+		return digest.hexdigest()
+
+
+	@property
+	def sample_rate(self):
+		return SAMPLE_RATE
+
+
+	@property
+	def num_samples(self):
+		""" number of speech samples """
+		return int(self.offsets[-1])
+
+
+	@property
+	def duration(self):
+		""" seconds of speech """
+		return self.num_samples / SAMPLE_RATE
+
+
+	def loaded_duration(self):
+		""" seconds of speech, known without decoding """
+		return self.duration
+
+
+	def header_duration(self):
+		""" seconds of speech, known without decoding """
+		return self.duration
+
+
+	def samples(self, first, last):
+		""" float32 samples between sample index first and last of the joined audio """
+		first = min(max(0, first), self.num_samples)
+		last = min(max(first, last), self.num_samples)
+		#regions overlapping [first, last)
+		i = np.searchsorted(self.offsets, first, side='right') - 1
+		j = np.searchsorted(self.offsets, last, side='left')
+		pieces = []
+		for k in range(i, j):
+			start = self.regions[k, 0] + max(first, self.offsets[k]) - self.offsets[k]
+			end = self.regions[k, 0] + min(last, self.offsets[k + 1]) - self.offsets[k]
+			pieces.append(self.source.samples(int(start), int(end)))
+		if len(pieces) == 1:
+			return pieces[0]
+		return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+
+
+	@property
+	def audio(self):
+		""" all speech samples of the file """
+		return self.samples(0, self.num_samples)
+
+
+	def crop(self, start, end):
+		""" samples between start and end seconds of the joined audio """
+		first = int(round(start * SAMPLE_RATE))
+		return self.samples(first, max(first, int(round(end * SAMPLE_RATE))))
+
+
+	def stream(self, window):
+		""" yields (offset in seconds, samples) of consecutive windows of the joined audio """
+		window_samples = max(1, int(window * SAMPLE_RATE))
+		for first in range(0, self.num_samples, window_samples):
+			yield first / SAMPLE_RATE, self.samples(first, first + window_samples)
+
+
+	def to_original(self, times, side='right'):
+		""" maps times of the joined audio to times of the original file
+
+		Parameters
+		-----------
+		times : array like of floats
+			seconds in the joined audio, NaN stays NaN
+		side : string, default 'right'
+			'right' for start times, 'left' for end times, so a time on the join of two
+			regions maps to the start of the later or the end of the earlier region
+
+		Returns
+		-----------
+		times : numpy array
+			seconds in the original file
+		"""
+		times = np.asarray(times, dtype=np.float64)
+		if len(self.regions) == 0:
+			return times
+		offsets = self.offsets[:-1] / SAMPLE_RATE
+		region = np.clip(np.searchsorted(offsets, times, side=side) - 1, 0, len(self.regions) - 1)
+		return self.regions[region, 0] / SAMPLE_RATE + (times - offsets[region])
+
+
+	def segments_to_original(self, segments):
+		""" copies of segments (and their 'words') with start and end in the time of the original file
+
+		Parameters
+		-----------
+		segments : list of dictionaries
+			with 'start' and 'end' in seconds of the joined audio, either may be missing
+
+		Returns
+		-----------
+		segments : list of dictionaries
+		"""
+		starts = self.to_original([segment.get('start', np.nan) for segment in segments], side='right')
+		ends = self.to_original([segment.get('end', np.nan) for segment in segments], side='left')
+
+		mapped = []
+		for segment, start, end in zip(segments, starts.tolist(), ends.tolist()):
+			segment = dict(segment)
+			if segment.get('start') is not None:
+				segment['start'] = start
+			if segment.get('end') is not None:
+				segment['end'] = end
+			if isinstance(segment.get('words'), list):
+				segment['words'] = self.segments_to_original(segment['words'])
+			mapped.append(segment)
+		return mapped
+
+
+	def close(self):
+		""" closes the original audio """
+		self.source.close()
+
 '''
 	def reducing_noise(self):
 		"""
@@ -0,0 +1,90 @@
+import torch
+
+
+def replace_linear_layers(module):
+    """ replaces subclasses of nn.Linear (e.g. whisper's Linear, which casts its weights
+    to the input dtype) by plain nn.Linear layers sharing the same weights.
+    quantize_dynamic only swaps modules whose type is exactly nn.Linear.
+
+    Parameters
+    -----------
+    module : torch module
+        modified in place
+
+    Returns
+    -----------
+    module : torch module
+    """
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+            linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight = child.weight
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            replace_linear_layers(child)
+    return module
+
+
+class PointwiseConv1d(torch.nn.Module):
+    """
+    """
+    def __init__(self, conv):
+        """ a Conv1d with kernel size 1 computed as a linear layer over the channels,
+        which (unlike Conv1d) dynamic quantization supports
+
+        Parameters
+        -----------
+        conv : torch.nn.Conv1d
+            kernel size 1, stride 1, no padding or groups. Weights are shared.
+        """
+        super().__init__()
+        self.linear = torch.nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight = torch.nn.Parameter(conv.weight.detach()[:, :, 0])
+        self.linear.bias = conv.bias
+
+    def forward(self, x):
+        #(batch, channels, time) -> (batch, time, channels) and back
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def replace_pointwise_convolutions(module):
+    """ replaces Conv1d layers with kernel size 1 by PointwiseConv1d, e.g. the
+    squeeze-excitation, res2net and pooling convolutions of ECAPA-TDNN
+
+    Parameters
+    -----------
+    module : torch module
+        modified in place
+
+    Returns
+    -----------
+    module : torch module
+    """
+    for name, child in module.named_children():
+        if (type(child) is torch.nn.Conv1d and child.kernel_size == (1,) and child.stride == (1,)
+                and child.groups == 1 and child.padding in [(0,), 'valid', 'same']):
+            setattr(module, name, PointwiseConv1d(child))
+        else:
+            replace_pointwise_convolutions(child)
+    return module
+
+
+def quantize_dynamic_int8(model):
+    """ int8 dynamic quantization of the linear layers (and convolutions with kernel
+    size 1) of a model for cpu inference. Weights are stored as int8 and activations
+    are quantized on the fly, the other layers (wider convolutions, embeddings, layer
+    norms) stay in float32.
+
+    Parameters
+    -----------
+    model : torch module
+        moved to the cpu and modified in place
+
+    Returns
+    -----------
+    model : torch module
+        quantized model in eval mode
+    """
+    model = replace_pointwise_convolutions(replace_linear_layers(model.cpu().eval()))
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
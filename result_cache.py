@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import fire
+
+#bump when the layout of cached results changes, old entries are then never hit
+CACHE_VERSION = 1
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def parse_size(size):
+    """ converts a size like 500MB or 10GB (or a number of bytes) to bytes
+
+    Parameters
+    -----------
+    size : int or string
+
+    Returns
+    -----------
+    size : int
+        number of bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(float(text))
+
+
+class ResultCache(object):
+    """
+    """
+    def __init__(self, cache_dir='.cache/speech_pipeline', max_size='10GB'):
+        """ content addressed on-disk cache for the results of pipeline stages.
+        Entries are keyed by a hash of the audio content, the stage and its options,
+        so unchanged inputs are never recomputed. The least recently used entries
+        are removed when the cache grows past max_size.
+
+        Parameters
+        -----------
+        cache_dir : string, default '.cache/speech_pipeline'
+            directory the results are stored in
+        max_size : int or string, default '10GB'
+            size limit of the cache, e.g. 500MB or 10GB
+        """
+        self.cache_dir = cache_dir
+        self.max_size = parse_size(max_size)
+        #total size of the cache, computed on first write
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(content_hash, stage, **options):
+        """ cache key of a stage result
+
+        Parameters
+        -----------
+        content_hash : string
+            hash of the audio content, see AudioFile.content_hash
+        stage : string
+            name of the stage, e.g. 'transcribe'
+        options : keyword arguments
+            everything else the result depends on (model, language, task ...)
+
+        Returns
+        -----------
+        key : string
+        """
+        description = json.dumps({'version': CACHE_VERSION, 'audio': content_hash, 'stage': stage, 'options': options},
+            sort_keys=True, default=str)
+        return stage + '-' + hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        stage, digest = key.rsplit('-', 1)
+        return os.path.join(self.cache_dir, stage, digest[:2], digest + '.pkl')
+
+    def get(self, key, default=None):
+        """ cached value of key, or default if it is not in the cache """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return default
+        except (EOFError, pickle.UnpicklingError):
+            #partially written or corrupt entry
+            self._remove(path)
+            return default
+
+        #the modification time is the last use, for LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """ stores value under key, then evicts old entries if the cache is too large """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        #write to a temp file and rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self.entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_size:
+            #evict down to 90% of the limit so the next writes do not each rescan the cache
+            self.prune(max_size=int(self.max_size * 0.9))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """ (path, size in bytes, last use) of every entry in the cache """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.pkl'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def stats(self):
+        """ number of entries and bytes used, in total and per stage
+
+        Returns
+        -----------
+        stats : dictionary
+        """
+        stages = {}
+        total = 0
+        entries = self.entries()
+        for path, size, _ in entries:
+            stage = os.path.relpath(path, self.cache_dir).split(os.sep)[0]
+            count, used = stages.get(stage, (0, 0))
+            stages[stage] = (count + 1, used + size)
+            total += size
+
+        return {'cache_dir': self.cache_dir, 'entries': len(entries), 'size': total, 'max_size': self.max_size,
+            'stages': {stage: {'entries': count, 'size': used} for stage, (count, used) in sorted(stages.items())}}
+
+    def prune(self, max_size=None):
+        """ removes the least recently used entries until the cache fits in max_size
+
+        Parameters
+        -----------
+        max_size : int or string, optional
+            defaults to the size limit of the cache
+
+        Returns
+        -----------
+        removed : int
+            number of removed entries
+        """
+        max_size = self.max_size if max_size is None else parse_size(max_size)
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+
+        removed = 0
+        for path, size, _ in entries:
+            if total <= max_size:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+
+        self._size = total
+        return removed
+
+    def clear(self):
+        """ removes every entry from the cache """
+        return self.prune(max_size=0)
+
+
+if __name__ == '__main__':
+    """
+    command line interface to inspect and prune the cache, e.g.
+    python3 result_cache.py --cache_dir .cache/speech_pipeline stats
+    """
+    fire.Fire(ResultCache)
@@ -0,0 +1,152 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+#states of a file or stage in the manifest
+STARTED, DONE, FAILED = 'started', 'done', 'failed'
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """ opens a temporary file next to path and renames it to path when the with block
+    finishes, so readers (and reruns after a crash) never see a half written file.
+    The temporary file is removed if the block raises.
+
+    Parameters
+    -----------
+    path : string
+        final path of the file
+    mode : string, default 'w'
+        'w' or 'wb'
+    kwargs : keyword arguments
+        passed to open, e.g. newline=''
+
+    Yields
+    -----------
+    f : file object
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def options_digest(options):
+    """ sha256 of the options a run's outputs depend on """
+    return hashlib.sha256(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RunManifest(object):
+    """
+    """
+    def __init__(self, path):
+        """ append-only record of the progress of a run, one json line per event.
+        Every input file gets a 'started' line with its content hash and the options
+        digest, a line per stage as it finishes or fails, and a final 'done' line with
+        its outputs (or 'failed' with the error). A rerun with resume skips files whose
+        last 'done' line matches their current content and the current options.
+
+        Lines are appended with a single write, so worker processes share the file.
+
+        Parameters
+        -----------
+        path : string
+            path of the manifest file, created if needed
+        """
+        self.path = path
+        #last event of every file, and of every (file, stage)
+        self.files = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self, repair=False):
+        """ reads the events written so far, ignoring a line cut off by a crash.
+        With repair the cut off line is removed from the file, only safe while
+        no other process is appending.
+        """
+        self.files, self.stages = {}, {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+' if repair else 'rb') as f:
+            data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            if repair and len(complete) < len(data):
+                #later events must not be appended to the cut off line
+                f.truncate(len(complete))
+        for line in complete.decode().splitlines():
+            self._apply(json.loads(line))
+
+    def _apply(self, event):
+        if event['stage'] == 'file':
+            self.files[event['file']] = event
+        else:
+            self.stages[(event['file'], event['stage'])] = event
+
+    def record(self, file, stage, state, **fields):
+        """ appends an event
+
+        Parameters
+        -----------
+        file : string
+            path of the input file
+        stage : string
+            'file' for the whole file, otherwise the name of the stage
+        state : string
+            STARTED, DONE or FAILED
+        fields : keyword arguments
+            e.g. content_hash, options, outputs or error. Stage events without them
+            take the content hash and options of the file's 'started' event.
+        """
+        with self.lock:
+            started = self.files.get(file, {})
+            event = {'file': file, 'stage': stage, 'state': state,
+                'content_hash': started.get('content_hash'), 'options': started.get('options'), 'time': time.time()}
+            event.update(fields)
+            self._apply(event)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(event, default=str) + '\n')
+        return event
+
+    def stage_hook(self, record):
+        """ instrumentation hook recording every finished stage of an input file """
+        if record.get('file') is not None and record['file'] in self.files:
+            self.record(record['file'], record['stage'], DONE if record['error'] is None else FAILED,
+                error=record['error'], cached=record.get('cached'))
+
+    def is_complete(self, file, content_hash, options):
+        """ True if the last run of file finished with the same content and options,
+        and its outputs still exist
+
+        Parameters
+        -----------
+        file : string
+            path of the input file
+        content_hash : string
+            current sha256 of the file
+        options : string
+            current options digest
+        """
+        event = self.files.get(file)
+        if event is None or event['state'] != DONE:
+            return False
+        if event['content_hash'] != content_hash or event['options'] != options:
+            return False
+        return all(os.path.exists(output) for output in event.get('outputs', []))
+
+    def summary(self):
+        """ number of files in every state """
+        counts = {}
+        for event in self.files.values():
+            counts[event['state']] = counts.get(event['state'], 0) + 1
+        return counts
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def _times(segments):
+    """ start and end of every segment as float arrays, NaN where missing """
+    starts = np.array([segment.get('start', np.nan) for segment in segments], dtype=np.float64).reshape(-1)
+    ends = np.array([segment.get('end', np.nan) for segment in segments], dtype=np.float64).reshape(-1)
+    return starts, ends
+
+
+def assign_speakers(diarized_segments, segments):
+    """ labels segments with the speaker of the diarized segments they overlap most, e.g.
+    translated segments with the speakers of the diarized transcript of the same audio.
+    Overlaps are summed per speaker. Segments overlapping no diarized segment take the
+    speaker of the nearest one.
+
+    The diarized segments are sorted by start with a running maximum of their ends, so the
+    diarized segments overlapping a segment are one contiguous range found with two binary
+    searches, and all overlaps are computed in one vectorized pass.
+
+    Parameters
+    -----------
+    diarized_segments : list of dictionaries
+        with 'start', 'end' and 'speaker'
+    segments : list of dictionaries
+        with 'start' and 'end'
+
+    Returns
+    -----------
+    segments : list of dictionaries
+        copies of segments with a 'speaker' label
+    """
+    segments = [dict(segment) for segment in segments]
+    diarized_segments = [segment for segment in diarized_segments if segment.get('speaker') is not None]
+    if not segments or not diarized_segments:
+        return segments
+
+    ref_starts, ref_ends = _times(diarized_segments)
+    order = np.argsort(ref_starts, kind='stable')
+    ref_starts, ref_ends = ref_starts[order], ref_ends[order]
+    speakers, ref_labels = np.unique([str(diarized_segments[i]['speaker']) for i in order], return_inverse=True)
+
+    #running maximum of the ends, and the diarized segment it comes from
+    max_ends = np.maximum.accumulate(ref_ends)
+    index = np.arange(len(ref_ends))
+    max_end_index = np.maximum.accumulate(np.where(ref_ends >= max_ends, index, 0))
+
+    starts, ends = _times(segments)
+    #diarized segments [first, last) start before the segment ends, and all before first end before it starts
+    first = np.searchsorted(max_ends, starts, side='right')
+    last = np.searchsorted(ref_starts, ends, side='left')
+    counts = np.maximum(last - first, 0)
+
+    #one row per (segment, candidate diarized segment) pair
+    pair_segment = np.repeat(np.arange(len(segments)), counts)
+    pair_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_ref = first[pair_segment] + pair_offsets
+    overlap = np.minimum(ends[pair_segment], ref_ends[pair_ref]) - np.maximum(starts[pair_segment], ref_starts[pair_ref])
+    overlap = np.maximum(np.nan_to_num(overlap), 0.0)
+
+    #overlap of every segment with every speaker
+    totals = np.bincount(pair_segment * len(speakers) + ref_labels[pair_ref], weights=overlap,
+        minlength=len(segments) * len(speakers)).reshape(len(segments), len(speakers))
+    labels = totals.argmax(axis=1)
+
+    #no overlap: the diarized segment ending last before the segment, or starting first after it
+    alone = totals.max(axis=1) <= 0
+    if alone.any():
+        before = max_end_index[np.clip(first[alone] - 1, 0, None)]
+        after = np.minimum(last[alone], len(ref_starts) - 1)
+        gap_before = np.where(first[alone] > 0, starts[alone] - ref_ends[before], np.inf)
+        gap_after = np.where(last[alone] < len(ref_starts), ref_starts[after] - ends[alone], np.inf)
+        labels[alone] = np.where(gap_before <= gap_after, ref_labels[before], ref_labels[after])
+
+    for segment, label in zip(segments, labels.tolist()):
+        segment['speaker'] = str(speakers[label])
+    return segments
@@ -0,0 +1,140 @@
+import numpy as np
+
+#sklearn and scipy are imported by the backends when they run, so looking up
+#CLUSTERING_BACKENDS (e.g. to validate arguments) stays cheap
+
+
+class AgglomerativeBackend(object):
+    """
+    """
+    def __init__(self):
+        """ exact agglomerative clustering of the dense embedding matrix.
+        Time and memory grow quadratically with the number of segments.
+        """
+
+    def __call__(self, embeddings, num_speakers):
+        """ cluster segment embeddings into speakers
+
+        Parameters
+        -----------
+        embeddings : numpy array
+            (number of segments, dimension) without NaNs
+        num_speakers : int
+            number of clusters
+
+        Returns
+        -----------
+        labels : numpy array
+            cluster index of every segment
+        """
+        from sklearn.cluster import AgglomerativeClustering
+
+        if len(embeddings) <= num_speakers:
+            #every segment is its own speaker
+            return np.arange(len(embeddings))
+        return AgglomerativeClustering(num_speakers).fit(embeddings).labels_
+
+
+class KNNGraphBackend(AgglomerativeBackend):
+    """
+    """
+    def __init__(self, n_neighbors=10, exact_below=2000):
+        """ ward clustering restricted to a k-nearest-neighbour connectivity graph.
+        Merges are only considered along graph edges, so memory grows with
+        n_neighbors times the number of segments instead of its square.
+
+        Parameters
+        -----------
+        n_neighbors : int, default 10
+            neighbours per segment in the connectivity graph
+        exact_below : int, default 2000
+            inputs with fewer segments use exact clustering, so labels on small
+            inputs are the same as AgglomerativeBackend
+        """
+        self.n_neighbors = n_neighbors
+        self.exact_below = exact_below
+
+    def __call__(self, embeddings, num_speakers):
+        if len(embeddings) < self.exact_below or len(embeddings) <= self.n_neighbors:
+            return super().__call__(embeddings, num_speakers)
+
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        from sklearn.cluster import AgglomerativeClustering
+        from sklearn.neighbors import kneighbors_graph
+
+        connectivity = kneighbors_graph(embeddings, self.n_neighbors, include_self=False)
+        connectivity = connectivity + connectivity.T
+
+        #well separated speakers give disconnected graphs. sklearn would complete the graph
+        #with all pairwise distances between components, instead chain them through one segment each
+        n_components, component = connected_components(connectivity, directed=False)
+        if n_components > 1:
+            _, first = np.unique(component, return_index=True)
+            links = coo_matrix((np.ones(n_components - 1), (first[:-1], first[1:])), shape=connectivity.shape)
+            connectivity = connectivity + links + links.T
+
+        return AgglomerativeClustering(num_speakers, connectivity=connectivity).fit(embeddings).labels_
+
+
+class TwoStageBackend(AgglomerativeBackend):
+    """
+    """
+    def __init__(self, num_centroids=1000, exact_below=2000, random_state=0):
+        """ two stage clustering: segments are summarised by mini-batch k-means
+        centroids, the centroids are clustered into speakers with agglomerative
+        clustering and every segment gets the speaker of its centroid.
+        Time and memory grow linearly with the number of segments.
+
+        Parameters
+        -----------
+        num_centroids : int, default 1000
+            number of k-means centroids in the first stage
+        exact_below : int, default 2000
+            inputs with fewer segments use exact clustering, so labels on small
+            inputs are the same as AgglomerativeBackend
+        random_state : int, default 0
+            seed of the k-means stage, for reproducible labels
+        """
+        self.num_centroids = num_centroids
+        self.exact_below = exact_below
+        self.random_state = random_state
+
+    def __call__(self, embeddings, num_speakers):
+        if len(embeddings) < self.exact_below or len(embeddings) <= self.num_centroids:
+            return super().__call__(embeddings, num_speakers)
+
+        from sklearn.cluster import MiniBatchKMeans
+
+        kmeans = MiniBatchKMeans(self.num_centroids, batch_size=4096, n_init=3, random_state=self.random_state)
+        assignment = kmeans.fit_predict(embeddings)
+        centroid_labels = super().__call__(kmeans.cluster_centers_, num_speakers)
+        return centroid_labels[assignment]
+
+
+#names accepted by the clustering option of DiarizeAudio and SpeechPipeline
+CLUSTERING_BACKENDS = {
+    'agglomerative': AgglomerativeBackend,
+    'knn': KNNGraphBackend,
+    'two_stage': TwoStageBackend,
+}
+
+
+def get_clustering_backend(name='agglomerative', **kwargs):
+    """ creates a clustering backend by name
+
+    Parameters
+    -----------
+    name : string, default 'agglomerative'
+        one of CLUSTERING_BACKENDS
+    kwargs : keyword arguments
+        passed to the backend
+
+    Returns
+    -----------
+    backend : callable
+        backend(embeddings, num_speakers) -> labels
+    """
+    if name not in CLUSTERING_BACKENDS:
+        raise ValueError('unknown clustering backend ' + repr(name) + ', choose from ' + ', '.join(CLUSTERING_BACKENDS))
+    return CLUSTERING_BACKENDS[name](**kwargs)
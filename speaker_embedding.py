@@ -0,0 +1,401 @@
+import copy
+import os
+import warnings
+
+import numpy as np
+import torch
+
+from run_manifest import atomic_write
+
+#precisions of the optimized speaker embedding model
+EMBEDDING_PRECISIONS = ('fp32', 'int8')
+
+#seconds of the signals of the two probe batches, of different batch sizes
+PROBE_LENGTHS = ((0.8, 1.7, 3.0), (0.6, 1.1, 2.3, 3.6, 5.2))
+
+
+class BatchedSpeakerEmbedding(object):
+    """
+    """
+    def __init__(self, model, batch_size=32, max_batch_duration=600.0):
+        """ Extract speaker embeddings for many segments at once.
+        Segments are sorted by duration so that each batch holds crops of similar
+        length, which keeps the zero padding (and wasted model compute) low.
+
+        Parameters
+        -----------
+        model : PretrainedSpeakerEmbedding
+            speechbrain 'spkrec-ecapa-voxceleb' model loaded with pyannote,
+            instantiated in SpeechPipeline Class
+        batch_size : int, default 32
+            maximum number of segments sent to the model in one forward pass
+        max_batch_duration : float, default 600.0
+            maximum seconds of (padded) audio in one batch, bounds memory when
+            segments are long
+        """
+        self.embedding_model = model
+        self.batch_size = max(1, int(batch_size))
+        self.max_batch_duration = max_batch_duration
+
+    @property
+    def dimension(self):
+        return getattr(self.embedding_model, 'dimension', 192)
+
+    def _bounds(self, audio_file, segments):
+        """ sample offsets of every segment in the decoded audio
+
+        Returns
+        -----------
+        first, last : numpy arrays of int
+        """
+        num_samples = audio_file.num_samples
+        sample_rate = audio_file.sample_rate
+
+        starts = np.array([segment["start"] for segment in segments], dtype=np.float64)
+        # Whisper overshoots the end timestamp in the last segment
+        ends = np.array([segment["end"] for segment in segments], dtype=np.float64)
+
+        first = np.clip(np.round(starts * sample_rate), 0, num_samples).astype(np.int64)
+        last = np.clip(np.round(ends * sample_rate), 0, num_samples).astype(np.int64)
+        return first, np.maximum(first, last)
+
+    def _batches(self, lengths, sample_rate):
+        """ yields arrays of segment indices, grouped into buckets of similar duration """
+        order = np.argsort(lengths, kind='stable')
+        max_samples = self.max_batch_duration * sample_rate
+
+        batch = []
+        for i in order:
+            #padded size of the batch if segment i is added (i is the longest so far)
+            if batch and (len(batch) == self.batch_size or (len(batch) + 1) * lengths[i] > max_samples):
+                yield np.array(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            yield np.array(batch)
+
+    def __call__(self, audio_file, segments, out=None):
+        """ get the embedding of every segment
+
+        Parameters
+        -----------
+        audio_file : AudioFile Object
+            object holding the decoded audio
+        segments : list of dictionaries
+            created with whisper model
+        out : numpy array, optional
+            preallocated (len(segments), dimension) matrix the embeddings are written into
+
+        Returns
+        -----------
+        out : numpy array
+            (len(segments), dimension), NaN rows for segments too short to embed
+        """
+        if out is None:
+            out = np.zeros(shape=(len(segments), self.dimension))
+        if len(segments) == 0:
+            return out
+
+        first, last = self._bounds(audio_file, segments)
+        lengths = last - first
+
+        for batch in self._batches(lengths, audio_file.sample_rate):
+            max_length = max(1, int(lengths[batch].max()))
+            waveforms = torch.zeros(len(batch), 1, max_length)
+            masks = torch.zeros(len(batch), max_length)
+
+            for row, i in enumerate(batch):
+                waveforms[row, 0, :lengths[i]] = torch.from_numpy(audio_file.samples(first[i], last[i]))
+                masks[row, :lengths[i]] = 1.0
+
+            #no autograd bookkeeping, tensors created here are never used for training
+            with torch.inference_mode():
+                out[batch] = self.embedding_model(waveforms, masks=masks)
+
+        return out
+
+
+class WindowedSpeakerEmbedding(object):
+    """
+    """
+    def __init__(self, model, window=1.5, step=0.75, batch_size=32):
+        """ speaker embeddings of a file on a fixed grid of sliding windows, computed once
+        and pooled into an embedding for any list of segments (transcribed, translated or
+        word aligned), so diarizing another segmentation of the same file needs no model call.
+
+        Parameters
+        -----------
+        model : PretrainedSpeakerEmbedding
+            speaker embedding model, called through BatchedSpeakerEmbedding
+        window : float, default 1.5
+            length of the windows in seconds
+        step : float, default 0.75
+            seconds between the starts of consecutive windows
+        batch_size : int, default 32
+            maximum number of windows sent to the model in one forward pass
+        """
+        self.engine = BatchedSpeakerEmbedding(model, batch_size=batch_size)
+        self.window = window
+        self.step = step
+
+    def windows(self, duration):
+        """ window segments covering duration seconds, the last one may be shorter """
+        num_windows = max(1, int(np.ceil(max(0.0, duration - self.window) / self.step)) + 1)
+        starts = np.arange(num_windows) * self.step
+        return [{'start': start, 'end': min(start + self.window, duration)} for start in starts.tolist()]
+
+    def __call__(self, audio_file):
+        """ embeddings of every window of the audio
+
+        Returns
+        -----------
+        embeddings : numpy array
+            (number of windows, dimension), unit length, NaN rows for windows too short to embed
+        """
+        embeddings = self.engine(audio_file, self.windows(audio_file.duration))
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def pool(self, embeddings, segments):
+        """ embedding of every segment, the mean of the windows centred inside it. A segment
+        without such a window (shorter than step) takes the window closest to its middle.
+
+        Parameters
+        -----------
+        embeddings : numpy array
+            window embeddings of the file, from __call__
+        segments : list of dictionaries
+            with 'start' and 'end' in seconds
+
+        Returns
+        -----------
+        pooled : numpy array
+            (len(segments), dimension), NaN rows if the file has no valid window
+        """
+        pooled = np.full((len(segments), embeddings.shape[1]), np.nan)
+        valid = ~np.isnan(embeddings).any(axis=1)
+        if len(segments) == 0 or not valid.any():
+            return pooled
+
+        starts = np.array([segment['start'] for segment in segments], dtype=np.float64)
+        ends = np.array([segment['end'] for segment in segments], dtype=np.float64)
+        centres = np.arange(len(embeddings)) * self.step + self.window / 2
+
+        #sums over any range of windows from running sums, invalid windows count as zero
+        totals = np.concatenate([np.zeros((1, embeddings.shape[1])), np.cumsum(np.where(valid[:, None], embeddings, 0.0), axis=0)])
+        counts = np.concatenate([[0], np.cumsum(valid)])
+        first = np.searchsorted(centres, starts, side='left')
+        last = np.searchsorted(centres, ends, side='left')
+
+        #nearest valid window to the middle of segments without one
+        empty = counts[last] - counts[first] == 0
+        if empty.any():
+            valid_windows = np.flatnonzero(valid)
+            middles = (starts[empty] + ends[empty]) / 2
+            right = np.clip(np.searchsorted(centres[valid_windows], middles), 1, max(1, len(valid_windows) - 1))
+            left = right - 1
+            right = np.minimum(right, len(valid_windows) - 1)
+            closer_left = np.abs(centres[valid_windows[left]] - middles) <= np.abs(centres[valid_windows[right]] - middles)
+            nearest = valid_windows[np.where(closer_left, left, right)]
+            first[empty], last[empty] = nearest, nearest + 1
+
+        pooled[:] = (totals[last] - totals[first]) / (counts[last] - counts[first])[:, None]
+        return pooled
+
+
+class OptimizedSpeakerEmbedding(object):
+    """
+    """
+    def __init__(self, model, name, precision='fp32', cache_dir=None, tolerance=0.98, seed=0):
+        """ faster drop-in for the pyannote wrapper of a speechbrain speaker embedding model.
+        The embedding network (ECAPA-TDNN) is traced with torch.jit, optionally after int8
+        dynamic quantization of its linear and pointwise convolution layers, and the traced
+        model is saved to cache_dir so later runs load it without tracing again. Feature
+        extraction (filterbanks and normalisation) stays the speechbrain code.
+
+        Every time it is created, the optimized model embeds two probe batches of seeded
+        noise, of different batch sizes and lengths, and its embeddings are compared to the
+        original model. The trace is checked on both batches too, so a trace specialised to
+        the shape it was traced with is caught. A saved trace failing the comparison is traced
+        again, and if the lowest cosine similarity is still below tolerance, it warns and
+        falls back to the original model.
+
+        Parameters
+        -----------
+        model : PretrainedSpeakerEmbedding
+            speechbrain 'spkrec-ecapa-voxceleb' model loaded with pyannote
+        name : string
+            name of the model, part of the name of the cached file
+        precision : string, default 'fp32'
+            'fp32' or 'int8', int8 runs on the cpu only
+        cache_dir : string, optional
+            directory of the traced models, nothing is saved if None
+        tolerance : float, default 0.98
+            lowest cosine similarity to the original embeddings accepted on the probe batch
+        seed : int, default 0
+            seed of the probe batches
+        """
+        if precision not in EMBEDDING_PRECISIONS:
+            raise ValueError('precision must be one of ' + ', '.join(EMBEDDING_PRECISIONS) + ', got ' + repr(precision))
+
+        self.model = model
+        self.classifier = model.classifier_
+        self.device = torch.device('cpu') if precision == 'int8' else model.device
+        self.dimension = model.dimension
+        self.min_num_samples = model.min_num_samples
+        self.precision = precision
+        self.path = None
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, '{}-{}-torch{}.pt'.format(name.replace('/', '--'), precision, torch.__version__))
+
+        #a second batch size and other lengths, the trace must not depend on the first
+        self.probes = [self._probe_batch(seed + i, lengths) for i, lengths in enumerate(PROBE_LENGTHS)]
+        self.embedding_model = self._load_or_trace()
+
+        #compared on every load, a stale or badly traced file is never used silently
+        self.min_cosine = self.check_probes()
+        if self.min_cosine < tolerance and self.loaded:
+            #e.g. saved by an older version, trace it again
+            self.embedding_model = self._load_or_trace(retrace=True)
+            self.min_cosine = self.check_probes()
+        if self.min_cosine < tolerance:
+            warnings.warn('optimized speaker embeddings differ from the original model (cosine similarity '
+                '{:.4f} < {}), using the original model'.format(self.min_cosine, tolerance))
+            self.embedding_model = None
+
+    def _probe_batch(self, seed, lengths):
+        """ seeded noise of different lengths, padded like BatchedSpeakerEmbedding pads segments """
+        rng = np.random.default_rng(seed)
+        num_samples = [int(length * self.model.sample_rate) for length in lengths]
+        waveforms = torch.zeros(len(lengths), 1, max(num_samples))
+        masks = torch.zeros(len(lengths), max(num_samples))
+        for row, length in enumerate(num_samples):
+            waveforms[row, 0, :length] = torch.from_numpy(rng.standard_normal(length).astype(np.float32) * 0.1)
+            masks[row, :length] = 1.0
+        return waveforms, masks
+
+    def _features(self, waveforms, masks=None):
+        """ normalised filterbanks of the unpadded signals, as in the pyannote wrapper
+
+        Returns
+        -----------
+        features : torch tensor
+            (batch, frames, filters)
+        wav_lens : torch tensor
+            relative length of every signal
+        too_short : torch tensor of booleans
+            signals shorter than min_num_samples, None if all are too short
+        """
+        batch_size, _, num_samples = waveforms.shape
+        waveforms = waveforms.squeeze(dim=1)
+        if masks is None:
+            signals = waveforms
+            wav_lens = num_samples * torch.ones(batch_size)
+        else:
+            imasks = torch.nn.functional.interpolate(masks.unsqueeze(dim=1), size=num_samples, mode='nearest').squeeze(dim=1) > 0.5
+            signals = torch.nn.utils.rnn.pad_sequence([waveform[imask].contiguous() for waveform, imask in zip(waveforms, imasks)], batch_first=True)
+            wav_lens = imasks.sum(dim=1)
+
+        max_len = wav_lens.max()
+        if max_len < self.min_num_samples:
+            return None, None, None
+        too_short = wav_lens < self.min_num_samples
+        wav_lens = wav_lens / max_len
+        wav_lens[too_short] = 1.0
+
+        signals, wav_lens = signals.to(self.device).float(), wav_lens.to(self.device)
+        features = self.classifier.mods.compute_features(signals)
+        features = self.classifier.mods.mean_var_norm(features, wav_lens)
+        return features, wav_lens, too_short
+
+    def _load_or_trace(self, retrace=False):
+        """ the traced embedding network, from cache_dir if it was saved before, or None
+        if the trace does not give the same output as the network on the probe batches
+        """
+        self.loaded = False
+        if self.path is not None and os.path.exists(self.path) and not retrace:
+            try:
+                model = torch.jit.load(self.path, map_location=self.device)
+                self.loaded = True
+                return model
+            except RuntimeError as e:
+                warnings.warn('could not load ' + self.path + ', tracing again: ' + repr(e))
+
+        #a copy, the original model is shared with pipelines using it directly
+        network = copy.deepcopy(self.classifier.mods.embedding_model).eval()
+        if self.precision == 'int8':
+            from quantization import quantize_dynamic_int8
+            network = quantize_dynamic_int8(network)
+        network = network.to(self.device)
+
+        inputs = []
+        for waveforms, masks in self.probes:
+            with torch.inference_mode():
+                features, wav_lens, _ = self._features(waveforms, masks)
+            #tracing needs normal tensors, inference tensors can not be saved in the graph
+            inputs.append((features.clone(), wav_lens.clone()))
+        with torch.no_grad():
+            try:
+                #traced on the first probe batch, checked against the network on both
+                traced = torch.jit.trace(network, inputs[0], check_inputs=inputs)
+            except torch.jit.TracingCheckError as e:
+                warnings.warn('the traced speaker embedding model depends on the shape of its input, '
+                    'using the original model: ' + str(e).splitlines()[0])
+                #a trace saved before would only be traced again on every load
+                if self.path is not None and os.path.exists(self.path):
+                    os.remove(self.path)
+                return None
+
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with atomic_write(self.path, 'wb') as f:
+                torch.jit.save(traced, f)
+        return traced
+
+    def check_probes(self):
+        """ lowest cosine similarity to the original model over the probe batches, -inf if
+        the optimized model fails on one of them
+        """
+        try:
+            return min(self.check(waveforms, masks) for waveforms, masks in self.probes)
+        except RuntimeError as e:
+            warnings.warn('optimized speaker embeddings failed on a probe batch: ' + repr(e))
+            return float('-inf')
+
+    def check(self, waveforms, masks=None):
+        """ lowest cosine similarity between the embeddings of the optimized and the original
+        model, over the rows of a batch long enough to embed
+        """
+        optimized = self(waveforms, masks)
+        with torch.inference_mode():
+            original = self.model(waveforms, masks=masks)
+        valid = ~np.isnan(original).any(axis=1)
+        optimized, original = optimized[valid], original[valid]
+        cosine = np.sum(optimized * original, axis=1) / (np.linalg.norm(optimized, axis=1) * np.linalg.norm(original, axis=1))
+        return float(cosine.min()) if len(cosine) else 1.0
+
+    def __call__(self, waveforms, masks=None):
+        """ embeddings of a batch, same arguments and output as the pyannote wrapper
+
+        Parameters
+        -----------
+        waveforms : torch tensor
+            (batch, 1, samples)
+        masks : torch tensor, optional
+            (batch, samples), 1 for the samples of each signal
+
+        Returns
+        -----------
+        embeddings : numpy array
+            (batch, dimension), NaN rows for signals too short to embed
+        """
+        if self.embedding_model is None:
+            with torch.inference_mode():
+                return self.model(waveforms, masks=masks)
+
+        with torch.inference_mode():
+            features, wav_lens, too_short = self._features(waveforms, masks)
+            if features is None:
+                return np.nan * np.zeros((waveforms.shape[0], self.dimension))
+            embeddings = self.embedding_model(features, wav_lens).squeeze(dim=1).cpu().numpy()
+        embeddings[too_short.cpu().numpy()] = np.nan
+        return embeddings
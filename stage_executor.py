@@ -0,0 +1,148 @@
+import queue
+import threading
+import time
+import traceback
+
+#marks the end of the items in a queue
+_DONE = object()
+
+
+class StageExecutor(object):
+    """
+    """
+    def __init__(self, stages, queue_size=2):
+        """ runs items through a chain of stages, every stage on its own thread(s), with
+        bounded queues between them. While one item is in a slow stage (the models), the
+        next item is prepared and the previous one finished by the other stages.
+
+        Parameters
+        -----------
+        stages : list of tuples
+            (name, function) or (name, function, number of threads). Every function takes
+            the result of the previous stage; the first one takes the item.
+        queue_size : int, default 2
+            maximum number of items waiting in front of each stage
+        """
+        self.stages = [stage if len(stage) == 3 else (stage[0], stage[1], 1) for stage in stages]
+        self.queue_size = queue_size
+        self.stats = {}
+        self.wall_seconds = 0.0
+
+    def _worker(self, function, inbox, outbox, stats, lock, remaining):
+        """ takes items from inbox, applies function and puts the result in outbox """
+        while True:
+            #items waiting when this stage becomes free
+            depth = inbox.qsize()
+            waited = time.perf_counter()
+            entry = inbox.get()
+            with lock:
+                stats['idle_seconds'] += time.perf_counter() - waited
+                stats['queue_depth_total'] += depth
+                stats['queue_depth_max'] = max(stats['queue_depth_max'], depth)
+                stats['gets'] += 1
+
+            if entry is _DONE:
+                #let the other threads of this stage see the end too
+                inbox.put(_DONE)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    outbox.put(_DONE)
+                return
+
+            item, value, error = entry
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    value = function(value)
+                except Exception:
+                    error = traceback.format_exc()
+                with lock:
+                    stats['busy_seconds'] += time.perf_counter() - start
+                    stats['items'] += 1
+            outbox.put((item, value, error))
+
+    def run(self, items):
+        """ passes every item through all stages
+
+        Parameters
+        -----------
+        items : iterable
+            inputs of the first stage
+
+        Returns
+        -----------
+        results : dictionary
+            item -> (result of the last stage, traceback or None). Items whose stage
+            raised an error skip the following stages.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        results_queue = queue.Queue()
+        queues.append(results_queue)
+
+        threads = []
+        self.stats = {}
+        for i, (name, function, num_threads) in enumerate(self.stages):
+            stats = {'threads': num_threads, 'items': 0, 'busy_seconds': 0.0, 'idle_seconds': 0.0,
+                'queue_depth_total': 0, 'queue_depth_max': 0, 'gets': 0}
+            self.stats[name] = stats
+            lock = threading.Lock()
+            remaining = [num_threads]
+            for _ in range(num_threads):
+                thread = threading.Thread(target=self._worker, name='stage-' + name, daemon=True,
+                    args=(function, queues[i], queues[i + 1], stats, lock, remaining))
+                thread.start()
+                threads.append(thread)
+
+        start = time.perf_counter()
+
+        #feed from a thread, the first queue is bounded
+        def feed():
+            for item in items:
+                queues[0].put((item, item, None))
+            queues[0].put(_DONE)
+        feeder = threading.Thread(target=feed, name='stage-feed', daemon=True)
+        feeder.start()
+
+        results = {}
+        while True:
+            entry = results_queue.get()
+            if entry is _DONE:
+                break
+            item, value, error = entry
+            results[item] = (value, error)
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - start
+        return results
+
+    def stage_stats(self):
+        """ busy time, utilisation and queue depths of every stage of the last run
+
+        Returns
+        -----------
+        stats : dictionary
+            stage name -> {'items', 'busy_seconds', 'utilisation', 'queue_depth_mean', 'queue_depth_max'}
+        """
+        summary = {}
+        for name, stats in self.stats.items():
+            capacity = stats['threads'] * self.wall_seconds
+            summary[name] = {
+                'items': stats['items'],
+                'busy_seconds': round(stats['busy_seconds'], 3),
+                'utilisation': round(stats['busy_seconds'] / capacity, 3) if capacity else 0.0,
+                'queue_depth_mean': round(stats['queue_depth_total'] / stats['gets'], 2) if stats['gets'] else 0.0,
+                'queue_depth_max': stats['queue_depth_max'],
+            }
+        return summary
+
+    def format_stats(self):
+        """ stage_stats as a printable table """
+        lines = ['#### Stage statistics, {:.1f}s wall time ####'.format(self.wall_seconds)]
+        for name, stats in self.stage_stats().items():
+            lines.append('{:>10}: {items} items, {busy_seconds}s busy, {utilisation:.0%} utilised, '
+                'queue depth mean {queue_depth_mean} max {queue_depth_max}'.format(name, **stats))
+        return '\n'.join(lines)
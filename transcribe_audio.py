@@ -1,4 +1,195 @@
 #import whisperx
+import numpy as np
+
+#whisper mel frames per second, used for the 'seek' field of segments
+FRAMES_PER_SECOND = 100
+#seconds of audio per whisper encoder window
+WINDOW_SECONDS = 30
+#seconds per whisper timestamp token
+TIME_PRECISION = 0.02
+
+#fallback settings, same as the defaults of whisper.transcribe
+TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+
+def segments_from_tokens(tokenizer, result, offset, duration, seek=0, first_id=0):
+    """ splits the tokens decoded for one window into whisper style segments,
+    using the timestamp tokens as segment boundaries
+
+    Parameters
+    -----------
+    tokenizer : whisper tokenizer
+    result : whisper DecodingResult
+        decoded with timestamps
+    offset : float
+        start of the window in the file, in seconds
+    duration : float
+        length of the audio in the window, in seconds
+    seek : int
+        start of the window in mel frames
+    first_id : int
+        id of the first segment
+
+    Returns
+    -----------
+    segments : list of dictionaries
+        same fields as the segments of whisper.transcribe
+    """
+    tokens = list(result.tokens)
+    timestamp_begin = tokenizer.timestamp_begin
+
+    def make_segment(start, end, segment_tokens):
+        text_tokens = [token for token in segment_tokens if token < tokenizer.eot]
+        return {
+            "id": first_id + len(segments),
+            "seek": seek,
+            "start": offset + start,
+            "end": offset + min(end, duration),
+            "text": tokenizer.decode(text_tokens),
+            "tokens": segment_tokens,
+            "temperature": result.temperature,
+            "avg_logprob": result.avg_logprob,
+            "compression_ratio": result.compression_ratio,
+            "no_speech_prob": result.no_speech_prob,
+        }
+
+    segments = []
+    #two timestamp tokens in a row close one segment and open the next
+    cuts = [i for i in range(1, len(tokens)) if tokens[i] >= timestamp_begin and tokens[i - 1] >= timestamp_begin]
+
+    last_cut = 0
+    for cut in cuts:
+        sliced = tokens[last_cut:cut]
+        start = (sliced[0] - timestamp_begin) * TIME_PRECISION
+        end = (sliced[-1] - timestamp_begin) * TIME_PRECISION
+        segments.append(make_segment(start, end, sliced))
+        last_cut = cut
+
+    #text after the last complete segment runs to its last timestamp or the end of the window
+    remainder = tokens[last_cut:]
+    if any(token < tokenizer.eot for token in remainder):
+        timestamps = [token for token in remainder if token >= timestamp_begin]
+        start = (timestamps[0] - timestamp_begin) * TIME_PRECISION if remainder[0] >= timestamp_begin else 0.0
+        end = duration
+        if len(timestamps) > 1 or (timestamps and remainder[-1] >= timestamp_begin):
+            end = max(start, (timestamps[-1] - timestamp_begin) * TIME_PRECISION)
+        segments.append(make_segment(start, end, remainder))
+
+    return segments
+
+
+def decode_with_fallback(model, features, **options):
+    """ decodes a batch of encoded audio, retrying at higher temperatures the items whose
+    text is repetitive or unlikely, as whisper.transcribe does. Retries are batched too.
+
+    Parameters
+    -----------
+    model : whisper model
+    features : torch tensor
+        (batch, n_audio_ctx, n_audio_state) output of the whisper encoder
+    options : keyword arguments
+        passed to whisper.DecodingOptions
+
+    Returns
+    --------
+    results : list of whisper DecodingResults
+        one per item of the batch
+    """
+    from whisper.decoding import DecodingOptions, decode
+
+    results = [None] * len(features)
+    remaining = list(range(len(features)))
+    for temperature in TEMPERATURES:
+        decoded = decode(model, features[remaining], DecodingOptions(temperature=temperature, **options))
+        retry = []
+        for index, result in zip(remaining, decoded):
+            results[index] = result
+            if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                #silence, a higher temperature will not help
+                continue
+            if result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD:
+                retry.append(index)
+        remaining = retry
+        if not remaining:
+            break
+    return results
+
+
+def transcribe_clips(model, clips, languages, batch_size=16, verbose=False):
+    """ transcribes short clips (at most WINDOW_SECONDS each) with one encoder pass and
+    one greedy decoding pass per batch of clips, instead of a padded 30 second window
+    per clip at batch size 1. Clips without a language get the language detected from
+    their encoder output, and the clips of one batch are decoded together per language.
+
+    Parameters
+    -----------
+    model : whisper model
+    clips : list of numpy arrays
+        16 kHz float32 samples, at most WINDOW_SECONDS long
+    languages : list of strings
+        language code of every clip, or None to detect it
+    batch_size : int, default 16
+        clips per encoder and decoder pass
+    verbose: : boolean, default False
+        if true, print statements about progress
+
+    Returns
+    --------
+    segments : list of lists of dictionaries
+        whisper style segments of every clip, times relative to the start of the clip
+    languages : list of strings
+        language of every clip
+    """
+    import torch
+    from whisper.audio import SAMPLE_RATE, log_mel_spectrogram, pad_or_trim
+    from whisper.tokenizer import get_tokenizer
+
+    fp16 = model.device.type != 'cpu'
+    n_mels = getattr(model.dims, 'n_mels', 80)
+    languages = list(languages)
+    segments = [[] for _ in clips]
+
+    for start in range(0, len(clips), batch_size):
+        batch = list(range(start, min(start + batch_size, len(clips))))
+        if verbose:
+            print('=== Transcribing clips', batch[0] + 1, 'to', batch[-1] + 1, 'of', len(clips), '===')
+
+        mel = torch.stack([log_mel_spectrogram(pad_or_trim(clips[i]), n_mels) if n_mels != 80
+            else log_mel_spectrogram(pad_or_trim(clips[i])) for i in batch]).to(model.device)
+        if fp16:
+            mel = mel.half()
+
+        with torch.no_grad():
+            #one encoder forward pass for the whole batch
+            features = model.embed_audio(mel)
+
+            unknown = [position for position, i in enumerate(batch) if languages[i] is None]
+            if unknown and model.is_multilingual:
+                _, probs = model.detect_language(features[unknown])
+                for position, clip_probs in zip(unknown, probs):
+                    languages[batch[position]] = max(clip_probs, key=clip_probs.get)
+            for position in unknown:
+                if languages[batch[position]] is None:
+                    languages[batch[position]] = 'en'
+
+        #a decoding pass has one language, clips are grouped by theirs
+        for language in sorted(set(languages[i] for i in batch)):
+            positions = [position for position, i in enumerate(batch) if languages[i] == language]
+            tokenizer = get_tokenizer(model.is_multilingual, language=language, task='transcribe')
+            results = decode_with_fallback(model, features[positions], task='transcribe', language=language,
+                fp16=fp16, without_timestamps=False)
+
+            for position, result in zip(positions, results):
+                if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                    continue
+                i = batch[position]
+                segments[i] = segments_from_tokens(tokenizer, result, 0.0, len(clips[i]) / SAMPLE_RATE)
+
+    return segments, languages
+
 
 class TranscribeAudio(object):
     """
@@ -9,17 +200,13 @@ class TranscribeAudio(object):
         Parameters
         -----------
         Audiofile : AudioFile Object
-            Audiofile object containing path to audiofile
+            Audiofile object holding the decoded audio samples
         model : whisper model
             whisper model, instantiated in SpeechPipeline Class
         """
 
         self.audiofile = audio_file
         self.asr_model = model
-        #check to see if audio file is in wav format, if not convert to wav format
-        if self.audiofile.path[-3:] != 'wav':
-            #update self.path to new wav file
-            self.audiofile.convert_to_wav()
 
 
     def transcribe_audio(self, verbose=False):
@@ -40,7 +227,9 @@ class TranscribeAudio(object):
         if verbose:
             print('=== Transcribing',self.audiofile.path,'===')
 
-        result = self.asr_model.transcribe(self.audiofile.path)
+        #pass the decoded samples so whisper does not run ffmpeg on the file again, and the
+        #language (if known) so it does not detect it again
+        result = self.asr_model.transcribe(self.audiofile.audio, language=self.audiofile.language)
         segments = result["segments"]
         return segments
         
@@ -56,6 +245,159 @@ class TranscribeAudio(object):
         if verbose:
             print('=== Translate',self.audiofile.path,'===')
 
-        result = self.asr_model.transcribe(self.audiofile.path, task='translate')
+        result = self.asr_model.transcribe(self.audiofile.audio, task='translate', language=self.audiofile.language)
         segments = result["segments"]
         return segments
+
+
+    def transcribe_stream(self, window=60.0, task='transcribe', verbose=False):
+        """ transcribe (or translate) audio one window at a time, yielding segments as
+        soon as they are decoded. Memory depends on the window, not on the file length.
+
+        The last segment of a window may be cut off by the window edge, so it is not
+        yielded. Its audio is carried over and decoded again at the start of the next
+        window, with the text decoded so far as the prompt.
+
+        Parameters
+        -----------
+        window : float, default 60.0
+            seconds of new audio read and decoded per step
+        task : string, default 'transcribe'
+            'transcribe' or 'translate' (to English)
+        verbose: : boolean, default False
+            if true, print statements about progress
+
+        Yields
+        --------
+        segment: dictionary
+            whisper segment with timestamps on the timeline of the whole file
+        """
+        if verbose:
+            print('=== Streaming', task, self.audiofile.path, '===')
+
+        sample_rate = self.audiofile.sample_rate
+        carry = np.zeros(0, dtype=np.float32)
+        prompt = None
+        segment_id = 0
+
+        windows = self.audiofile.stream(window)
+        pending = next(windows, None)
+        while pending is not None:
+            offset, samples = pending
+            pending = next(windows, None)
+
+            #start of the buffer on the timeline of the whole file
+            buffer_offset = offset - len(carry) / sample_rate
+            buffer = np.concatenate([carry, samples]) if len(carry) else samples
+            carry = np.zeros(0, dtype=np.float32)
+
+            segments = self.asr_model.transcribe(buffer, task=task, initial_prompt=prompt, language=self.audiofile.language)["segments"]
+
+            if pending is not None and len(segments) > 1:
+                #decode the (possibly cut off) last segment again with the next window
+                carry = buffer[int(segments[-1]["start"] * sample_rate):]
+                segments = segments[:-1]
+
+            for segment in segments:
+                segment = dict(segment)
+                segment["id"] = segment_id
+                segment["seek"] = segment["seek"] + int(round(buffer_offset * FRAMES_PER_SECOND))
+                segment["start"] = segment["start"] + buffer_offset
+                segment["end"] = segment["end"] + buffer_offset
+                segment_id += 1
+                yield segment
+
+            if segments:
+                prompt = ''.join(segment["text"] for segment in segments)
+
+
+    def _decode_with_fallback(self, features, **options):
+        """ decodes encoded audio, retrying at higher temperatures when the text is
+        repetitive or unlikely, as whisper.transcribe does
+
+        Parameters
+        -----------
+        features : torch tensor
+            (1, n_audio_ctx, n_audio_state) output of the whisper encoder
+        options : keyword arguments
+            passed to whisper.DecodingOptions
+
+        Returns
+        --------
+        result : whisper DecodingResult
+        """
+        return decode_with_fallback(self.asr_model, features, **options)[0]
+
+    def transcribe_and_translate(self, verbose=False):
+        """ transcribe audio and translate it to English with one encoder pass.
+        The log-mel spectrogram and whisper encoder output of every 30 second window
+        are computed once and both tasks are decoded from them, so translating costs
+        only the (cheap) decoding. Windows do not overlap, unlike whisper.transcribe
+        which moves each window to the last complete segment.
+
+        Parameters
+        -----------
+        verbose: : boolean, default False
+            if true, print statements about progress
+
+        Return
+        --------
+        segments: list of dictionaries
+            ASR transcript
+        english_segments: list of dictionaries
+            ASR transcript translated to English
+        """
+        import torch
+        from whisper.audio import log_mel_spectrogram, pad_or_trim
+        from whisper.tokenizer import get_tokenizer
+
+        if verbose:
+            print('=== Transcribing and Translating', self.audiofile.path, '===')
+
+        model = self.asr_model
+        fp16 = model.device.type != 'cpu'
+        n_mels = getattr(model.dims, 'n_mels', 80)
+        sample_rate = self.audiofile.sample_rate
+
+        #detected from the first window if the audio file does not know it
+        language = self.audiofile.language
+        tokenizers = {}
+        prompts = {'transcribe': [], 'translate': []}
+        results = {'transcribe': [], 'translate': []}
+
+        for offset, samples in self.audiofile.stream(WINDOW_SECONDS):
+            chunk = pad_or_trim(samples)
+            mel = log_mel_spectrogram(chunk, n_mels) if n_mels != 80 else log_mel_spectrogram(chunk)
+            mel = mel.to(model.device)[None]
+            if fp16:
+                mel = mel.half()
+
+            #one encoder forward pass, shared by both tasks, without keeping its autograd graph
+            with torch.no_grad():
+                features = model.embed_audio(mel)
+
+            if not tokenizers:
+                if language is None and model.is_multilingual:
+                    #detected once, from the encoder output of the first window
+                    _, probs = model.detect_language(features)
+                    language = max(probs[0], key=probs[0].get)
+                elif language is None:
+                    language = 'en'
+                for task in results:
+                    tokenizers[task] = get_tokenizer(model.is_multilingual, language=language, task=task)
+
+            for task in results:
+                result = self._decode_with_fallback(features, task=task, language=language, fp16=fp16,
+                    prompt=prompts[task], without_timestamps=False)
+
+                if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+                    continue
+
+                segments = segments_from_tokens(tokenizers[task], result, offset, len(samples) / sample_rate,
+                    seek=int(round(offset * FRAMES_PER_SECOND)), first_id=len(results[task]))
+                results[task].extend(segments)
+
+                #condition the next window on this text, unless decoding was unstable
+                prompts[task] = [] if result.temperature > 0.5 else [token for token in result.tokens if token < tokenizers[task].eot]
+
+        return results['transcribe'], results['translate']
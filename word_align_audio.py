@@ -3,43 +3,81 @@ import whisperx
 class WordAlignAudio(object):
     """
     """
-    def __init__(self, audio_file, alignment_model, metadata, device):
+    def __init__(self, audio_file, alignment_model, metadata, device, window=300.0):
         """ Transcribe audio with word-level timestamps. This can only be done
         after running the Whisper model and getting transcribed segments.
 
         Parameters
         ------------
         audio_file : AudioFile Object
-            Audiofile object containing path to audiofile
+            Audiofile object holding the decoded audio samples
         alignment_model : whisper model
             whisper model, instantiated in SpeechPipeline Class
         metadata : xxx
             xxx
         device : string
             specifies to use GPU or CPU
+        window : float, default 300.0
+            maximum seconds of audio cropped and aligned at once
         """
 
         self.audiofile = audio_file
         self.alignment_model = alignment_model
         self.metadata = metadata
         self.device = device
+        self.window = window
+
+    @staticmethod
+    def _shift_times(item, offset):
+        """ adds offset to every 'start'/'end' timestamp in nested segment dictionaries """
+        if isinstance(item, list):
+            return [WordAlignAudio._shift_times(value, offset) for value in item]
+        if isinstance(item, dict):
+            shifted = {}
+            for key, value in item.items():
+                if key in ('start', 'end') and isinstance(value, (int, float)):
+                    shifted[key] = value + offset
+                else:
+                    shifted[key] = WordAlignAudio._shift_times(value, offset)
+            return shifted
+        return item
+
+    def _windows(self, segments):
+        """ yields runs of consecutive segments spanning at most self.window seconds """
+        run = []
+        for segment in segments:
+            if run and segment['end'] - run[0]['start'] > self.window:
+                yield run
+                run = []
+            run.append(segment)
+        if run:
+            yield run
 
     def align_words(self, segments, verbose=False):
         """ add word-level timestamp alignment to whisper ASR segments
 
         Parameters
         -----------
-        segements : 
+        segements :
         verbose : boolean
             default False, prints statements about alignment progress
 
         returns
-        -----------  
-        aligned_segments : 
+        -----------
+        aligned_segments :
         """
 
         if verbose:
             print('### Starting Word-Level Alignment with WhisperX ####')
 
-        return whisperx.align(segments, self.alignment_model, self.metadata, self.audiofile.path, self.device)
+        #align one window at a time so only that part of the audio is read
+        aligned_segments = {'segments': [], 'word_segments': []}
+        for run in self._windows(segments):
+            offset = run[0]['start']
+            audio = self.audiofile.crop(offset, run[-1]['end'])
+            #whisperx crops every segment out of the window instead of reloading the file
+            result = whisperx.align(self._shift_times(run, -offset), self.alignment_model, self.metadata, audio, self.device)
+            for key, value in self._shift_times(result, offset).items():
+                aligned_segments.setdefault(key, []).extend(value)
 
+        return aligned_segments
@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import fire
+
+from run_manifest import atomic_write
+
+#seconds a lease stays valid without a heartbeat
+LEASE_SECONDS = 600.0
+
+#a file that failed this many times is not claimed again
+MAX_ATTEMPTS = 3
+
+
+class WorkQueue(object):
+    """
+    """
+    def __init__(self, queue_dir, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """ work queue in a shared directory (e.g. on NFS), for several pipelines on one or
+        more machines processing the same input files without a broker.
+
+        A worker claims a file by creating its lease file with O_CREAT | O_EXCL, which only
+        one worker can do. A heartbeat thread touches the leases it holds, so their
+        modification time stays recent while the file is processed. A lease not touched for
+        lease_seconds belongs to a dead worker: it is renamed away (only one worker's rename
+        succeeds) and the file claimed again. Finished files get a done marker and are never
+        claimed again, failed files are retried until they failed max_attempts times.
+
+        Times are compared with the modification time of a file touched in queue_dir, so
+        the clocks of the machines do not need to agree, only the file server's clock counts.
+
+        Parameters
+        -----------
+        queue_dir : string
+            directory of the queue, shared by all workers, created if needed
+        lease_seconds : float, default 600.0
+            seconds without a heartbeat after which a lease expires
+        max_attempts : int, default 3
+            number of failures after which a file is given up
+        """
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        for name in ['leases', 'done', 'failed', 'clock']:
+            os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+        #lease path -> token of the leases held by this worker
+        self.held = {}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _key(self, file):
+        """ name of the markers of file, readable and unique per absolute path """
+        digest = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()[:16]
+        return os.path.basename(file) + '.' + digest
+
+    def _path(self, kind, file):
+        return os.path.join(self.queue_dir, kind, self._key(file) + '.json')
+
+    def now(self):
+        """ current time of the file server, the modification time of a file touched now """
+        path = os.path.join(self.queue_dir, 'clock', self.worker_id)
+        with open(path, 'a'):
+            os.utime(path)
+        return os.stat(path).st_mtime
+
+    @staticmethod
+    def _read(path):
+        """ json content of a marker or lease, None if it does not exist or is being written """
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_done(self, file):
+        """ True if file has a done marker """
+        return os.path.exists(self._path('done', file))
+
+    def attempts(self, file):
+        """ number of times file failed """
+        failed = self._read(self._path('failed', file))
+        return failed['attempts'] if failed is not None else 0
+
+    def is_finished(self, file):
+        """ True if file is done or failed too often, no worker will claim it again """
+        return self.is_done(file) or self.attempts(file) >= self.max_attempts
+
+    def claim(self, file):
+        """ tries to take the lease of file
+
+        Parameters
+        -----------
+        file : string
+            path of the input file
+
+        Returns
+        -----------
+        claimed : boolean
+            True if this worker now holds the lease and should process file
+        """
+        if self.is_finished(file):
+            return False
+
+        lease_path = self._path('leases', file)
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                #held by another worker, try again once if its lease expired and was reclaimed
+                if not self._reclaim(lease_path):
+                    return False
+                continue
+
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'file': file, 'worker': self.worker_id, 'token': token, 'time': time.time()}, f)
+            #done while the lease was being taken, e.g. by the worker whose lease expired
+            if self.is_done(file):
+                self._remove_lease(lease_path, token)
+                return False
+            with self.lock:
+                self.held[lease_path] = token
+            self._start_heartbeat()
+            return True
+        return False
+
+    def _reclaim(self, lease_path):
+        """ removes the lease at lease_path if it expired, True if it is gone """
+        try:
+            modified = os.stat(lease_path).st_mtime
+        except FileNotFoundError:
+            return True
+        if self.now() - modified < self.lease_seconds:
+            return False
+
+        expired = self._read(lease_path)
+        stale_path = lease_path + '.' + self.worker_id + '.stale'
+        try:
+            #only one worker's rename succeeds, the others find the lease gone
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+
+        moved = self._read(stale_path)
+        if expired is not None and moved is not None and moved.get('token') != expired.get('token'):
+            #another worker reclaimed it and took a new lease between the check and the rename, give it back
+            try:
+                os.link(stale_path, lease_path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def _remove_lease(self, lease_path, token):
+        """ removes a lease if it is still the one with token """
+        with self.lock:
+            self.held.pop(lease_path, None)
+        lease = self._read(lease_path)
+        if lease is not None and lease.get('token') == token:
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+
+    def _start_heartbeat(self):
+        with self.lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renew, name='work-queue-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def _renew(self):
+        """ touches the held leases every third of lease_seconds, until close """
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = dict(self.held)
+            for lease_path, token in held.items():
+                lease = self._read(lease_path)
+                if lease is None or lease.get('token') != token:
+                    #expired and reclaimed by another worker, which now processes the file too
+                    with self.lock:
+                        self.held.pop(lease_path, None)
+                    continue
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    pass
+
+    def complete(self, file, outputs=()):
+        """ writes the done marker of file and releases its lease
+
+        Parameters
+        -----------
+        file : string
+            path of the input file
+        outputs : list of strings
+            saved output paths, kept in the marker
+        """
+        with atomic_write(self._path('done', file)) as f:
+            json.dump({'file': file, 'worker': self.worker_id, 'time': time.time(), 'outputs': list(outputs)}, f)
+        self.release(file)
+
+    def fail(self, file, error):
+        """ counts a failed attempt of file and releases its lease, it is claimed again
+        until it failed max_attempts times
+        """
+        attempts = self.attempts(file) + 1
+        with atomic_write(self._path('failed', file)) as f:
+            json.dump({'file': file, 'worker': self.worker_id, 'time': time.time(), 'attempts': attempts,
+                'error': error}, f)
+        self.release(file)
+
+    def release(self, file):
+        """ gives up the lease of file without marking it """
+        lease_path = self._path('leases', file)
+        with self.lock:
+            token = self.held.get(lease_path)
+        if token is not None:
+            self._remove_lease(lease_path, token)
+
+    def close(self):
+        """ stops the heartbeat and releases every held lease """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self.lock:
+            held = dict(self.held)
+        for lease_path, token in held.items():
+            self._remove_lease(lease_path, token)
+        try:
+            os.remove(os.path.join(self.queue_dir, 'clock', self.worker_id))
+        except FileNotFoundError:
+            pass
+
+    def process(self, files, process_file, poll_seconds=None, verbose=True):
+        """ claims and processes files until every file is finished. Files leased by other
+        workers are waited for, and taken over if their lease expires.
+
+        Parameters
+        -----------
+        files : list of strings
+            paths of the input files, the same list on every worker
+        process_file : function
+            called with the path of every claimed file, returns its output paths
+        poll_seconds : float, optional
+            wait between passes over files leased by others, defaults to a quarter of lease_seconds
+        verbose : boolean, default True
+            prints updates to console about claimed and finished files
+
+        Returns
+        -----------
+        failed : dictionary
+            file path -> error of every file that failed in this worker and is not done
+        """
+        import random
+        import traceback
+
+        poll_seconds = poll_seconds if poll_seconds is not None else self.lease_seconds / 4
+        #workers start at different files, so they rarely race for the same lease
+        start = random.randrange(len(files)) if files else 0
+        files = files[start:] + files[:start]
+
+        failed = {}
+        try:
+            while True:
+                pending = [file for file in files if not self.is_finished(file)]
+                if not pending:
+                    break
+                claimed = 0
+                for file in pending:
+                    if not self.claim(file):
+                        continue
+                    claimed += 1
+                    if verbose:
+                        print('#### Claimed', file, '####')
+                    try:
+                        outputs = process_file(file)
+                    except Exception:
+                        failed[file] = traceback.format_exc()
+                        self.fail(file, failed[file])
+                        if verbose:
+                            print('#### Failed', file, '####')
+                            print(failed[file])
+                    else:
+                        self.complete(file, outputs or ())
+                        failed.pop(file, None)
+                if not claimed:
+                    #the rest is leased by other workers, wait for them to finish or expire
+                    time.sleep(poll_seconds)
+        finally:
+            self.close()
+        #files another worker completed after they failed here
+        return {file: error for file, error in failed.items() if not self.is_done(file)}
+
+    def status(self):
+        """ number of done, failed, given up, leased and expired files """
+        now = self.now()
+        leases = [os.path.join(self.queue_dir, 'leases', name) for name in os.listdir(os.path.join(self.queue_dir, 'leases'))
+            if name.endswith('.json')]
+        expired = 0
+        for path in leases:
+            try:
+                expired += now - os.stat(path).st_mtime >= self.lease_seconds
+            except FileNotFoundError:
+                pass
+        failed = [self._read(os.path.join(self.queue_dir, 'failed', name)) for name in os.listdir(os.path.join(self.queue_dir, 'failed'))]
+        failed = [marker for marker in failed if marker is not None]
+        return {
+            'done': len(os.listdir(os.path.join(self.queue_dir, 'done'))),
+            'failed': len(failed),
+            'given_up': sum(marker['attempts'] >= self.max_attempts for marker in failed),
+            'leased': len(leases),
+            'expired': expired,
+        }
+
+    def reset_failed(self):
+        """ removes the failure counts, so files given up are claimed again """
+        for name in os.listdir(os.path.join(self.queue_dir, 'failed')):
+            os.remove(os.path.join(self.queue_dir, 'failed', name))
+
+
+if __name__ == '__main__':
+    """
+    inspects a queue, e.g.
+    python3 work_queue.py --queue_dir /mnt/corpus/queue status
+    python3 work_queue.py --queue_dir /mnt/corpus/queue reset_failed
+    """
+    fire.Fire(WorkQueue)